@@ -3,10 +3,15 @@ Base Agent — foundation class for all specialized rehabilitation agents.
 """
 
 import json
+import time
 import anthropic
 from rehab_consultant import TOOLS, execute_tool, extract_text_response
 from utils.security import validate_medical_output
 
+# Minimum seconds between placeholder refreshes while streaming — each refresh
+# re-sends and re-parses the whole accumulated text, so per-token updates are O(n²)
+STREAM_REFRESH_INTERVAL = 0.05
+
 
 class BaseAgent:
     """Base class for specialized rehabilitation agents."""
@@ -117,22 +122,25 @@ class BaseAgent:
             iteration += 1
 
             with client.messages.stream(**api_params) as stream:
-                current_text = ""
+                last_refresh = 0.0
                 for event in stream:
                     if event.type == "content_block_delta":
                         if hasattr(event.delta, "text"):
-                            current_text += event.delta.text
                             accumulated_text += event.delta.text
-                            if placeholder:
+                            # Throttled refresh — the final text is rendered once below
+                            now = time.monotonic()
+                            if placeholder and now - last_refresh >= STREAM_REFRESH_INTERVAL:
                                 placeholder.markdown(accumulated_text + " |")
+                                last_refresh = now
 
                 response = stream.get_final_message()
 
             if response.stop_reason == "end_turn":
+                final_text = validate_medical_output(accumulated_text)
                 if placeholder:
-                    placeholder.markdown(validate_medical_output(accumulated_text))
+                    placeholder.markdown(final_text)
                 return {
-                    "text": validate_medical_output(accumulated_text),
+                    "text": final_text,
                     "tool_calls": tool_calls_log,
                     "thinking_used": use_thinking,
                 }
@@ -161,10 +169,11 @@ class BaseAgent:
                         })
                 api_params["messages"].append({"role": "user", "content": tool_results})
             else:
+                final_text = validate_medical_output(accumulated_text)
                 if placeholder:
-                    placeholder.markdown(validate_medical_output(accumulated_text))
+                    placeholder.markdown(final_text)
                 return {
-                    "text": validate_medical_output(accumulated_text),
+                    "text": final_text,
                     "tool_calls": tool_calls_log,
                     "thinking_used": False,
                 }
@@ -6,12 +6,50 @@ Medical Rehabilitation AI Consultant — Streamlit UI
 
 import os
 import json
+import atexit
 import html
+import io
+import hashlib
+import heapq
 import re
+import sqlite3
 import base64
+import threading
+import time
+import uuid
+import warnings
 import anthropic
+import numpy as np
 import streamlit as st
+from collections import Counter, deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime
+from itertools import chain
+from operator import itemgetter
+from types import MappingProxyType
+try:
+    import orjson
+except ImportError:
+    # fallback إلى json القياسي إن لم تتوفر orjson
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    # بدون ijson يُشتق الملخص من قراءة الملف كاملاً
+    ijson = None
+try:
+    from PIL import Image
+except ImportError:
+    # بدون Pillow تُرسل الصور المرفقة كما هي دون تصغير
+    Image = None
+try:
+    import fcntl
+except ImportError:
+    # Windows — لا يتوفر قفل الملفات
+    fcntl = None
 from utils.security import sanitize_patient_input, validate_medical_output
 from rehab_consultant import SYSTEM_PROMPT, TOOLS, execute_tool, extract_text_response
 from orchestrator import RehabOrchestrator
@@ -36,7 +74,7 @@ st.set_page_config(
 
 PATIENTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "patients")
 
-ICD10_OPTIONS = {
+ICD10_OPTIONS = MappingProxyType({
     # Vision
     "H35.30": "AMD — تنكس بقعي مرتبط بالعمر",
     "H35.32": "AMD رطبة — Exudative AMD",
@@ -80,14 +118,72 @@ ICD10_OPTIONS = {
     # Pain
     "G89.4": "Chronic pain — ألم مزمن",
     "M79.7": "Fibromyalgia — فيبروميالجيا",
-}
+})
+# خيارات وتسميات جاهزة للمكوّنات — تُبنى مرة واحدة عند تحميل الوحدة
+ICD10_CODES = tuple(ICD10_OPTIONS)
+ICD10_LABELS = MappingProxyType({code: f"{code}: {label}" for code, label in ICD10_OPTIONS.items()})
 
-VISION_PATTERNS = [
+VISION_PATTERNS = (
     "central_scotoma", "hemianopia", "tunnel_vision",
     "total_blindness", "peripheral_loss", "general_blur",
-]
+)
+VISION_PATTERN_CHOICES = ("",) + VISION_PATTERNS
+
+COG_STATES = ("normal", "mild_impairment", "moderate_impairment", "severe_impairment")
+COG_INDEX = {s: i for i, s in enumerate(COG_STATES)}
+# تسميات الخيارات الثابتة — تُمرَّر إلى format_func كـ __getitem__ بدل lambda تبني قاموساً لكل خيار
+COG_STATE_LABELS = MappingProxyType({
+    "normal": "طبيعي", "mild_impairment": "خفيف",
+    "moderate_impairment": "متوسط", "severe_impairment": "شديد",
+})
+GENDER_LABELS = MappingProxyType({"male": "ذكر", "female": "أنثى"})
+GENDERS = tuple(GENDER_LABELS)
+AFFECTED_SIDE_LABELS = MappingProxyType({"": "—", "right": "أيمن", "left": "أيسر", "bilateral": "ثنائي"})
+AFFECTED_SIDES = tuple(AFFECTED_SIDE_LABELS)
+ASSESSMENT_TYPE_LABELS = MappingProxyType({
+    "fixation": "ثبات التثبيت (BCEA)", "reading": "سرعة القراءة (MNREAD)",
+    "visual_search": "المسح البصري", "contrast": "حساسية التباين",
+})
+ASSESSMENT_TYPES = tuple(ASSESSMENT_TYPE_LABELS)
+INTERVENTION_TYPE_LABELS = MappingProxyType({
+    "scanning": "تدريب المسح البصري", "perceptual_learning": "التعلم الإدراكي",
+    "device_routing": "التوجيه الذكي للمعدات", "visual_augmentation": "التعزيز البصري",
+})
+INTERVENTION_TYPES = tuple(INTERVENTION_TYPE_LABELS)
+# خيارات ثابتة لبقية الحقول — tuple على مستوى الوحدة بدل قائمة تُبنى في كل إعادة تشغيل
+NYHA_CLASSES = ("I", "II", "III", "IV")
+NOTE_TYPES = ("ملاحظة عامة", "تقييم", "متابعة", "إحالة")
+BLIND_SIDES = ("right", "left")
+REPORT_LANGUAGES = ("ar", "en")
+# مستويات LogCS في لوحة Pelli-Robson (ثلاثيات أحرف)
+PELLI_ROBSON_LEVELS = (0.0, 0.15, 0.30, 0.45, 0.60, 0.75, 0.90, 1.05, 1.20, 1.35)
+# أقل عدد نقاط تثبيت لحساب BCEA (تباين وتغاير X/Y)
+MIN_FIXATION_POINTS = 3
+
+# قيمة افتراضية فارغة مشتركة لـ multiselect — tuple غير قابلة للتعديل فآمنة للمشاركة
+_EMPTY_DEFAULT = ()
+
+IMAGE_MEDIA_TYPES = MappingProxyType({
+    "png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp",
+})
+# أقصى بُعد للصورة المرفقة قبل إرسالها — نماذج الرؤية تصغّر ما هو أكبر على أي حال
+IMAGE_MAX_SIDE = 1536
+
+DOC_TYPES = ("تقرير شامل", "خطاب إحالة", "خطة علاجية")
+REFERRAL_SPECIALTIES = (
+    "ophthalmology", "neurology", "orthopedics", "cardiology",
+    "pulmonology", "psychiatry", "psychology", "pediatrics", "ot", "om",
+    "social_work", "optometry", "pain_management",
+)
+
+# عدد السجلات المعروضة في كل صفحة من السجل السابق والملاحظات
+HISTORY_PAGE_SIZE = 20
+# أقصى عدد رسائل محادثة تبقى في نافذة العرض — السجل الكامل يبقى في ملف المريض
+CHAT_VIEW_SIZE = 200
+# نافذة تجاهل الإرسال المكرر لنفس الرسالة (بالثواني)
+DUPLICATE_SEND_WINDOW = 5.0
 
-FUNCTIONAL_GOALS = [
+FUNCTIONAL_GOALS = (
     # General / ADL
     "ADL", "mobility", "transfers", "stair_climbing",
     "self_care", "dressing", "feeding", "toileting",
@@ -106,9 +202,9 @@ FUNCTIONAL_GOALS = [
     "balance", "coordination", "cognitive_function",
     # Pain
     "pain_management", "sleep_quality",
-]
+)
 
-FUNCTIONAL_GOALS_AR = {
+FUNCTIONAL_GOALS_AR = MappingProxyType({
     "ADL": "الأنشطة اليومية", "mobility": "التنقل", "transfers": "الانتقالات",
     "stair_climbing": "صعود الدرج", "self_care": "العناية الشخصية",
     "dressing": "ارتداء الملابس", "feeding": "تناول الطعام", "toileting": "استخدام الحمام",
@@ -121,9 +217,28 @@ FUNCTIONAL_GOALS_AR = {
     "endurance": "التحمل", "balance": "التوازن", "coordination": "التنسيق",
     "cognitive_function": "الوظائف الإدراكية", "pain_management": "إدارة الألم",
     "sleep_quality": "جودة النوم",
-}
+})
+# تسمية كل هدف للمكوّنات — بدون lambda و.get() لكل خيار في كل إعادة تشغيل
+FUNCTIONAL_GOAL_LABELS = MappingProxyType({g: FUNCTIONAL_GOALS_AR.get(g, g) for g in FUNCTIONAL_GOALS})
+
 
-TOOLS_MANIFEST = [
+@lru_cache(maxsize=256)
+def goals_ar_text(goals: tuple) -> str:
+    """الأهداف الوظيفية بالعربية مفصولة بفواصل (فارغة إن لم تُحدد) — مخزَّنة حسب tuple الأهداف"""
+    return ", ".join(FUNCTIONAL_GOALS_AR.get(g, g) for g in goals)
+
+
+# html.escape مخزَّن للنصوص الحرة المعروضة في كل إعادة تشغيل (الملاحظات) — نفس كائنات str
+# تبقى في session_state فيكون بحثها في الذاكرة المؤقتة دون إعادة حساب
+escape_cached = lru_cache(maxsize=1024)(html.escape)
+
+
+@lru_cache(maxsize=256)
+def icd_text(codes: tuple) -> str:
+    """رموز ICD-10 مفصولة بفواصل — مخزَّنة حسب tuple الرموز"""
+    return ", ".join(codes)
+
+TOOLS_MANIFEST = (
     ("VE", "تمارين بصرية SVG", "visual_exercise"),
     ("DB", "قاعدة بيانات المرضى", "patient_database"),
     ("PM", "بحث PubMed", "pubmed"),
@@ -146,7 +261,9 @@ TOOLS_MANIFEST = [
     ("CL", "تقييمات سريرية", "clinical_assessment"),
     ("IN", "تدخلات علاجية", "clinical_intervention"),
     ("TP", "خطة علاجية", "treatment_plan"),
-]
+)
+# نسخة مُهرَّبة مسبقاً للعرض في HTML — القائمة ثابتة فيكفي تهريبها مرة واحدة
+TOOLS_MANIFEST_ESCAPED = tuple((html.escape(icon), html.escape(name)) for icon, name, _ in TOOLS_MANIFEST)
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -154,129 +271,516 @@ TOOLS_MANIFEST = [
 # ═══════════════════════════════════════════════════════════════
 
 COUNTER_FILE = os.path.join(PATIENTS_DIR, ".counter")
+# سجل المرضى (SQLite): ملخص + رقم الملف + نص البحث لكل مريض — ملفات JSON تبقى مصدر البيانات الكاملة
+REGISTRY_DB = os.path.join(PATIENTS_DIR, "registry.db")
+# اسم ملف المريض: MR-YYYY-NNNN.json — الرقم التسلسلي هو رقم الملف
+_PATIENT_FILE_RE = re.compile(r"^[A-Za-z]+-\d{4}-(\d+)\.json$")
+# محارف غير مسموحة في اسم ملف المريض
+_UNSAFE_ID_RE = re.compile(r'[^A-Za-z0-9_\-]')
+
+
+# فك JSON من نص/بايتات (أسطر سجل المحادثة، ملخصات السجل) — orjson إن توفرت
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _read_json(path: str):
+    """قراءة ملف JSON — عبر orjson إن توفرت (أخطاؤها ترث json.JSONDecodeError)"""
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+@st.cache_resource(show_spinner=False)
+def _ensure_patients_dir() -> str:
+    """إنشاء مجلد المرضى مرة واحدة لكل عملية — بدل makedirs/exists في كل حفظ وتحميل"""
+    os.makedirs(PATIENTS_DIR, exist_ok=True)
+    return PATIENTS_DIR
 
 
 def _read_counter() -> int:
     """قراءة العداد التسلسلي من الملف"""
-    os.makedirs(PATIENTS_DIR, exist_ok=True)
-    if os.path.exists(COUNTER_FILE):
-        try:
-            with open(COUNTER_FILE, "r") as f:
-                return int(f.read().strip())
-        except (ValueError, OSError):
-            pass
-    # إذا لم يوجد عداد، نبحث عن أعلى رقم موجود
-    max_num = 0
-    if os.path.exists(PATIENTS_DIR):
-        for fname in os.listdir(PATIENTS_DIR):
-            if fname.endswith(".json"):
-                try:
-                    with open(os.path.join(PATIENTS_DIR, fname), "r", encoding="utf-8") as f:
-                        p = json.load(f)
-                        fnum = p.get("file_number", 0)
-                        if isinstance(fnum, int) and fnum > max_num:
-                            max_num = fnum
-                except (json.JSONDecodeError, KeyError, OSError):
-                    pass
-    return max_num
+    try:
+        with open(COUNTER_FILE, "r") as f:
+            return int(f.read().strip())
+    except (ValueError, OSError):
+        pass
+    # إذا لم يوجد عداد، نستخرج أعلى رقم من أسماء الملفات دون فتحها
+    with os.scandir(PATIENTS_DIR) as entries:
+        return max((int(m.group(1)) for e in entries
+                    if (m := _PATIENT_FILE_RE.match(e.name)) and e.is_file()), default=0)
 
 
 def _write_counter(val: int):
-    """كتابة العداد التسلسلي"""
-    os.makedirs(PATIENTS_DIR, exist_ok=True)
-    with open(COUNTER_FILE, "w") as f:
+    """كتابة العداد التسلسلي ذرياً (ملف مؤقت + fsync ثم os.replace)"""
+    tmp = COUNTER_FILE + ".tmp"
+    with open(tmp, "w") as f:
         f.write(str(val))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, COUNTER_FILE)
 
 
-def generate_patient_id() -> tuple:
+@contextmanager
+def _file_lock(lock_path: str):
+    """قفل حصري بين الجلسات والعمليات عبر fcntl.flock (بدون قفل على Windows)"""
+    if fcntl is None:
+        yield
+        return
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+@dataclass(slots=True)
+class NewPatientId:
+    """معرف مريض جديد ورقم ملفه التسلسلي"""
+    id: str
+    file_number: int
+
+
+def generate_patient_id() -> NewPatientId:
     """
     توليد معرف فريد + رقم ملف تسلسلي
 
+    القراءة والزيادة والكتابة تتم تحت قفل واحد — جلستان متزامنتان لا تحصلان على نفس الرقم.
+
     Returns:
-        (patient_id: str, file_number: int)
-        مثال: ("VR-2026-0001", 1)
+        NewPatientId — مثال: NewPatientId(id="MR-2026-0001", file_number=1)
     """
-    counter = _read_counter() + 1
-    _write_counter(counter)
-    year = datetime.now().strftime("%Y")
-    pid = f"MR-{year}-{counter:04d}"
-    return pid, counter
+    _ensure_patients_dir()
+    with _file_lock(COUNTER_FILE + ".lock"):
+        counter = _read_counter() + 1
+        _write_counter(counter)
+    return NewPatientId(id=f"MR-{datetime.now().year}-{counter:04d}", file_number=counter)
 
 
 def _sanitize_filename(patient_id: str) -> str:
-    return re.sub(r'[^A-Za-z0-9_\-]', '', patient_id)
+    return _UNSAFE_ID_RE.sub('', patient_id)
+
+
+_REGISTRY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    id          TEXT PRIMARY KEY,
+    file_name   TEXT NOT NULL,
+    file_number INTEGER,
+    search_text TEXT NOT NULL,
+    summary     TEXT NOT NULL,
+    updated_at  TEXT,
+    mtime_ns    INTEGER NOT NULL,
+    size        INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS patients_file_number ON patients(file_number);
+CREATE INDEX IF NOT EXISTS patients_file_name ON patients(file_name);
+"""
+
+_UPSERT_SQL = """
+INSERT INTO patients (id, file_name, file_number, search_text, summary, updated_at, mtime_ns, size)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(id) DO UPDATE SET
+    file_name = excluded.file_name, file_number = excluded.file_number,
+    search_text = excluded.search_text, summary = excluded.summary,
+    updated_at = excluded.updated_at, mtime_ns = excluded.mtime_ns, size = excluded.size
+"""
+
+
+@st.cache_resource(show_spinner=False)
+def _init_registry() -> str:
+    """إنشاء قاعدة السجل مرة واحدة لكل عملية (WAL: القرّاء لا ينتظرون الكاتب)"""
+    _ensure_patients_dir()
+    conn = sqlite3.connect(REGISTRY_DB)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_REGISTRY_SCHEMA)
+    finally:
+        conn.close()
+    return REGISTRY_DB
+
+
+@contextmanager
+def _registry():
+    """اتصال قصير بالسجل — اتصال لكل عملية لأن جلسات Streamlit تعمل في خيوط مختلفة"""
+    conn = sqlite3.connect(_init_registry(), isolation_level=None, timeout=10)
+    try:
+        conn.execute("PRAGMA synchronous=NORMAL")
+        yield conn
+    finally:
+        conn.close()
+
+
+def _search_text(summary: dict) -> str:
+    """نص البحث المُصغَّر: المعرف/الاسم/التشخيص/ICD-10"""
+    fields = [summary.get("id") or "", summary.get("name") or "",
+              summary.get("name_en") or "", summary.get("diagnosis_text") or ""]
+    fields.extend(summary.get("diagnosis_icd10") or [])
+    return "\n".join(fields).lower()
+
+
+def _upsert_summary(conn: sqlite3.Connection, safe_id: str, summary: dict, mtime_ns: int, size: int):
+    """كتابة صف المريض في السجل مع بصمة (mtime, الحجم) للملف الكامل الذي اشتُق منه"""
+    fnum = summary.get("file_number")
+    conn.execute(_UPSERT_SQL, (
+        summary["id"], safe_id, fnum if isinstance(fnum, int) else None, _search_text(summary),
+        _dump_patient(summary).decode("utf-8"), summary.get("updated_at"), mtime_ns, size,
+    ))
+
+
+def _dump_patient(patient: dict) -> bytes:
+    """تسلسل ملف المريض إلى UTF-8 مضغوط بدون مسافات بادئة — عبر orjson إن توفرت"""
+    if orjson is not None:
+        return orjson.dumps(patient, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(patient, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _chat_log_path(safe_id: str) -> str:
+    return os.path.join(PATIENTS_DIR, f"{safe_id}.chat.jsonl")
+
+
+def _read_chat_log(safe_id: str) -> list | None:
+    """قراءة سجل المحادثة (None إن لم يوجد) — يتوقف عند سطر أخير مبتور"""
+    try:
+        with open(_chat_log_path(safe_id), "rb") as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    history = []
+    for line in lines:
+        try:
+            history.append(_json_loads(line))
+        except json.JSONDecodeError:
+            break
+    return history
+
+
+def _write_chat_log(safe_id: str, history: list):
+    """إعادة كتابة سجل المحادثة كاملاً (ذرياً) — عند مسح المحادثة أو ترحيل ملف قديم"""
+    path = _chat_log_path(safe_id)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(_dump_patient(msg) + b"\n" for msg in history))
+    os.replace(tmp, path)
+
+
+def append_chat_turns(patient: dict, messages: tuple):
+    """إلحاق رسائل جديدة بسجل المحادثة (JSONL) — O(1) لكل رسالة بدل إعادة تسلسل ملف المريض"""
+    _ensure_patients_dir()
+    safe_id = _sanitize_filename(patient["id"])
+    history = patient.get("chat_history", [])
+    logged = st.session_state.setdefault("_chat_logged", {})
+    if logged.get(safe_id) != len(history) - len(messages):
+        # السجل على القرص لا يطابق ما قبل هذه الرسائل — يُعاد كتابته كاملاً
+        _write_chat_log(safe_id, history)
+    else:
+        with open(_chat_log_path(safe_id), "ab") as f:
+            f.write(b"".join(_dump_patient(msg) + b"\n" for msg in messages))
+    logged[safe_id] = len(history)
+
+
+def _write_patient_record(safe_id: str, path: str, body: bytes, summary: dict):
+    """كتابة ذرية لملف المريض ثم تحديث صفه في السجل"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(body)
+    os.replace(tmp, path)
+    info = os.stat(path)
+    with _registry() as conn:
+        _upsert_summary(conn, safe_id, summary, info.st_mtime_ns, info.st_size)
+
+
+class _PatientWriter:
+    """طابور كتابة ملفات المرضى في خيط خلفي — آخر نسخة فقط لكل مريض، وإعادة التشغيل لا تنتظر القرص"""
+
+    def __init__(self):
+        self._pending = {}
+        self._busy = False
+        self._cond = threading.Condition()
+        self._start()
+        # الخيط daemon — ما بقي في الطابور يُكتب قبل خروج العملية
+        atexit.register(self.flush)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name="patient-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, safe_id: str, path: str, body: bytes, summary: dict) -> Future:
+        """إضافة نسخة للكتابة — الـ Future يحمل نتيجة كتابتها (أو خطأها) للجلسة التي أرسلتها"""
+        future = Future()
+        with self._cond:
+            # حفظان متتاليان لنفس المريض قبل الكتابة يندمجان في الأحدث — ونتيجته تُبلَّغ للاثنين
+            _, futures = self._pending.pop(safe_id, (None, []))
+            futures.append(future)
+            self._pending[safe_id] = ((safe_id, path, body, summary), futures)
+            if not self._thread.is_alive():
+                self._start()
+            self._cond.notify_all()
+        return future
+
+    def flush(self):
+        """انتظار انتهاء كل الكتابات المعلّقة — قبل أي قراءة لملفات المرضى من القرص"""
+        with self._cond:
+            while self._pending or self._busy:
+                if not self._thread.is_alive():
+                    # لا انتظار لخيط متوقف — يُعاد تشغيله ليُفرغ الطابور
+                    self._busy = False
+                    self._start()
+                self._cond.wait(timeout=1.0)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                job, futures = self._pending.pop(next(iter(self._pending)))
+                self._busy = True
+            try:
+                _write_patient_record(*job)
+            except Exception as e:
+                # أي خطأ يُسلَّم لمن أرسل الحفظ — والخيط يبقى حياً للكتابات التالية
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(None)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+
+@st.cache_resource(show_spinner=False)
+def _patient_writer() -> _PatientWriter:
+    """كاتب واحد لكل عملية — مشترك بين الجلسات"""
+    return _PatientWriter()
+
+
+def _check_saves():
+    """رفع خطأ كتابة خلفية فشلت لحفظ أرسلته هذه الجلسة — وتُنسى بصمة المريض فيُعاد حفظه"""
+    futures = st.session_state.get("_save_futures")
+    if not futures:
+        return
+    hashes = st.session_state.get("_patient_hash", {})
+    error = None
+    for safe_id, future in list(futures.items()):
+        if future.done():
+            del futures[safe_id]
+            if future.exception() is not None:
+                hashes.pop(safe_id, None)
+                error = error or future.exception()
+    if error is not None:
+        raise error
 
 
 def save_patient(patient: dict):
-    """حفظ ملف المريض كـ JSON"""
-    os.makedirs(PATIENTS_DIR, exist_ok=True)
+    """حفظ ملف المريض كـ JSON — يُتخطى الحفظ إن لم يتغير المحتوى، والكتابة ذرية في خيط الكاتب"""
+    _check_saves()
+    _ensure_patients_dir()
     safe_id = _sanitize_filename(patient["id"])
     path = os.path.join(PATIENTS_DIR, f"{safe_id}.json")
-    patient["updated_at"] = datetime.now().isoformat()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(patient, f, ensure_ascii=False, indent=2)
+    # المحادثة تُحفظ في سجلها الخاص (append_chat_turns) — هنا فقط عند اختلاف طولها (مسح/ترحيل)
+    history = patient.get("chat_history", [])
+    logged = st.session_state.setdefault("_chat_logged", {})
+    if logged.get(safe_id) != len(history):
+        _write_chat_log(safe_id, history)
+        logged[safe_id] = len(history)
+    record = {k: v for k, v in patient.items() if k != "chat_history"}
+    # بصمة المحتوى بدون updated_at — حفظ بلا تغيير لا يعيد الكتابة ولا يغيّر mtime
+    body = _dump_patient({k: v for k, v in record.items() if k != "updated_at"})
+    digest = hashlib.blake2b(body, digest_size=16).digest()
+    hashes = st.session_state.setdefault("_patient_hash", {})
+    if hashes.get(safe_id) == digest and os.path.exists(path):
+        return
+    patient["updated_at"] = record["updated_at"] = datetime.now().isoformat()
+    # التسلسل يتم هنا (لقطة ثابتة للملف)؛ الكتابة على القرص وتحديث السجل في خيط الكاتب
+    hashes[safe_id] = digest
+    st.session_state.setdefault("_save_futures", {})[safe_id] = _patient_writer().submit(
+        safe_id, path, _dump_patient(record), get_patient_summary(patient))
+
+
+def mark_dirty(patient: dict):
+    """تسجيل تعديل على ملف المريض — يُحفظ مرة واحدة في نهاية إعادة التشغيل بدل الحفظ عند كل نقرة"""
+    st.session_state.setdefault("_dirty_patients", {})[patient["id"]] = patient
+
+
+def flush_dirty_patients():
+    """حفظ الملفات المعدّلة في هذه الدورة — حفظ واحد لكل مريض مهما تعددت التعديلات"""
+    dirty = st.session_state.get("_dirty_patients")
+    for pid in list(dirty or ()):
+        save_patient(dirty[pid])
+        del dirty[pid]
+    # كتابات هذه الجلسة التي انتهت بفشل تظهر لها هنا لا لجلسة أخرى
+    _check_saves()
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _load_patient_cached(safe_id: str, stamp: tuple) -> dict:
+    """قراءة ملف مريض واحد — مخزَّنة حسب (mtime, الحجم) للملف"""
+    return _read_json(os.path.join(PATIENTS_DIR, f"{safe_id}.json"))
+
+
+# الحقول الرقمية وأنواعها — تُوحَّد عند التحميل فتُمرَّر القيم للحقول كما هي دون float()/int() في كل إعادة تشغيل
+_NUMERIC_FIELDS = MappingProxyType({
+    "age": int, "va_logmar": float, "visual_field_degrees": float, "phq9_score": int,
+})
 
 
-def load_all_patients() -> dict:
-    """تحميل جميع ملفات المرضى"""
-    patients = {}
-    if os.path.exists(PATIENTS_DIR):
-        for fname in sorted(os.listdir(PATIENTS_DIR)):
-            if fname.endswith(".json"):
+def _coerce_numeric(patient: dict):
+    """توحيد أنواع الحقول الرقمية (ملفات قديمة/معدّلة يدوياً) — القيم غير القابلة للتحويل تُترك"""
+    for field, kind in _NUMERIC_FIELDS.items():
+        value = patient.get(field)
+        if value is not None and type(value) is not kind:
+            try:
+                patient[field] = kind(value)
+            except (TypeError, ValueError):
+                pass
+
+
+def load_patient(patient_id: str) -> dict:
+    """تحميل ملف مريض واحد مع سجل محادثته (None إن لم يوجد)"""
+    safe_id = _sanitize_filename(patient_id)
+    _patient_writer().flush()
+    try:
+        info = os.stat(os.path.join(PATIENTS_DIR, f"{safe_id}.json"))
+        patient = _load_patient_cached(safe_id, (info.st_mtime_ns, info.st_size))
+    except (OSError, json.JSONDecodeError):
+        return None
+    _coerce_numeric(patient)
+    # الملفات القديمة تحمل المحادثة داخلها — تُنقل إلى السجل عند أول حفظ
+    history = _read_chat_log(safe_id)
+    if history is not None:
+        patient["chat_history"] = history
+    st.session_state.setdefault("_chat_logged", {})[safe_id] = None if history is None else len(history)
+    return patient
+
+
+# حقول الملخص: قيم مفردة، قوائم نصية صغيرة، وسجلات يكفي عدّ عناصرها
+_SUMMARY_SCALARS = frozenset((
+    "id", "file_number", "name", "name_en", "age", "gender", "rehabilitation_type",
+    "diagnosis_text", "cognitive_status", "phq9_score", "created_at", "updated_at",
+    "va_logmar", "va_snellen", "visual_field_degrees", "vision_pattern", "affected_side", "nyha_class",
+))
+_SUMMARY_LISTS = frozenset(("diagnosis_icd10", "functional_goals"))
+_SUMMARY_COUNTS = frozenset((
+    "assessment_results", "intervention_sessions", "notes",
+    "cdss_evaluations", "documents", "treatment_plans",
+))
+_IJSON_VALUE_EVENTS = frozenset(("string", "number", "boolean", "null"))
+_IJSON_ITEM_EVENTS = _IJSON_VALUE_EVENTS | {"start_map", "start_array"}
+
+
+def _stream_patient_summary(path: str) -> dict:
+    """اشتقاق الملخص بتحليل تدفقي (ijson) — السجلات الضخمة تُعدّ ولا تُبنى ككائنات Python"""
+    light = {}
+    counts = dict.fromkeys(_SUMMARY_COUNTS, 0)
+    last_pain = None
+    with open(path, "rb") as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if prefix in _SUMMARY_SCALARS and event in _IJSON_VALUE_EVENTS:
+                light[prefix] = value
+                continue
+            key, _, rest = prefix.partition(".")
+            if rest == "item":
+                if key in _SUMMARY_LISTS and event == "string":
+                    light.setdefault(key, []).append(value)
+                elif key in _SUMMARY_COUNTS and event in _IJSON_ITEM_EVENTS:
+                    counts[key] += 1
+            elif key == "pain_scores" and rest == "item.value" and event in _IJSON_VALUE_EVENTS:
+                last_pain = value
+    # get_patient_summary يحتاج أطوال القوائم فقط — قوائم نائبة بنفس الطول
+    for key, n in counts.items():
+        light[key] = [None] * n
+    if last_pain is not None:
+        light["pain_scores"] = [{"value": last_pain}]
+    return get_patient_summary(light)
+
+
+def _patient_stamps() -> tuple:
+    """(اسم الملف، mtime، الحجم) لكل ملف مريض — مسح واحد بـ scandir دون فتح أي ملف"""
+    stamps = []
+    with os.scandir(PATIENTS_DIR) as entries:
+        for e in entries:
+            if e.name.endswith(".json") and not e.name.startswith(".") and e.is_file():
+                info = e.stat()
+                stamps.append((e.name, info.st_mtime_ns, info.st_size))
+    return tuple(sorted(stamps))
+
+
+def _sync_registry(stamps: tuple):
+    """مزامنة السجل مع ملفات المرضى — يُعاد اشتقاق الصفوف الجديدة/القديمة فقط وتُحذف صفوف الملفات المحذوفة"""
+    with _registry() as conn:
+        known = {name: (mtime_ns, size) for name, mtime_ns, size
+                 in conn.execute("SELECT file_name, mtime_ns, size FROM patients")}
+        on_disk = set()
+        conn.execute("BEGIN")
+        try:
+            for fname, mtime_ns, size in stamps:
+                safe_id = fname[:-5]
+                on_disk.add(safe_id)
+                if known.get(safe_id) == (mtime_ns, size):
+                    continue
+                # ملف جديد أو كُتب من خارج save_patient — يُحسب الملخص من الملف الكامل
                 path = os.path.join(PATIENTS_DIR, fname)
                 try:
-                    with open(path, "r", encoding="utf-8") as f:
-                        p = json.load(f)
-                        patients[p["id"]] = p
-                except (json.JSONDecodeError, KeyError):
-                    pass
-    return patients
+                    if ijson is not None:
+                        summary = _stream_patient_summary(path)
+                    else:
+                        summary = get_patient_summary(_read_json(path))
+                except (json.JSONDecodeError, OSError, ValueError):
+                    continue
+                if summary.get("id"):
+                    _upsert_summary(conn, safe_id, summary, mtime_ns, size)
+            conn.executemany("DELETE FROM patients WHERE file_name = ?",
+                             [(name,) for name in known.keys() - on_disk])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _load_all_summaries_cached(stamps: tuple) -> dict:
+    """ملخصات جميع المرضى من السجل، الأحدث تعديلاً أولاً — مخزَّنة حسب بصمات الملفات"""
+    _sync_registry(stamps)
+    # الترتيب يتم في SQLite مرة واحدة لكل تغيير — لا فرز في كل إعادة تشغيل
+    with _registry() as conn:
+        return {pid: _json_loads(summary) for pid, summary in conn.execute(
+            "SELECT id, summary FROM patients ORDER BY COALESCE(updated_at, '') DESC, file_name")}
+
+
+def load_all_summaries() -> dict:
+    """ملخصات جميع المرضى لسجل المرضى — بدون المحادثات والسجلات الكاملة"""
+    _patient_writer().flush()
+    try:
+        stamps = _patient_stamps()
+    except FileNotFoundError:
+        return {}
+    return _load_all_summaries_cached(stamps)
 
 
 def load_patient_by_file_number(file_number: int) -> dict:
-    """تحميل مريض بناءً على رقم الملف"""
-    if os.path.exists(PATIENTS_DIR):
-        for fname in os.listdir(PATIENTS_DIR):
-            if fname.endswith(".json"):
-                path = os.path.join(PATIENTS_DIR, fname)
-                try:
-                    with open(path, "r", encoding="utf-8") as f:
-                        p = json.load(f)
-                        if p.get("file_number") == file_number:
-                            return p
-                except (json.JSONDecodeError, KeyError, OSError):
-                    pass
-    return None
+    """تحميل مريض بناءً على رقم الملف — استعلام مفهرس في السجل"""
+    load_all_summaries()
+    with _registry() as conn:
+        row = conn.execute("SELECT id FROM patients WHERE file_number = ?", (file_number,)).fetchone()
+    if row is None:
+        return None
+    p = load_patient(row[0])
+    return p if p is not None and p.get("file_number") == file_number else None
 
 
 def search_patients(query: str) -> list:
-    """بحث في سجلات المرضى بالاسم أو التشخيص أو رقم الملف"""
-    results = []
+    """بحث في سجلات المرضى بالاسم أو التشخيص أو رقم الملف — يُرجع ملخصات دون فتح ملفات المرضى"""
     query_lower = query.lower().strip()
-    patients = load_all_patients()
-    for pid, p in patients.items():
-        # بحث برقم الملف
-        if query_lower.isdigit() and p.get("file_number") == int(query_lower):
-            results.append(p)
-            continue
-        # بحث بمعرف المريض
-        if query_lower in pid.lower():
-            results.append(p)
-            continue
-        # بحث بالاسم
-        if query_lower in p.get("name", "").lower() or query_lower in p.get("name_en", "").lower():
-            results.append(p)
-            continue
-        # بحث بالتشخيص
-        if query_lower in p.get("diagnosis_text", "").lower():
-            results.append(p)
-            continue
-        # بحث بـ ICD-10
-        for icd in p.get("diagnosis_icd10", []):
-            if query_lower in icd.lower():
-                results.append(p)
-                break
-    return results
+    fnum = int(query_lower) if query_lower.isdigit() else None
+    load_all_summaries()
+    # نص البحث مُصغَّر مسبقاً عند الحفظ — فحص instr واحد لكل صف ويحافظ على مطابقة جزء من النص
+    with _registry() as conn:
+        return [_json_loads(row[0]) for row in conn.execute(
+            "SELECT summary FROM patients WHERE instr(search_text, ?) > 0 OR file_number = ? ORDER BY file_name",
+            (query_lower, fnum))]
 
 
 def get_patient_summary(patient: dict) -> dict:
@@ -323,9 +827,15 @@ def get_patient_summary(patient: dict) -> dict:
 def delete_patient(patient_id: str):
     """حذف ملف مريض"""
     safe_id = _sanitize_filename(patient_id)
-    path = os.path.join(PATIENTS_DIR, f"{safe_id}.json")
-    if os.path.exists(path):
-        os.remove(path)
+    # كتابة معلّقة لنفس المريض قد تعيد إنشاء الملف بعد حذفه
+    _patient_writer().flush()
+    for path in (os.path.join(PATIENTS_DIR, f"{safe_id}.json"), _chat_log_path(safe_id)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    with _registry() as conn:
+        conn.execute("DELETE FROM patients WHERE file_name = ?", (safe_id,))
 
 
 def new_patient_template(pid: str, file_number: int) -> dict:
@@ -360,6 +870,7 @@ def init_session():
     defaults = {
         "current_page": "registry",
         "current_patient_id": None,
+        # ملف المريض الحالي فقط — يُحمَّل عند الطلب عبر get_patient
         "patients": {},
         "thinking_budget": 8000,
         "use_thinking": True,
@@ -369,637 +880,114 @@ def init_session():
     for k, v in defaults.items():
         if k not in st.session_state:
             st.session_state[k] = v
-    # Load patients from disk on first run
-    if not st.session_state.patients:
-        st.session_state.patients = load_all_patients()
-
-
-init_session()
 
 
-# ═══════════════════════════════════════════════════════════════
-# Custom CSS
-# ═══════════════════════════════════════════════════════════════
-
-CUSTOM_CSS = """
-<style>
-@import url('https://fonts.googleapis.com/css2?family=Cairo:wght@300;400;500;600;700;800;900&family=Tajawal:wght@300;400;500;700;800&display=swap');
-:root {
-    --primary: #1E3A5F; --primary-light: #2E5B8C;
-    --secondary: #2E8BC0; --secondary-light: #4FA8D8;
-    --accent: #0B8457; --accent-light: #10A567;
-    --bg: #EEF2F7; --card: #FFFFFF;
-    --text: #1A2744; --text-sub: #4A5568; --text-muted: #718096;
-    --border: #E2E8F0; --border-focus: #2E8BC0;
-    --shadow-sm: 0 1px 3px rgba(0,0,0,0.08), 0 1px 2px rgba(0,0,0,0.04);
-    --shadow: 0 4px 6px -1px rgba(0,0,0,0.07), 0 2px 4px -1px rgba(0,0,0,0.04);
-    --shadow-md: 0 10px 25px -5px rgba(0,0,0,0.08), 0 4px 10px -5px rgba(0,0,0,0.04);
-    --shadow-lg: 0 20px 40px -10px rgba(0,0,0,0.1);
-    --radius-sm: 8px; --radius: 12px; --radius-lg: 20px; --radius-xl: 28px;
-}
-*, *::before, *::after { box-sizing: border-box; }
-html, body, .stApp, [class*="css"] {
-    font-family: 'Cairo', 'Tajawal', -apple-system, sans-serif !important; direction: rtl;
-}
-.stApp {
-    background: var(--bg) !important;
-    position: relative;
-    overflow-x: hidden;
-}
+def get_patient(pid: str) -> dict:
+    """ملف المريض الحالي — يُقرأ من القرص فقط عند تغيّر المريض، ولا تحتفظ الجلسة إلا بملف واحد"""
+    patients = st.session_state.patients
+    patient = patients.get(pid)
+    if patient is None:
+        # تحرير الملف السابق وحالة محادثته قبل تحميل الجديد
+        for old_pid in patients:
+            st.session_state.pop(f"chat_view_{old_pid}", None)
+            st.session_state.pop(f"_api_history_{old_pid}", None)
+        patients.clear()
+        patient = load_patient(pid)
+        if patient is not None:
+            patients[pid] = patient
+    return patient
 
-/* ── Animated Background ── */
-.stApp::before {
-    content: '';
-    position: fixed;
-    top: -50%; left: -50%;
-    width: 200%; height: 200%;
-    background:
-        radial-gradient(ellipse at 20% 50%, rgba(46,139,192,0.06) 0%, transparent 50%),
-        radial-gradient(ellipse at 80% 20%, rgba(11,132,87,0.05) 0%, transparent 50%),
-        radial-gradient(ellipse at 50% 80%, rgba(30,58,95,0.04) 0%, transparent 50%);
-    animation: bgDrift 20s ease-in-out infinite alternate;
-    z-index: 0;
-    pointer-events: none;
-}
-@keyframes bgDrift {
-    0%   { transform: translate(0, 0) rotate(0deg); }
-    33%  { transform: translate(2%, -1%) rotate(1deg); }
-    66%  { transform: translate(-1%, 2%) rotate(-0.5deg); }
-    100% { transform: translate(1%, -2%) rotate(0.5deg); }
-}
 
-/* ── Floating Particles ── */
-.stApp::after {
-    content: '';
-    position: fixed;
-    width: 100%; height: 100%;
-    top: 0; left: 0;
-    background-image:
-        radial-gradient(2px 2px at 10% 20%, rgba(46,139,192,0.15) 50%, transparent 50%),
-        radial-gradient(2px 2px at 30% 70%, rgba(11,132,87,0.12) 50%, transparent 50%),
-        radial-gradient(3px 3px at 60% 30%, rgba(30,58,95,0.1) 50%, transparent 50%),
-        radial-gradient(2px 2px at 80% 60%, rgba(46,139,192,0.12) 50%, transparent 50%),
-        radial-gradient(2px 2px at 50% 90%, rgba(11,132,87,0.1) 50%, transparent 50%),
-        radial-gradient(3px 3px at 90% 10%, rgba(30,58,95,0.08) 50%, transparent 50%);
-    animation: particleFloat 30s linear infinite;
-    z-index: 0;
-    pointer-events: none;
-}
-@keyframes particleFloat {
-    0%   { transform: translateY(0); }
-    100% { transform: translateY(-100vh); }
-}
+def get_api_key() -> str:
+    """مفتاح Anthropic API — يُقرأ من متغيرات البيئة مرة واحدة لكل جلسة"""
+    return st.session_state.setdefault("_api_key", os.environ.get("ANTHROPIC_API_KEY", ""))
 
-#MainMenu, footer, header, .stDeployButton,
-[data-testid="stToolbar"], [data-testid="stDecoration"], [data-testid="stStatusWidget"] { display: none !important; }
 
-/* SIDEBAR */
-[data-testid="stSidebar"] {
-    background: linear-gradient(170deg, #142540 0%, #1E3A5F 60%, #1A3252 100%) !important;
-    border-left: 1px solid rgba(255,255,255,0.06) !important; min-width: 280px !important;
-}
-[data-testid="stSidebar"] > div:first-child { padding: 0 !important; }
-[data-testid="stSidebar"] .block-container { padding: 0 !important; }
-.sb-header {
-    background: linear-gradient(135deg, rgba(46,139,192,0.25) 0%, rgba(11,132,87,0.15) 100%);
-    border-bottom: 1px solid rgba(255,255,255,0.08); padding: 28px 20px 22px; text-align: center;
-}
-.sb-logo-wrap { display: flex; justify-content: center; margin-bottom: 10px;
-    filter: drop-shadow(0 4px 20px rgba(46,139,192,0.55)); }
-.ai-loading { display: flex; gap: 6px; justify-content: center; align-items: center; padding: 20px 0; }
-.ai-loading-dot { width: 10px; height: 10px; border-radius: 50%; background: var(--secondary); opacity: 0.3; }
-.ai-loading-dot:nth-child(1) { animation: aiDot 1.2s ease-in-out 0s infinite; }
-.ai-loading-dot:nth-child(2) { animation: aiDot 1.2s ease-in-out 0.2s infinite; }
-.ai-loading-dot:nth-child(3) { animation: aiDot 1.2s ease-in-out 0.4s infinite; }
-@keyframes aiDot { 0%,80%,100% { transform: scale(1); opacity:0.3; } 40% { transform: scale(1.6); opacity:1; } }
-.visual-exercise-card {
-    background: linear-gradient(135deg, rgba(30,58,95,0.9) 0%, rgba(11,50,40,0.9) 100%);
-    border: 2px solid rgba(46,139,192,0.5); border-radius: var(--radius-lg);
-    padding: 18px; margin: 14px 0 6px; box-shadow: var(--shadow-md);
-}
-.ve-header { font-weight: 800; font-size: 15px; color: #60C4F0; margin-bottom: 8px; }
-.ve-instructions { font-size: 13px; color: rgba(255,255,255,0.75); margin-bottom: 14px; line-height: 1.6; }
-.ve-svg { text-align: center; }
-.ve-svg svg { max-width: 100%; height: auto; border-radius: 10px; box-shadow: 0 4px 20px rgba(0,0,0,0.4); }
-.ve-footer { font-size: 11px; color: rgba(255,255,255,0.4); margin-top: 10px; display: flex; gap: 12px; }
-.sb-title { color: #FFF; font-size: 15px; font-weight: 800; margin: 0 0 4px; }
-.sb-subtitle { color: rgba(255,255,255,0.45); font-size: 10px; font-weight: 500;
-    letter-spacing: 0.5px; text-transform: uppercase; margin: 0; }
-.sb-model-badge {
-    display: inline-flex; align-items: center; gap: 5px; margin-top: 10px; padding: 4px 10px;
-    background: rgba(46,139,192,0.25); border: 1px solid rgba(46,139,192,0.4);
-    border-radius: 20px; font-size: 10px; color: #60C4F0; font-weight: 600;
-}
-.sb-body { padding: 16px 14px; }
-.sb-section-label { color: rgba(255,255,255,0.35); font-size: 9px; font-weight: 700;
-    letter-spacing: 2px; text-transform: uppercase; margin: 18px 0 8px 4px; }
-.sb-stats { display: grid; grid-template-columns: 1fr 1fr; gap: 8px; margin-bottom: 4px; }
-.sb-stat { background: rgba(255,255,255,0.06); border: 1px solid rgba(255,255,255,0.08);
-    border-radius: var(--radius-sm); padding: 12px 8px; text-align: center; transition: background 0.2s; }
-.sb-stat:hover { background: rgba(255,255,255,0.1); }
-.sb-stat-num { color: #60C4F0; font-size: 22px; font-weight: 900; line-height: 1; display: block; }
-.sb-stat-lbl { color: rgba(255,255,255,0.45); font-size: 9px; font-weight: 500; display: block; margin-top: 4px; }
-.tool-chip { display: flex; align-items: center; gap: 9px; padding: 8px 10px;
-    background: rgba(255,255,255,0.05); border: 1px solid rgba(255,255,255,0.07);
-    border-radius: var(--radius-sm); margin-bottom: 5px; transition: all 0.2s; cursor: default; }
-.tool-chip:hover { background: rgba(255,255,255,0.09); border-color: rgba(255,255,255,0.14); transform: translateX(-2px); }
-.tool-chip-icon { font-size: 13px; width: 18px; text-align: center; flex-shrink: 0; }
-.tool-chip-name { color: rgba(255,255,255,0.75); font-size: 11px; font-weight: 500; flex: 1; }
-.tool-chip-badge { font-size: 8px; padding: 2px 6px; border-radius: 10px; font-weight: 700;
-    background: rgba(16,185,129,0.18); color: #34D399; border: 1px solid rgba(16,185,129,0.25); }
-.sb-divider { height: 1px; background: rgba(255,255,255,0.07); margin: 14px 0; }
-[data-testid="stSidebar"] .stButton > button {
-    font-family: 'Cairo', sans-serif !important; background: rgba(220,38,38,0.12) !important;
-    color: rgba(252,165,165,0.9) !important; border: 1px solid rgba(220,38,38,0.25) !important;
-    border-radius: var(--radius-sm) !important; font-size: 12px !important; font-weight: 600 !important;
-    width: 100% !important; padding: 8px 16px !important; transition: all 0.2s !important;
-}
-[data-testid="stSidebar"] .stButton > button:hover {
-    background: rgba(220,38,38,0.22) !important; border-color: rgba(220,38,38,0.4) !important;
-}
+init_session()
 
-/* MAIN CONTENT */
-.main .block-container { max-width: 960px !important; padding: 0 24px 24px !important; margin: 0 auto !important; }
 
-/* PAGE HEADER */
-.page-header {
-    background: linear-gradient(135deg, #1E3A5F 0%, #2A6496 50%, #1A7A58 100%);
-    border-radius: 0 0 var(--radius-xl) var(--radius-xl);
-    padding: 26px 32px 22px; margin: 0 -24px 24px; display: flex;
-    align-items: center; justify-content: space-between; box-shadow: var(--shadow-md);
-}
-.ph-left { display: flex; align-items: center; gap: 16px; }
-.ph-icon { font-size: 38px; filter: drop-shadow(0 2px 8px rgba(0,0,0,0.3)); }
-.ph-title { color: white; font-size: 20px; font-weight: 800; margin: 0 0 3px; line-height: 1.2; }
-.ph-sub { color: rgba(255,255,255,0.65); font-size: 11px; font-weight: 500; margin: 0; }
-.ph-badges { display: flex; gap: 8px; flex-direction: column; align-items: flex-end; }
-.badge { display: inline-flex; align-items: center; gap: 5px; padding: 4px 10px;
-    border-radius: 16px; font-size: 10px; font-weight: 700; white-space: nowrap; }
-.badge-green { background: rgba(16,185,129,0.2); color: #6EE7B7; border: 1px solid rgba(16,185,129,0.3); }
-.badge-blue { background: rgba(96,165,250,0.2); color: #93C5FD; border: 1px solid rgba(96,165,250,0.3); }
-.badge-red { background: rgba(239,68,68,0.2); color: #FCA5A5; border: 1px solid rgba(239,68,68,0.3); }
-
-/* PATIENT HEADER */
-.patient-header {
-    background: linear-gradient(135deg, #1E3A5F, #2E5B8C);
-    border-radius: var(--radius); padding: 18px 24px; margin-bottom: 16px;
-    display: flex; align-items: center; justify-content: space-between;
-    box-shadow: var(--shadow); color: white;
-}
-.patient-header .ph-name { font-size: 18px; font-weight: 800; margin: 0; }
-.patient-header .ph-meta { font-size: 12px; color: rgba(255,255,255,0.7); margin-top: 4px; }
-.patient-header .ph-badges { display: flex; gap: 6px; }
-
-/* PATIENT CARD (Registry) */
-.patient-card {
-    background: var(--card); border: 2px solid var(--border); border-radius: var(--radius);
-    padding: 18px; transition: all 0.25s; box-shadow: var(--shadow-sm);
-}
-.patient-card:hover { border-color: var(--secondary); box-shadow: var(--shadow); transform: translateY(-2px); }
-.patient-card-name { font-size: 16px; font-weight: 700; color: var(--primary); margin: 0 0 6px; }
-.patient-card-dx { font-size: 12px; color: var(--text-sub); margin: 0 0 4px; }
-.patient-card-meta { font-size: 10px; color: var(--text-muted); }
-
-/* CHAT MESSAGES */
-.msg-user { display: flex; justify-content: flex-end; align-items: flex-end; gap: 10px; animation: msgIn 0.3s ease-out; }
-.msg-ai { display: flex; justify-content: flex-start; align-items: flex-end; gap: 10px; animation: msgIn 0.3s ease-out; }
-@keyframes msgIn { from { opacity: 0; transform: translateY(12px); } to { opacity: 1; transform: translateY(0); } }
-.avatar { width: 38px; height: 38px; border-radius: 50%; display: flex; align-items: center;
-    justify-content: center; font-size: 20px; flex-shrink: 0; box-shadow: var(--shadow); }
-.avatar-user { background: linear-gradient(135deg, #1E3A5F, #2E8BC0); order: 1; }
-.avatar-ai { background: linear-gradient(135deg, #0B5E3D, #0B8457); order: -1; }
-.bubble { max-width: 76%; padding: 14px 18px; font-size: 14px; line-height: 1.75;
-    color: var(--text); box-shadow: var(--shadow); position: relative; word-break: break-word; }
-.bubble-user { background: linear-gradient(145deg, #EBF5FB, #D6EAF8); border: 1px solid #AED6F1;
-    border-radius: var(--radius) var(--radius-sm) var(--radius) var(--radius); order: 0; }
-.bubble-ai { background: var(--card); border: 1px solid var(--border);
-    border-radius: var(--radius-sm) var(--radius) var(--radius) var(--radius); order: 0; }
-.bubble-footer { display: flex; align-items: center; justify-content: flex-end; gap: 6px;
-    margin-top: 8px; font-size: 10px; color: var(--text-muted); }
-.bubble-footer-ai { justify-content: flex-start; }
-.bubble h1,.bubble h2,.bubble h3 { color: var(--primary); }
-.bubble h1 { font-size: 17px; } .bubble h2 { font-size: 15px; } .bubble h3 { font-size: 13px; }
-.bubble p { margin: 0 0 8px; } .bubble p:last-child { margin-bottom: 0; }
-.bubble ul,.bubble ol { padding-right: 18px; margin: 6px 0; } .bubble li { margin-bottom: 4px; }
-.bubble table { width: 100%; border-collapse: collapse; font-size: 12px; margin: 10px 0;
-    border-radius: var(--radius-sm); overflow: hidden; }
-.bubble th { background: var(--primary); color: white; padding: 8px 12px; font-weight: 700; font-size: 11px; }
-.bubble td { padding: 7px 12px; border-bottom: 1px solid var(--border); }
-.bubble tr:nth-child(even) td { background: #F7FAFC; }
-.bubble code { background: #F1F5F9; border: 1px solid #E2E8F0; border-radius: 4px; padding: 1px 5px;
-    font-size: 12px; font-family: monospace; direction: ltr; display: inline-block; }
-.bubble pre { background: #1E293B; border-radius: var(--radius-sm); padding: 12px; overflow-x: auto; direction: ltr; }
-.bubble pre code { background: none; border: none; color: #E2E8F0; }
-.bubble blockquote { border-right: 4px solid var(--secondary); background: #EBF8FF;
-    margin: 8px 0; padding: 8px 14px; border-radius: 0 var(--radius-sm) var(--radius-sm) 0; color: var(--text-sub); }
-.bubble strong { color: var(--primary); } .bubble a { color: var(--secondary); }
-
-/* TOOL CALL */
-.tool-call-card { background: linear-gradient(135deg, #FFFBEB, #FEF3C7); border: 1px solid #F59E0B;
-    border-radius: var(--radius-sm); padding: 10px 14px; margin: 6px 0; font-size: 12px; }
-.tool-call-header { display: flex; align-items: center; gap: 6px; color: #92400E; font-weight: 700;
-    margin-bottom: 4px; font-size: 11px; text-transform: uppercase; }
-.tool-call-name { font-size: 12px; color: #78350F; font-weight: 600; font-family: monospace;
-    background: rgba(0,0,0,0.06); padding: 2px 6px; border-radius: 4px; }
-
-/* THINKING */
-.thinking-card { background: linear-gradient(135deg, #FAF5FF, #EDE9FE); border: 1px solid #A78BFA;
-    border-radius: var(--radius-sm); padding: 12px 16px; margin: 6px 0; display: flex; align-items: center; gap: 10px; }
-.thinking-text { color: #5B21B6; font-size: 12px; font-weight: 600; }
-.thinking-dots { display: inline-flex; gap: 5px; }
-.thinking-dots span { width: 7px; height: 7px; background: #7C3AED; border-radius: 50%; animation: thinkBounce 1.4s infinite ease-in-out; }
-.thinking-dots span:nth-child(2) { animation-delay: 0.16s; }
-.thinking-dots span:nth-child(3) { animation-delay: 0.32s; }
-@keyframes thinkBounce { 0%,80%,100% { transform: scale(0.5); opacity: 0.4; } 40% { transform: scale(1); opacity: 1; } }
-
-/* INPUT */
-.input-wrapper { position: sticky; bottom: 0; z-index: 100; padding: 12px 0 4px;
-    background: linear-gradient(to top, var(--bg) 75%, transparent 100%); }
-.input-card { background: var(--card); border: 2px solid var(--border); border-radius: var(--radius-xl);
-    padding: 12px 16px 10px; box-shadow: var(--shadow-md); transition: border-color 0.25s, box-shadow 0.25s; }
-.input-card:focus-within { border-color: var(--secondary); box-shadow: 0 0 0 4px rgba(46,139,192,0.1), var(--shadow-md); }
-[data-testid="stTextArea"] { margin: 0 !important; }
-[data-testid="stTextArea"] > div { border: none !important; box-shadow: none !important; background: transparent !important; }
-[data-testid="stTextArea"] textarea { font-family: 'Cairo', sans-serif !important; font-size: 14px !important;
-    direction: rtl !important; border: none !important; box-shadow: none !important;
-    background: transparent !important; resize: none !important; color: var(--text) !important;
-    padding: 4px 0 !important; min-height: 46px !important; }
-[data-testid="stTextArea"] textarea::placeholder { color: var(--text-muted) !important; }
-.send-col .stButton > button { font-family: 'Cairo', sans-serif !important;
-    background: linear-gradient(135deg, #1E3A5F, #2E5B8C) !important; color: white !important;
-    border: none !important; border-radius: var(--radius) !important; font-size: 13px !important;
-    font-weight: 700 !important; padding: 8px 20px !important; width: 100% !important;
-    box-shadow: 0 3px 10px rgba(30,58,95,0.35) !important; }
-.send-col .stButton > button:hover { background: linear-gradient(135deg, #2E5B8C, #3A79B8) !important; }
-.clear-col .stButton > button { font-family: 'Cairo', sans-serif !important;
-    background: transparent !important; color: var(--text-muted) !important;
-    border: 1px solid var(--border) !important; border-radius: var(--radius) !important;
-    font-size: 12px !important; font-weight: 600 !important; padding: 8px 14px !important; width: 100% !important; }
-.clear-col .stButton > button:hover { background: #FEF2F2 !important; border-color: #FECACA !important; color: #DC2626 !important; }
-
-/* NOTE CARD */
-.note-card { background: white; border: 1px solid var(--border); border-radius: var(--radius-sm);
-    padding: 14px; margin-bottom: 10px; box-shadow: var(--shadow-sm); }
-.note-card-header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 6px; }
-.note-card-type { font-size: 10px; font-weight: 700; color: var(--secondary); text-transform: uppercase; }
-.note-card-time { font-size: 10px; color: var(--text-muted); }
-.note-card-body { font-size: 13px; color: var(--text); line-height: 1.6; }
-
-/* WELCOME */
-.welcome-container { text-align: center; padding: 40px 20px 20px; }
-.welcome-emoji { font-size: 80px; display: block; margin-bottom: 20px; animation: welcomeFloat 3.5s ease-in-out infinite; }
-@keyframes welcomeFloat { 0%,100% { transform: translateY(0) scale(1); } 50% { transform: translateY(-12px) scale(1.03); } }
-.welcome-title { color: var(--primary); font-size: 28px; font-weight: 900; margin: 0 0 8px; }
-.welcome-subtitle { color: var(--text-sub); font-size: 15px; margin: 0 0 32px;
-    max-width: 520px; margin-left: auto; margin-right: auto; line-height: 1.7; }
-.feature-row { display: flex; justify-content: center; gap: 10px; flex-wrap: wrap; margin-bottom: 36px; }
-.feature-chip { display: flex; align-items: center; gap: 6px; padding: 6px 14px; background: white;
-    border: 1px solid var(--border); border-radius: 20px; font-size: 12px; color: var(--text-sub);
-    font-weight: 500; box-shadow: var(--shadow-sm); }
-.examples-grid { display: grid; grid-template-columns: repeat(auto-fit, minmax(210px, 1fr));
-    gap: 12px; max-width: 760px; margin: 0 auto; }
-
-/* ALERTS */
-.alert { padding: 12px 16px; border-radius: var(--radius-sm); font-size: 13px;
-    display: flex; align-items: flex-start; gap: 10px; margin: 8px 0; }
-.alert-info { background: #EBF8FF; border: 1px solid #BEE3F8; color: #2C5282; }
-.alert-warning { background: #FFFBEB; border: 1px solid #FCD34D; color: #78350F; }
-.alert-success { background: #F0FFF4; border: 1px solid #9AE6B4; color: #22543D; }
-.alert-danger { background: #FFF5F5; border: 1px solid #FEB2B2; color: #742A2A; }
-
-/* ── Glassmorphism Cards ── */
-.glass-card {
-    background: rgba(255,255,255,0.75);
-    backdrop-filter: blur(12px); -webkit-backdrop-filter: blur(12px);
-    border: 1px solid rgba(255,255,255,0.4);
-    border-radius: var(--radius);
-    box-shadow: var(--shadow), 0 0 40px rgba(46,139,192,0.04);
-    transition: all 0.35s cubic-bezier(0.4, 0, 0.2, 1);
-}
-.glass-card:hover {
-    box-shadow: var(--shadow-lg), 0 0 60px rgba(46,139,192,0.08);
-    transform: translateY(-3px);
-    border-color: rgba(46,139,192,0.2);
-}
+# ═══════════════════════════════════════════════════════════════
+# Custom CSS
+# ═══════════════════════════════════════════════════════════════
 
-/* ── Enhanced Patient Cards ── */
-.patient-card {
-    background: rgba(255,255,255,0.82);
-    backdrop-filter: blur(10px); -webkit-backdrop-filter: blur(10px);
-    border: 2px solid transparent;
-    border-image: linear-gradient(135deg, var(--border) 0%, rgba(46,139,192,0.15) 100%) 1;
-    border-image-slice: 1;
-    border-radius: var(--radius); border-image: none;
-    border: 2px solid var(--border);
-    padding: 20px; transition: all 0.35s cubic-bezier(0.4, 0, 0.2, 1);
-    box-shadow: var(--shadow-sm); position: relative; overflow: hidden;
-}
-.patient-card::before {
-    content: ''; position: absolute; top: 0; left: 0; right: 0; height: 3px;
-    background: linear-gradient(90deg, var(--secondary), var(--accent), var(--secondary));
-    opacity: 0; transition: opacity 0.3s;
-}
-.patient-card:hover { border-color: var(--secondary-light); box-shadow: var(--shadow-md), 0 4px 30px rgba(46,139,192,0.1); transform: translateY(-4px); }
-.patient-card:hover::before { opacity: 1; }
-.patient-card-name { font-size: 17px; font-weight: 800; color: var(--primary); margin: 0 0 8px; letter-spacing: -0.3px; }
-.patient-card-dx { font-size: 12px; color: var(--text-sub); margin: 0 0 6px; line-height: 1.5; }
-.patient-card-meta { font-size: 10px; color: var(--text-muted); display: flex; gap: 8px; align-items: center; }
-
-/* ── Enhanced Patient Header ── */
-.patient-header {
-    background: linear-gradient(135deg, #1E3A5F 0%, #2A5F8C 40%, #1A7A58 100%);
-    border-radius: var(--radius-lg); padding: 22px 28px; margin-bottom: 20px;
-    display: flex; align-items: center; justify-content: space-between;
-    box-shadow: var(--shadow-md), 0 4px 30px rgba(30,58,95,0.2); color: white;
-    position: relative; overflow: hidden;
-}
-.patient-header::before {
-    content: ''; position: absolute; top: -50%; right: -20%; width: 60%; height: 200%;
-    background: radial-gradient(ellipse, rgba(255,255,255,0.06) 0%, transparent 70%);
-    animation: headerShine 6s ease-in-out infinite alternate;
-}
-@keyframes headerShine {
-    0% { transform: translateX(-20%); } 100% { transform: translateX(20%); }
-}
-.patient-header .ph-name { font-size: 19px; font-weight: 800; margin: 0; position: relative; z-index: 1; }
-.patient-header .ph-meta { font-size: 12px; color: rgba(255,255,255,0.75); margin-top: 6px; position: relative; z-index: 1; }
-.patient-header .ph-badges { display: flex; gap: 6px; position: relative; z-index: 1; }
-
-/* ── Workflow Progress Bar ── */
-.workflow-progress {
-    display: flex; gap: 4px; padding: 12px 20px; margin-bottom: 16px;
-    background: rgba(255,255,255,0.7); backdrop-filter: blur(8px);
-    border-radius: var(--radius); border: 1px solid var(--border); box-shadow: var(--shadow-sm);
-}
-.workflow-step {
-    flex: 1; text-align: center; padding: 8px 4px; border-radius: var(--radius-sm);
-    font-size: 10px; font-weight: 600; color: var(--text-muted); transition: all 0.3s;
-    position: relative;
-}
-.workflow-step.active {
-    background: linear-gradient(135deg, rgba(46,139,192,0.12), rgba(11,132,87,0.08));
-    color: var(--primary); box-shadow: 0 2px 8px rgba(46,139,192,0.12);
-}
-.workflow-step.done {
-    background: rgba(16,185,129,0.08); color: var(--accent);
-}
-.workflow-step-icon { font-size: 18px; display: block; margin-bottom: 4px; }
-.workflow-step-label { display: block; }
-.workflow-step-connector {
-    position: absolute; top: 50%; left: -8px; width: 12px; height: 2px;
-    background: var(--border);
-}
-.workflow-step.done .workflow-step-connector { background: var(--accent); }
-
-/* ── Metric Cards ── */
-.metric-row { display: grid; grid-template-columns: repeat(4, 1fr); gap: 12px; margin-bottom: 16px; }
-.metric-card {
-    background: rgba(255,255,255,0.8); backdrop-filter: blur(8px);
-    border: 1px solid var(--border); border-radius: var(--radius); padding: 16px 14px;
-    text-align: center; transition: all 0.3s; position: relative; overflow: hidden;
-}
-.metric-card::after {
-    content: ''; position: absolute; bottom: 0; left: 0; right: 0; height: 3px;
-    background: linear-gradient(90deg, var(--secondary), var(--accent));
-    opacity: 0.5; transition: opacity 0.3s;
-}
-.metric-card:hover { transform: translateY(-2px); box-shadow: var(--shadow); }
-.metric-card:hover::after { opacity: 1; }
-.metric-num { font-size: 28px; font-weight: 900; color: var(--primary); line-height: 1; display: block; }
-.metric-label { font-size: 11px; color: var(--text-muted); font-weight: 600; margin-top: 6px; display: block; }
-
-/* ── Quick Actions ── */
-.quick-actions { display: flex; gap: 8px; flex-wrap: wrap; margin: 16px 0; }
-.quick-action-btn {
-    display: inline-flex; align-items: center; gap: 6px; padding: 8px 16px;
-    background: rgba(255,255,255,0.8); border: 1px solid var(--border);
-    border-radius: 20px; font-size: 12px; font-weight: 600; color: var(--text-sub);
-    cursor: pointer; transition: all 0.25s; text-decoration: none;
-}
-.quick-action-btn:hover {
-    background: linear-gradient(135deg, rgba(46,139,192,0.08), rgba(11,132,87,0.06));
-    border-color: var(--secondary); color: var(--primary); transform: translateY(-1px);
-    box-shadow: 0 4px 12px rgba(46,139,192,0.1);
-}
+CSS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "app.css")
 
-/* ── Enhanced Tabs ── */
-.stTabs [data-baseweb="tab-list"] {
-    gap: 4px !important; background: rgba(255,255,255,0.5) !important;
-    padding: 4px !important; border-radius: var(--radius) !important;
-    border: 1px solid var(--border) !important;
-}
-.stTabs [data-baseweb="tab"] {
-    border-radius: var(--radius-sm) !important; font-family: 'Cairo', sans-serif !important;
-    font-size: 13px !important; font-weight: 600 !important; padding: 8px 12px !important;
-    color: var(--text-muted) !important; transition: all 0.25s !important;
-}
-.stTabs [data-baseweb="tab"]:hover {
-    background: rgba(46,139,192,0.06) !important; color: var(--primary) !important;
-}
-.stTabs [aria-selected="true"] {
-    background: linear-gradient(135deg, rgba(46,139,192,0.12), rgba(11,132,87,0.08)) !important;
-    color: var(--primary) !important; box-shadow: 0 2px 8px rgba(46,139,192,0.1) !important;
-}
-.stTabs [data-baseweb="tab-highlight"] {
-    background: linear-gradient(90deg, var(--secondary), var(--accent)) !important;
-    height: 3px !important; border-radius: 2px !important;
-}
-.stTabs [data-baseweb="tab-border"] { display: none !important; }
-
-/* ── Enhanced Buttons ── */
-.stButton > button[kind="primary"], .stButton > button[data-testid*="primary"] {
-    font-family: 'Cairo', sans-serif !important;
-    background: linear-gradient(135deg, #1E3A5F 0%, #2E5B8C 100%) !important;
-    color: white !important; border: none !important;
-    border-radius: var(--radius) !important; font-weight: 700 !important;
-    padding: 8px 20px !important; box-shadow: 0 4px 15px rgba(30,58,95,0.3) !important;
-    transition: all 0.3s cubic-bezier(0.4, 0, 0.2, 1) !important;
-}
-.stButton > button[kind="primary"]:hover {
-    background: linear-gradient(135deg, #2E5B8C 0%, #3A79B8 100%) !important;
-    transform: translateY(-1px) !important;
-    box-shadow: 0 6px 20px rgba(30,58,95,0.4) !important;
-}
-.stButton > button:not([kind="primary"]) {
-    font-family: 'Cairo', sans-serif !important; border-radius: var(--radius-sm) !important;
-    transition: all 0.25s !important; font-weight: 600 !important;
-}
-.stButton > button:not([kind="primary"]):hover { transform: translateY(-1px) !important; }
-
-/* ── Enhanced Form Inputs ── */
-.stTextInput > div > div, .stNumberInput > div > div, .stSelectbox > div > div {
-    border-radius: var(--radius-sm) !important;
-    border-color: var(--border) !important;
-    transition: all 0.25s !important;
-    font-family: 'Cairo', sans-serif !important;
-}
-.stTextInput > div > div:focus-within, .stNumberInput > div > div:focus-within,
-.stSelectbox > div > div:focus-within {
-    border-color: var(--secondary) !important;
-    box-shadow: 0 0 0 3px rgba(46,139,192,0.1) !important;
-}
 
-/* ── Enhanced Expanders ── */
-[data-testid="stExpander"] {
-    border: 1px solid var(--border) !important;
-    border-radius: var(--radius) !important;
-    background: rgba(255,255,255,0.8) !important;
-    backdrop-filter: blur(6px) !important;
-    box-shadow: var(--shadow-sm) !important;
-    transition: all 0.3s !important;
-}
-[data-testid="stExpander"]:hover {
-    box-shadow: var(--shadow) !important; border-color: rgba(46,139,192,0.15) !important;
-}
-[data-testid="stExpander"] summary {
-    font-family: 'Cairo', sans-serif !important; font-weight: 700 !important;
-}
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_CSS_SPACE_RE = re.compile(r"\s+")
+# المسافات حول { } ; و , آمنة للحذف — أما حول ":" فلا (مسافة قبل :hover تعني عنصراً فرعياً)
+_CSS_PUNCT_RE = re.compile(r"\s*([{};,])\s*")
 
-/* ── Enhanced Note Cards ── */
-.note-card {
-    background: rgba(255,255,255,0.85); backdrop-filter: blur(6px);
-    border: 1px solid var(--border); border-radius: var(--radius);
-    padding: 16px; margin-bottom: 12px; box-shadow: var(--shadow-sm);
-    transition: all 0.25s; position: relative; overflow: hidden;
-    border-right: 4px solid var(--secondary);
-}
-.note-card:hover { box-shadow: var(--shadow); transform: translateX(-3px); }
 
-/* ── API Status Pulse ── */
-@keyframes statusPulse {
-    0%, 100% { box-shadow: 0 0 0 0 rgba(16,185,129,0.4); }
-    50% { box-shadow: 0 0 0 8px rgba(16,185,129,0); }
-}
-.badge-green { animation: statusPulse 2s infinite; }
+def _minify_css(css: str) -> str:
+    """ضغط CSS: حذف التعليقات وطيّ المسافات — الحمولة تُرسل عبر websocket في كل إعادة تشغيل"""
+    css = _CSS_COMMENT_RE.sub("", css)
+    css = _CSS_SPACE_RE.sub(" ", css)
+    css = _CSS_PUNCT_RE.sub(r"\1", css)
+    return css.replace(";}", "}").strip()
 
-/* ── Activity Timeline ── */
-.activity-item {
-    display: flex; align-items: flex-start; gap: 12px; padding: 10px 0;
-    border-bottom: 1px solid rgba(226,232,240,0.5); position: relative;
-}
-.activity-item::before {
-    content: ''; position: absolute; right: 5px; top: 0; bottom: 0; width: 2px;
-    background: linear-gradient(to bottom, var(--secondary), transparent);
-}
-.activity-dot {
-    width: 10px; height: 10px; border-radius: 50%; flex-shrink: 0; margin-top: 4px;
-    background: var(--secondary); box-shadow: 0 0 0 3px rgba(46,139,192,0.15);
-}
-.activity-content { flex: 1; }
-.activity-type { font-size: 11px; font-weight: 700; color: var(--primary); }
-.activity-desc { font-size: 12px; color: var(--text-sub); margin-top: 2px; }
-.activity-time { font-size: 10px; color: var(--text-muted); }
-
-/* ── Info Section ── */
-.info-grid { display: grid; grid-template-columns: 1fr 1fr; gap: 8px; }
-.info-item {
-    padding: 10px 14px; background: rgba(238,242,247,0.6); border-radius: var(--radius-sm);
-    border: 1px solid rgba(226,232,240,0.5);
-}
-.info-label { font-size: 10px; font-weight: 700; color: var(--text-muted); text-transform: uppercase; letter-spacing: 0.5px; }
-.info-value { font-size: 14px; font-weight: 600; color: var(--primary); margin-top: 2px; }
-
-/* ── Page Header Enhanced ── */
-.page-header {
-    background: linear-gradient(135deg, #1E3A5F 0%, #2A6496 40%, #1A7A58 80%, #0B8457 100%);
-    border-radius: 0 0 var(--radius-xl) var(--radius-xl);
-    padding: 28px 34px 24px; margin: 0 -24px 28px; display: flex;
-    align-items: center; justify-content: space-between;
-    box-shadow: var(--shadow-lg), 0 6px 40px rgba(30,58,95,0.15);
-    position: relative; overflow: hidden;
-}
-.page-header::before {
-    content: ''; position: absolute; top: -50%; right: -30%; width: 80%; height: 200%;
-    background: radial-gradient(ellipse, rgba(255,255,255,0.05) 0%, transparent 60%);
-    animation: headerShine 8s ease-in-out infinite alternate;
-}
 
-/* SCROLLBAR */
-::-webkit-scrollbar { width: 6px; height: 6px; }
-::-webkit-scrollbar-track { background: transparent; }
-::-webkit-scrollbar-thumb { background: linear-gradient(to bottom, #CBD5E0, #A0AEC0); border-radius: 3px; }
-::-webkit-scrollbar-thumb:hover { background: linear-gradient(to bottom, #A0AEC0, #718096); }
-
-/* ── Empty State ── */
-.empty-state {
-    text-align: center; padding: 40px 20px;
-    background: rgba(255,255,255,0.5); border-radius: var(--radius-lg);
-    border: 2px dashed var(--border);
-}
-.empty-state-icon { font-size: 60px; display: block; margin-bottom: 16px; opacity: 0.6; }
-.empty-state-text { color: var(--text-muted); font-size: 14px; }
+@st.cache_resource(show_spinner=False)
+def load_custom_css() -> str:
+    """
+    أنماط الواجهة من static/app.css — تُحضَّر مرة واحدة لكل عملية
 
-/* ── Loading Skeleton ── */
-@keyframes shimmer {
-    0% { background-position: -200% 0; }
-    100% { background-position: 200% 0; }
-}
-.skeleton {
-    background: linear-gradient(90deg, #EEF2F7 25%, #E2E8F0 50%, #EEF2F7 75%);
-    background-size: 200% 100%; animation: shimmer 1.5s infinite;
-    border-radius: var(--radius-sm);
-}
+    مع التقديم الثابت (.streamlit/config.toml) تُرسل كل إعادة تشغيل سطر @import فقط،
+    والمتصفح يحمّل الملف مرة ويخزّنه (بصمة المحتوى في الرابط تُبطل النسخة القديمة).
+    بدونه تُضمَّن الأنماط مضغوطة كما هي.
+    """
+    with open(CSS_FILE, "rb") as f:
+        raw = f.read()
+    if st.get_option("server.enableStaticServing"):
+        version = hashlib.blake2b(raw, digest_size=8).hexdigest()
+        return f'<style>@import url("app/static/app.css?v={version}");</style>'
+    return f"<style>{_minify_css(raw.decode('utf-8'))}</style>"
 
-/* RESPONSIVE */
-@media (max-width: 768px) {
-    .bubble { max-width: 92%; } .page-header { padding: 18px 20px; }
-    .ph-title { font-size: 16px; } .ph-badges { display: none; }
-    .metric-row { grid-template-columns: repeat(2, 1fr); }
-    .workflow-progress { flex-wrap: wrap; }
-    .info-grid { grid-template-columns: 1fr; }
-}
-</style>
-"""
 
-st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+# st.html بمحتوى style فقط يُرسل إلى حاوية الأحداث فلا يشغل مساحة في الصفحة
+st.html(load_custom_css())
 
 
 # ═══════════════════════════════════════════════════════════════
 # Chat Backend — Patient-Aware
 # ═══════════════════════════════════════════════════════════════
 
-def build_patient_system_context(patient: dict) -> str:
+def build_system_prompt(patient: dict = None) -> str:
+    """موجّه النظام كاملاً (SYSTEM_PROMPT + سياق المريض) — يُبنى مرة لكل (معرف، updated_at) ويُعاد من الجلسة في بقية الأدوار"""
+    if not patient:
+        return SYSTEM_PROMPT
+    key = (patient.get("id"), patient.get("updated_at"))
+    cached = st.session_state.get("_system_ctx")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    prompt = SYSTEM_PROMPT + _patient_system_context(patient)
+    st.session_state._system_ctx = (key, prompt)
+    return prompt
+
+
+def _patient_system_context(patient: dict) -> str:
     goals = ", ".join(patient.get("functional_goals", [])) or "لم تُحدد"
-    icd = ", ".join(patient.get("diagnosis_icd10", [])) or "—"
+    icd = icd_text(tuple(patient.get("diagnosis_icd10", []))) or "—"
     fnum = patient.get("file_number", "—")
 
-    # تضمين آخر التقييمات والملاحظات
-    recent_notes = ""
-    for note in patient.get("notes", [])[-3:]:
-        recent_notes += f"  - [{note.get('type', '')}] {note.get('content', '')[:80]}\n"
-    recent_assess = ""
-    for a in patient.get("assessment_results", [])[-3:]:
-        atype = a.get("type", "")
-        ts = a.get("timestamp", "")[:10]
-        recent_assess += f"  - {atype} ({ts})\n"
-    recent_sessions = ""
-    for s in patient.get("intervention_sessions", [])[-3:]:
-        stype = s.get("type", "")
-        ts = s.get("timestamp", "")[:10]
-        recent_sessions += f"  - {stype} ({ts})\n"
-
-    rehab_type = patient.get("rehabilitation_type", "") or "غير محدد"
-    treatment_plans_count = len(patient.get("treatment_plans", []))
-    active_plans = [p for p in patient.get("treatment_plans", []) if p.get("status") == "active"]
-
-    recent_plans = ""
-    for plan in active_plans[-2:]:
-        recent_plans += f"  - {plan.get('plan_title', '')} ({plan.get('rehabilitation_type', '')})\n"
-
-    ctx = (
-        f"\n\n--- سياق المريض الحالي ---\n"
+    rt = patient.get("rehabilitation_type", "")
+    plans = patient.get("treatment_plans", [])
+    active_plans = [p for p in plans if p.get("status") == "active"]
+
+    # الأجزاء تُجمع في قائمة وتُلصق مرة واحدة — بدل += متكرر على نص متنامٍ
+    parts = [
+        "\n\n--- سياق المريض الحالي ---\n"
         f"رقم الملف: {fnum}\n"
         f"معرف المريض: {patient.get('id', '')}\n"
         f"الاسم: {patient.get('name', '')}\n"
         f"العمر: {patient.get('age', '—')}\n"
         f"الجنس: {'ذكر' if patient.get('gender') == 'male' else 'أنثى'}\n"
-        f"نوع التأهيل: {rehab_type}\n"
+        f"نوع التأهيل: {rt or 'غير محدد'}\n"
         f"التشخيص: {patient.get('diagnosis_text', '')} ({icd})\n"
-    )
+    ]
     # Specialty-specific context
-    rt = patient.get("rehabilitation_type", "")
     if rt == "vision":
-        ctx += (
+        parts.append(
             f"حدة الإبصار: {patient.get('va_logmar', '—')} LogMAR\n"
             f"مجال الرؤية: {patient.get('visual_field_degrees', '—')} درجة\n"
             f"نمط الفقد: {patient.get('vision_pattern', '—')}\n"
@@ -1007,60 +995,77 @@ def build_patient_system_context(patient: dict) -> str:
     if rt in ("orthopedic", "neuro", "pain"):
         pain_scores = patient.get("pain_scores", [])
         last_pain = pain_scores[-1]["value"] if pain_scores else "لم يُقيَّم"
-        ctx += f"مستوى الألم (VAS): {last_pain}\n"
+        parts.append(f"مستوى الألم (VAS): {last_pain}\n")
     if rt == "neuro":
-        affected = {"right": "أيمن", "left": "أيسر", "bilateral": "ثنائي"}.get(patient.get("affected_side", ""), "—")
-        ctx += f"الجانب المصاب: {affected}\n"
+        affected = AFFECTED_SIDE_LABELS.get(patient.get("affected_side", ""), "—")
+        parts.append(f"الجانب المصاب: {affected}\n")
     if rt == "cardiac":
-        ctx += f"تصنيف NYHA: {patient.get('nyha_class', '—')}\n"
+        parts.append(f"تصنيف NYHA: {patient.get('nyha_class', '—')}\n")
 
-    ctx += (
+    parts.append(
         f"الحالة الإدراكية: {patient.get('cognitive_status', 'normal')}\n"
         f"PHQ-9: {patient.get('phq9_score', 'لم يُقيَّم')}\n"
         f"الأهداف الوظيفية: {goals}\n"
         f"عدد التقييمات: {len(patient.get('assessment_results', []))} | "
         f"عدد الجلسات: {len(patient.get('intervention_sessions', []))} | "
         f"عدد الملاحظات: {len(patient.get('notes', []))} | "
-        f"عدد الخطط العلاجية: {treatment_plans_count}\n"
+        f"عدد الخطط العلاجية: {len(plans)}\n"
     )
-    if recent_notes:
-        ctx += f"آخر الملاحظات:\n{recent_notes}"
-    if recent_assess:
-        ctx += f"آخر التقييمات:\n{recent_assess}"
-    if recent_sessions:
-        ctx += f"آخر الجلسات:\n{recent_sessions}"
-    if recent_plans:
-        ctx += f"الخطط العلاجية النشطة:\n{recent_plans}"
-    ctx += (
-        f"---\n"
+
+    # تضمين آخر التقييمات والملاحظات
+    notes = patient.get("notes", [])[-3:]
+    if notes:
+        parts.append("آخر الملاحظات:\n")
+        parts.extend(f"  - [{note.get('type', '')}] {note.get('content', '')[:80]}\n" for note in notes)
+    assessments = patient.get("assessment_results", [])[-3:]
+    if assessments:
+        parts.append("آخر التقييمات:\n")
+        parts.extend(f"  - {a.get('type', '')} ({a.get('timestamp', '')[:10]})\n" for a in assessments)
+    sessions = patient.get("intervention_sessions", [])[-3:]
+    if sessions:
+        parts.append("آخر الجلسات:\n")
+        parts.extend(f"  - {s.get('type', '')} ({s.get('timestamp', '')[:10]})\n" for s in sessions)
+    if active_plans:
+        parts.append("الخطط العلاجية النشطة:\n")
+        parts.extend(f"  - {plan.get('plan_title', '')} ({plan.get('rehabilitation_type', '')})\n"
+                     for plan in active_plans[-2:])
+    parts.append(
+        "---\n"
         f"عند الإجابة، استخدم بيانات هذا المريض (ملف #{fnum}) تحديداً.\n"
-        f"يمكنك استخدام أداة patient_database للبحث عن مرضى آخرين أو استرجاع بيانات إضافية.\n"
-        f"استخدم أداة record_treatment_plan لحفظ الخطط العلاجية في ملف المريض.\n"
-        f"بادر بطرح أسئلة لاستكمال المعلومات الناقصة.\n"
+        "يمكنك استخدام أداة patient_database للبحث عن مرضى آخرين أو استرجاع بيانات إضافية.\n"
+        "استخدم أداة record_treatment_plan لحفظ الخطط العلاجية في ملف المريض.\n"
+        "بادر بطرح أسئلة لاستكمال المعلومات الناقصة.\n"
     )
-    return ctx
+    return "".join(parts)
 
 
 _orchestrator = RehabOrchestrator()
 
 
+def _api_history(patient: dict) -> list:
+    """سجل المحادثة بصيغة API — تُغلَّف الرسائل الجديدة فقط، والبادئة المغلَّفة محفوظة في الجلسة"""
+    history = patient.get("chat_history", [])
+    key = f"_api_history_{patient.get('id')}"
+    source, wrapped = st.session_state.get(key, (None, []))
+    # المحادثة تُلحق فقط — قائمة مختلفة (مسح المحادثة) أو أقصر تعني البناء من جديد
+    if source is not history or len(wrapped) > len(history):
+        wrapped = []
+    # الدوران user/assistant يُبنيان بنفس الشكل — لا حاجة لتفرّع لكل رسالة
+    wrapped.extend({"role": msg["role"], "content": [{"type": "text", "text": msg["content"]}]}
+                   for msg in history[len(wrapped):])
+    st.session_state[key] = (history, wrapped)
+    return wrapped
+
+
 def _build_api_messages(patient: dict, user_text: str, images: list = None) -> list:
     """Build API messages from chat history + current message."""
-    chat_history = patient.get("chat_history", []) if patient else []
-    api_messages = []
-    for msg in chat_history:
-        if msg["role"] == "user":
-            api_messages.append({"role": "user", "content": [{"type": "text", "text": msg["content"]}]})
-        else:
-            api_messages.append({"role": "assistant", "content": [{"type": "text", "text": msg["content"]}]})
-
-    current_content = []
-    if images:
-        for img in images:
-            current_content.append({
-                "type": "image",
-                "source": {"type": "base64", "media_type": img["media_type"], "data": img["data"]}
-            })
+    # نسخة من القائمة — الوكلاء يضيفون رسائل الأدوات إليها ولا يجب أن تمس البادئة المخزَّنة
+    api_messages = list(_api_history(patient)) if patient else []
+
+    current_content = [{
+        "type": "image",
+        "source": {"type": "base64", "media_type": img["media_type"], "data": img["data"]}
+    } for img in images or ()]
     current_content.append({"type": "text", "text": user_text})
     api_messages.append({"role": "user", "content": current_content})
     return api_messages
@@ -1068,7 +1073,7 @@ def _build_api_messages(patient: dict, user_text: str, images: list = None) -> l
 
 def chat_with_patient_context(user_text: str, patient: dict = None, images: list = None) -> dict:
     """Synchronous chat (used for non-streaming contexts like AI summary)."""
-    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+    api_key = get_api_key()
     if not api_key:
         return {
             "text": "[تنبيه] **مفتاح API غير موجود!**\n\nيرجى إضافة `ANTHROPIC_API_KEY` في متغيرات البيئة.",
@@ -1076,10 +1081,7 @@ def chat_with_patient_context(user_text: str, patient: dict = None, images: list
         }
 
     user_text = sanitize_patient_input(user_text)
-    system = SYSTEM_PROMPT
-    if patient:
-        system = system + build_patient_system_context(patient)
-
+    system = build_system_prompt(patient)
     api_messages = _build_api_messages(patient, user_text, images)
 
     try:
@@ -1104,7 +1106,7 @@ def chat_with_patient_context(user_text: str, patient: dict = None, images: list
 def chat_with_patient_context_stream(user_text: str, patient: dict = None,
                                      images: list = None, placeholder=None) -> dict:
     """Streaming chat — tokens appear word-by-word in the placeholder."""
-    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+    api_key = get_api_key()
     if not api_key:
         return {
             "text": "[تنبيه] **مفتاح API غير موجود!**",
@@ -1112,10 +1114,7 @@ def chat_with_patient_context_stream(user_text: str, patient: dict = None,
         }
 
     user_text = sanitize_patient_input(user_text)
-    system = SYSTEM_PROMPT
-    if patient:
-        system = system + build_patient_system_context(patient)
-
+    system = build_system_prompt(patient)
     api_messages = _build_api_messages(patient, user_text, images)
 
     try:
@@ -1144,86 +1143,161 @@ def chat_with_patient_context_stream(user_text: str, patient: dict = None,
 
 TOOL_NAME_MAP = {t[2]: t[1] for t in TOOLS_MANIFEST}
 
-def tool_display_name(raw_name: str) -> str:
+# قوالب HTML للصفوف المتكررة — تُملأ بـ str.format بدل بناء f-string لكل صف
+_NOTE_CARD_TPL = (
+    '<div class="note-card">'
+    '<div class="note-card-header">'
+    '<span class="note-card-type">{type}</span>'
+    '<span class="note-card-time">{time}</span>'
+    '</div>'
+    '<div class="note-card-body">{body}</div>'
+    '</div>'
+)
+_TOOL_CHIP_TPL = (
+    '<div class="tool-chip">'
+    '<span class="tool-chip-icon">{icon}</span>'
+    '<span class="tool-chip-name">{name}</span>'
+    '<span class="tool-chip-badge">نشط</span>'
+    '</div>'
+)
+_TOOL_CALL_TPL = (
+    '<div class="tool-call-card">'
+    '<div class="tool-call-header">استخدام أداة</div>'
+    '<span class="tool-call-name">{name}</span>'
+    '<div style="color:#78350F;font-size:10px;margin-top:4px;font-family:monospace;opacity:0.7">{preview}</div>'
+    '</div>'
+)
+_SVG_CARD_TPL = (
+    '<div class="visual-exercise-card">'
+    '<div class="ve-header">{title}</div>'
+    '<div class="ve-instructions">{instructions}</div>'
+    '<div class="ve-svg">{svg}</div>'
+    '<div class="ve-footer">'
+    '<span>{duration} دقيقة</span>'
+    '<span>{reps} مرات</span>'
+    '{badge}'
+    '</div>'
+    '</div>'
+)
+_PATIENT_CARD_TPL = (
+    '<div class="patient-card">'
+    '<div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:6px">'
+    '<p class="patient-card-name" style="margin:0">{name}</p>'
+    '<span class="badge badge-blue" style="font-size:11px;font-weight:800">{fnum}</span>'
+    '</div>'
+    '<p class="patient-card-dx">{dx}</p>'
+    '<p class="patient-card-meta">VA: {va} · ملف: {pid} · {updated}</p>'
+    '</div>'
+)
+_EVIDENCE_BADGE_TPL = (
+    '<span style="background:rgba(11,132,87,0.2);color:#10A567;padding:2px 8px;'
+    'border-radius:10px;font-size:10px;font-weight:700">مستوى الدليل: {}</span>'
+)
+
+def _match_tool_label(raw_name: str) -> str:
     for key, label in TOOL_NAME_MAP.items():
         if key in raw_name:
             return label
     return raw_name
 
-def render_tool_calls(tool_calls: list):
-    if not tool_calls:
-        return
-    for tc in tool_calls:
-        st.markdown(f"""
-        <div class="tool-call-card">
-            <div class="tool-call-header">استخدام أداة</div>
-            <span class="tool-call-name">{html.escape(tool_display_name(tc['name']))}</span>
-            <div style="color:#78350F;font-size:10px;margin-top:4px;font-family:monospace;opacity:0.7">
-                {html.escape(tc.get('input_preview', ''))}
-            </div>
-        </div>""", unsafe_allow_html=True)
+# أسماء الأدوات المعروفة تُطابَق وتُهرَّب مرة واحدة عند التحميل — العرض بعدها بحث مباشر في القاموس
+TOOL_DISPLAY_NAMES_ESCAPED = {t["name"]: html.escape(_match_tool_label(t["name"])) for t in TOOLS}
+
+def tool_display_name_escaped(raw_name: str) -> str:
+    label = TOOL_DISPLAY_NAMES_ESCAPED.get(raw_name)
+    return label if label is not None else html.escape(_match_tool_label(raw_name))
+
+def _tool_calls_html(tool_calls: list) -> str:
+    return "".join(_TOOL_CALL_TPL.format(
+        name=tool_display_name_escaped(tc["name"]),
+        preview=html.escape(tc.get("input_preview", "")),
+    ) for tc in tool_calls)
 
-def render_message(msg: dict):
+def _show_older(limit_key: str):
+    st.session_state[limit_key] = st.session_state.get(limit_key, HISTORY_PAGE_SIZE) + HISTORY_PAGE_SIZE
+
+def render_show_older(pid: str, kind: str, total: int, limit: int):
+    """زر "عرض الأقدم" — يوسّع نافذة العرض بصفحة إضافية"""
+    if total > limit:
+        st.button(f"عرض الأقدم ({total - limit})", key=f"older_{pid}_{kind}",
+            on_click=_show_older, args=(f"prev_limit_{pid}_{kind}",))
+
+@st.fragment
+def render_history(pid: str, kind: str, title: str, items: list, render_item):
+    """عرض السجلات السابقة عند الطلب فقط — التبديل يعيد تشغيل هذا الجزء وحده"""
+    if not st.toggle(title, key=f"show_prev_{pid}_{kind}"):
+        return
+    limit = st.session_state.get(f"prev_limit_{pid}_{kind}", HISTORY_PAGE_SIZE)
+    with st.container(border=True):
+        for item in items[:-limit - 1:-1]:
+            render_item(item)
+            st.markdown("---")
+        render_show_older(pid, kind, len(items), limit)
+
+def _render_prev_result(entry: dict):
+    st.write(f"**{entry.get('type', '')}** — {entry.get('timestamp', '')[:16]}")
+    st.json(entry.get("result", {}))
+
+def _render_prev_cdss(ev: dict):
+    st.write(f"**{ev.get('timestamp', '')[:16]}**")
+    recs = ev.get("result", {}).get("recommendations", [])
+    for r in recs[:3]:
+        st.write(f"  - {r.get('technique_ar', r.get('technique', ''))}: أولوية {r.get('priority', '')}")
+
+def _render_prev_document(d: dict):
+    st.write(f"**{d.get('type', '')}** — {d.get('timestamp', '')[:16]}")
+    st.markdown(d.get("content", ""))
+
+def render_message(msg: dict, index: int = 0):
+    """رسم رسالة واحدة — index موضعها في المحادثة (مفتاح حاوية رد المساعد)"""
     role = msg["role"]
     content = msg["content"]
-    ts = msg.get("time", "")
+    # إخفاء رسالة الإطلاق التلقائي (__START_INTAKE__) قبل تجهيز أي شيء آخر
+    if role == "user" and content.strip() == "__START_INTAKE__":
+        return
+    ts = html.escape(msg.get("time", ""))
     tool_calls = msg.get("tool_calls", [])
 
     if role == "user":
-        # إخفاء رسالة الإطلاق التلقائي (__START_INTAKE__)
-        if content.strip() == "__START_INTAKE__":
-            return
         st.markdown(f"""
         <div class="msg-user">
             <div class="avatar avatar-user">M</div>
             <div>
                 <div class="bubble bubble-user">{html.escape(content)}</div>
-                <div class="bubble-footer">{html.escape(ts)}</div>
+                <div class="bubble-footer">{ts}</div>
             </div>
         </div>""", unsafe_allow_html=True)
     else:
         # عرض استدعاءات الأدوات (غير SVG)
         non_svg_calls = [tc for tc in tool_calls if not tc.get("svg_data")]
         if non_svg_calls:
-            st.markdown('<div style="padding-right:48px">', unsafe_allow_html=True)
-            render_tool_calls(non_svg_calls)
-            st.markdown('</div>', unsafe_allow_html=True)
-
-        col_av, col_bub = st.columns([0.06, 0.94])
-        with col_av:
-            st.markdown('<div class="avatar avatar-ai" style="margin-top:4px;font-size:12px;font-weight:800;color:white">Re</div>', unsafe_allow_html=True)
-        with col_bub:
-            st.markdown('<div class="bubble bubble-ai" style="max-width:100%">', unsafe_allow_html=True)
+            st.markdown(f'<div style="padding-right:48px">{_tool_calls_html(non_svg_calls)}</div>',
+                        unsafe_allow_html=True)
+
+        # حاوية بمفتاح تُنسَّق كفقاعة من static/app.css (st-key-ai_msg_*) بدل st.columns؛
+        # الرد يمر بـ st.markdown العادي — بدون unsafe_allow_html فلا يُفسَّر HTML من النموذج
+        with st.container(key=f"ai_msg_{index}"):
             st.markdown(content)
-            st.markdown(f'<div class="bubble-footer bubble-footer-ai">{html.escape(ts)}</div></div>', unsafe_allow_html=True)
-
-        # عرض التمارين البصرية SVG
-        for tc in tool_calls:
-            if tc.get("svg_data"):
-                ev = tc.get("svg_evidence", "")
-                ev_badge = f'<span style="background:rgba(11,132,87,0.2);color:#10A567;padding:2px 8px;border-radius:10px;font-size:10px;font-weight:700">مستوى الدليل: {html.escape(ev)}</span>' if ev else ""
-                st.markdown(f"""
-                <div class="visual-exercise-card">
-                    <div class="ve-header">{html.escape(tc.get("svg_title", "تمرين بصري"))}</div>
-                    <div class="ve-instructions">{html.escape(tc.get("svg_instructions", ""))}</div>
-                    <div class="ve-svg">{tc["svg_data"]}</div>
-                    <div class="ve-footer">
-                        <span>{tc.get("svg_duration", 10)} دقيقة</span>
-                        <span>{tc.get("svg_reps", 3)} مرات</span>
-                        {ev_badge}
-                    </div>
-                </div>
-                """, unsafe_allow_html=True)
+            st.markdown(f'<div class="bubble-footer bubble-footer-ai">{ts}</div>', unsafe_allow_html=True)
+
+        # عرض التمارين البصرية SVG — جميع البطاقات في استدعاء markdown واحد
+        svg_cards = "".join(_SVG_CARD_TPL.format(
+            title=html.escape(tc.get("svg_title", "تمرين بصري")),
+            instructions=html.escape(tc.get("svg_instructions", "")),
+            svg=tc["svg_data"],
+            duration=tc.get("svg_duration", 10),
+            reps=tc.get("svg_reps", 3),
+            badge=_EVIDENCE_BADGE_TPL.format(html.escape(ev)) if (ev := tc.get("svg_evidence", "")) else "",
+        ) for tc in tool_calls if tc.get("svg_data"))
+        if svg_cards:
+            st.markdown(svg_cards, unsafe_allow_html=True)
 
 
 # ═══════════════════════════════════════════════════════════════
 # Patient Registry Page
 # ═══════════════════════════════════════════════════════════════
 
-def render_patient_registry():
-    api_key = os.environ.get("ANTHROPIC_API_KEY", "")
-    api_badge = '<span class="badge badge-green">● API متصل</span>' if api_key else '<span class="badge badge-red">○ API غير متصل</span>'
-    st.markdown(f"""
+_PAGE_HEADER_TPL = """
     <div class="page-header">
         <div class="ph-left">
             <span class="ph-icon" style="font-size:28px;font-weight:900;color:white">Re</span>
@@ -1237,7 +1311,14 @@ def render_patient_registry():
             <span class="badge badge-blue">22 أداة متخصصة</span>
         </div>
     </div>
-    """, unsafe_allow_html=True)
+    """
+# رأس الصفحة بحالتيه جاهز عند التحميل — لا يتغير إلا بوجود مفتاح API
+_PAGE_HEADER_ONLINE = _PAGE_HEADER_TPL.format(api_badge='<span class="badge badge-green">● API متصل</span>')
+_PAGE_HEADER_OFFLINE = _PAGE_HEADER_TPL.format(api_badge='<span class="badge badge-red">○ API غير متصل</span>')
+
+
+def render_patient_registry():
+    st.markdown(_PAGE_HEADER_ONLINE if get_api_key() else _PAGE_HEADER_OFFLINE, unsafe_allow_html=True)
 
     st.markdown("## سجل المرضى")
 
@@ -1249,7 +1330,7 @@ def render_patient_registry():
         render_new_patient_form()
 
     # Patient cards grid
-    patients = st.session_state.patients
+    patients = load_all_summaries()
     if not patients:
         st.markdown("""
         <div class="empty-state">
@@ -1260,40 +1341,48 @@ def render_patient_registry():
 
     st.markdown(f'<div style="font-size:13px;color:var(--text-muted);font-weight:600;margin-bottom:12px">إجمالي المرضى: <span style="color:var(--primary);font-weight:800">{len(patients)}</span></div>', unsafe_allow_html=True)
     cols = st.columns(3)
-    for i, (pid, p) in enumerate(sorted(patients.items(), key=lambda x: x[1].get("updated_at", ""), reverse=True)):
+    # load_all_summaries مرتبة مسبقاً حسب آخر تعديل
+    for i, (pid, p) in enumerate(patients.items()):
         with cols[i % 3]:
-            dx = p.get("diagnosis_text", "—") or "—"
-            va = p.get("va_logmar", "—")
-            va_str = f"{va} LogMAR" if va is not None else "—"
-            updated = p.get("updated_at", "")[:10]
+            va = p.get("va_logmar")
             fnum = p.get("file_number", "—")
-            fnum_display = f"#{fnum}" if isinstance(fnum, int) else fnum
+            st.markdown(_PATIENT_CARD_TPL.format(
+                name=html.escape(p.get("name") or pid),
+                fnum=html.escape(f"#{fnum}" if isinstance(fnum, int) else str(fnum)),
+                dx=html.escape(p.get("diagnosis_text") or "—"),
+                va=html.escape(f"{va} LogMAR") if va is not None else "—",
+                pid=html.escape(pid),
+                updated=html.escape((p.get("updated_at") or "")[:10]),
+            ), unsafe_allow_html=True)
+
+            if st.button("فتح الملف", key=f"open_{pid}", use_container_width=True):
+                st.session_state.current_page = "patient_file"
+                st.session_state.current_patient_id = pid
+                st.rerun()
+
+    render_delete_patients(patients)
 
-            st.markdown(f"""
-            <div class="patient-card">
-                <div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:6px">
-                    <p class="patient-card-name" style="margin:0">{html.escape(p.get('name', pid))}</p>
-                    <span class="badge badge-blue" style="font-size:11px;font-weight:800">{html.escape(str(fnum_display))}</span>
-                </div>
-                <p class="patient-card-dx">{html.escape(dx)}</p>
-                <p class="patient-card-meta">VA: {html.escape(str(va_str))} · ملف: {html.escape(str(pid))} · {html.escape(updated)}</p>
-            </div>
-            """, unsafe_allow_html=True)
 
-            c1, c2 = st.columns(2)
-            with c1:
-                if st.button("فتح الملف", key=f"open_{pid}", use_container_width=True):
-                    st.session_state.current_page = "patient_file"
-                    st.session_state.current_patient_id = pid
-                    st.rerun()
-            with c2:
-                if st.button("حذف", key=f"del_{pid}", use_container_width=True):
-                    delete_patient(pid)
-                    del st.session_state.patients[pid]
-                    st.rerun()
+def render_delete_patients(patients: dict):
+    """حذف الملفات من جدول واحد بعمود تحديد وزر واحد — بدل زر حذف لكل بطاقة"""
+    if not st.toggle("حذف ملفات مرضى", key="show_delete_patients"):
+        return
+    rows = [{"delete": False, "file": pid, "name": p.get("name") or pid} for pid, p in patients.items()]
+    edited = st.data_editor(rows, key=f"delete_patients_{len(rows)}", hide_index=True,
+        disabled=("file", "name"), column_config={
+            "delete": st.column_config.CheckboxColumn("حذف"),
+            "file": st.column_config.TextColumn("الملف"),
+            "name": st.column_config.TextColumn("الاسم"),
+        })
+    selected = [row["file"] for row in edited if row["delete"]]
+    if st.button(f"حذف المحدد ({len(selected)})", key="delete_selected", disabled=not selected):
+        for pid in selected:
+            delete_patient(pid)
+            st.session_state.patients.pop(pid, None)
+        st.rerun()
 
 
-REHAB_TYPES = {
+REHAB_TYPES = MappingProxyType({
     "": "-- اختر نوع التأهيل --",
     "musculoskeletal": "عضلي هيكلي",
     "neurological": "عصبي",
@@ -1303,106 +1392,151 @@ REHAB_TYPES = {
     "geriatric": "كبار السن",
     "pain": "إدارة الألم",
     "psychosocial": "نفسي اجتماعي",
-}
+})
+REHAB_TYPE_KEYS = tuple(REHAB_TYPES)
+# أسماء أنواع التأهيل مُهرَّبة للعرض في HTML — ثابتة فتُهرَّب مرة واحدة
+REHAB_TYPES_ESCAPED = MappingProxyType({k: html.escape(v) for k, v in REHAB_TYPES.items()})
 
 
 def render_new_patient_form():
     with st.expander("بيانات المريض الجديد", expanded=True):
-        rehab_type = st.selectbox("نوع التأهيل", list(REHAB_TYPES.keys()),
-            format_func=lambda x: REHAB_TYPES[x], key="np_rehab_type")
-
-        col1, col2 = st.columns(2)
-        with col1:
-            name = st.text_input("اسم المريض (عربي)", key="np_name")
-            age = st.number_input("العمر", 0, 120, 60, key="np_age")
-            gender = st.selectbox("الجنس", ["male", "female"], format_func=lambda x: "ذكر" if x == "male" else "أنثى", key="np_gender")
-            cog = st.selectbox("الحالة الإدراكية",
-                ["normal", "mild_impairment", "moderate_impairment", "severe_impairment"],
-                format_func=lambda x: {"normal": "طبيعي", "mild_impairment": "خفيف",
-                    "moderate_impairment": "متوسط", "severe_impairment": "شديد"}.get(x, x), key="np_cog")
-        with col2:
-            icd10 = st.multiselect("التشخيص (ICD-10)", list(ICD10_OPTIONS.keys()),
-                format_func=lambda x: f"{x}: {ICD10_OPTIONS[x]}", key="np_icd10")
-            phq9 = st.number_input("PHQ-9 (اكتئاب)", 0, 27, 0, key="np_phq9")
-
-        # Specialty-specific fields
-        va = None
-        pattern = ""
-        vf = None
-        pain_level = None
-        affected_side = ""
-
-        if rehab_type == "vision":
-            st.markdown("**بيانات بصرية**")
-            vc1, vc2, vc3 = st.columns(3)
-            va = vc1.number_input("حدة الإبصار (LogMAR)", -0.3, 3.0, 1.0, 0.1, format="%.1f", key="np_va")
-            pattern = vc2.selectbox("نمط الفقد البصري", [""] + VISION_PATTERNS, key="np_pattern")
-            vf = vc3.number_input("مجال الرؤية (درجات)", 0.0, 180.0, 0.0, 5.0, key="np_vf")
-
-        if rehab_type in ("orthopedic", "neuro", "pain"):
-            st.markdown("**بيانات إضافية**")
-            pc1, pc2 = st.columns(2)
-            pain_level = pc1.slider("مستوى الألم (VAS 0-10)", 0, 10, 0, key="np_pain")
-            if rehab_type == "neuro":
-                affected_side = pc2.selectbox("الجانب المصاب", ["", "right", "left", "bilateral"],
-                    format_func=lambda x: {"": "—", "right": "أيمن", "left": "أيسر", "bilateral": "ثنائي"}.get(x, x), key="np_side")
-
-        if rehab_type == "cardiac":
-            st.markdown("**بيانات قلبية**")
-            nyha_class = st.selectbox("تصنيف NYHA", ["I", "II", "III", "IV"], key="np_nyha")
-
-        goals = st.multiselect("الأهداف الوظيفية", FUNCTIONAL_GOALS,
-            format_func=lambda x: FUNCTIONAL_GOALS_AR.get(x, x), key="np_goals")
+        # نوع التأهيل خارج النموذج — يحدد الحقول الظاهرة فيجب أن يعيد التشغيل فوراً
+        rehab_type = st.selectbox("نوع التأهيل", REHAB_TYPE_KEYS,
+            format_func=REHAB_TYPES.__getitem__, key="np_rehab_type")
+
+        # بقية الحقول داخل st.form — إعادة تشغيل واحدة عند الحفظ بدل واحدة لكل حقل
+        with st.form("new_patient_form"):
+            col1, col2 = st.columns(2)
+            with col1:
+                name = st.text_input("اسم المريض (عربي)", key="np_name")
+                age = st.number_input("العمر", 0, 120, 60, key="np_age")
+                gender = st.selectbox("الجنس", GENDERS, format_func=GENDER_LABELS.__getitem__, key="np_gender")
+                cog = st.selectbox("الحالة الإدراكية", COG_STATES,
+                    format_func=COG_STATE_LABELS.__getitem__, key="np_cog")
+            with col2:
+                icd10 = st.multiselect("التشخيص (ICD-10)", ICD10_CODES,
+                    format_func=ICD10_LABELS.__getitem__, key="np_icd10")
+                phq9 = st.number_input("PHQ-9 (اكتئاب)", 0, 27, 0, key="np_phq9")
+
+            # Specialty-specific fields
+            va = None
+            pattern = ""
+            vf = None
+            pain_level = None
+            affected_side = ""
+
+            if rehab_type == "vision":
+                st.markdown("**بيانات بصرية**")
+                vc1, vc2, vc3 = st.columns(3)
+                va = vc1.number_input("حدة الإبصار (LogMAR)", -0.3, 3.0, 1.0, 0.1, format="%.1f", key="np_va")
+                pattern = vc2.selectbox("نمط الفقد البصري", VISION_PATTERN_CHOICES, key="np_pattern")
+                vf = vc3.number_input("مجال الرؤية (درجات)", 0.0, 180.0, 0.0, 5.0, key="np_vf")
+
+            if rehab_type in ("orthopedic", "neuro", "pain"):
+                st.markdown("**بيانات إضافية**")
+                pc1, pc2 = st.columns(2)
+                pain_level = pc1.slider("مستوى الألم (VAS 0-10)", 0, 10, 0, key="np_pain")
+                if rehab_type == "neuro":
+                    affected_side = pc2.selectbox("الجانب المصاب", AFFECTED_SIDES,
+                        format_func=AFFECTED_SIDE_LABELS.__getitem__, key="np_side")
+
+            if rehab_type == "cardiac":
+                st.markdown("**بيانات قلبية**")
+                nyha_class = st.selectbox("تصنيف NYHA", NYHA_CLASSES, key="np_nyha")
+
+            goals = st.multiselect("الأهداف الوظيفية", FUNCTIONAL_GOALS,
+                format_func=FUNCTIONAL_GOAL_LABELS.__getitem__, key="np_goals")
+            submitted = st.form_submit_button("حفظ وفتح الملف", type="primary", key="save_np")
+
+        if st.button("إلغاء", key="cancel_np"):
+            st.session_state.show_new_patient_form = False
+            st.rerun()
 
-        c1, c2 = st.columns(2)
-        with c1:
-            if st.button("حفظ وفتح الملف", type="primary", key="save_np"):
-                if not name.strip():
-                    st.error("يرجى إدخال اسم المريض")
-                    return
-                pid, file_number = generate_patient_id()
-                patient = new_patient_template(pid, file_number)
-                patient.update({
-                    "name": name.strip(), "age": int(age), "gender": gender,
-                    "rehabilitation_type": rehab_type,
-                    "diagnosis_icd10": icd10,
-                    "diagnosis_text": ", ".join(ICD10_OPTIONS.get(c, c) for c in icd10),
-                    "cognitive_status": cog, "functional_goals": goals,
-                    "phq9_score": int(phq9) if phq9 else None,
-                })
-                # Vision-specific
-                if va is not None:
-                    patient["va_logmar"] = float(va)
-                if pattern:
-                    patient["vision_pattern"] = pattern
-                if vf and vf > 0:
-                    patient["visual_field_degrees"] = float(vf)
-                # Pain
-                if pain_level is not None and pain_level > 0:
-                    patient["pain_scores"] = [{"value": pain_level, "timestamp": datetime.now().isoformat(), "scale": "VAS"}]
-                # Neuro
-                if affected_side:
-                    patient["affected_side"] = affected_side
-                # Cardiac
-                if rehab_type == "cardiac":
-                    patient["nyha_class"] = nyha_class
+        if submitted:
+            if not name.strip():
+                st.error("يرجى إدخال اسم المريض")
+                return
+            new_id = generate_patient_id()
+            pid = new_id.id
+            patient = new_patient_template(pid, new_id.file_number)
+            patient.update({
+                "name": name.strip(), "age": int(age), "gender": gender,
+                "rehabilitation_type": rehab_type,
+                "diagnosis_icd10": icd10,
+                "diagnosis_text": ", ".join(ICD10_OPTIONS.get(c, c) for c in icd10),
+                "cognitive_status": cog, "functional_goals": goals,
+                "phq9_score": int(phq9) if phq9 else None,
+            })
+            # Vision-specific
+            if va is not None:
+                patient["va_logmar"] = float(va)
+            if pattern:
+                patient["vision_pattern"] = pattern
+            if vf and vf > 0:
+                patient["visual_field_degrees"] = float(vf)
+            # Pain
+            if pain_level is not None and pain_level > 0:
+                patient["pain_scores"] = [{"value": pain_level, "timestamp": patient["created_at"], "scale": "VAS"}]
+            # Neuro
+            if affected_side:
+                patient["affected_side"] = affected_side
+            # Cardiac
+            if rehab_type == "cardiac":
+                patient["nyha_class"] = nyha_class
 
-                save_patient(patient)
-                st.session_state.patients[pid] = patient
-                st.session_state.current_page = "patient_file"
-                st.session_state.current_patient_id = pid
-                st.session_state.show_new_patient_form = False
-                st.rerun()
-        with c2:
-            if st.button("إلغاء", key="cancel_np"):
-                st.session_state.show_new_patient_form = False
-                st.rerun()
+            save_patient(patient)
+            st.session_state.patients = {pid: patient}
+            st.session_state.current_page = "patient_file"
+            st.session_state.current_patient_id = pid
+            st.session_state.show_new_patient_form = False
+            st.rerun()
 
 
 # ═══════════════════════════════════════════════════════════════
 # Patient File Page — Header + Tabs
 # ═══════════════════════════════════════════════════════════════
 
+_PATIENT_HEADER_TPL = (
+    '<div class="patient-header">'
+    '<div>'
+    '<p class="ph-name">{name}</p>'
+    '<p class="ph-meta">{meta}</p>'
+    '</div>'
+    '<div class="ph-badges">'
+    '<span class="badge badge-green" style="font-size:12px;font-weight:900">{fnum}</span>'
+    '<span class="badge badge-blue">{rehab_type}</span>'
+    '</div>'
+    '</div>'
+)
+
+
+@dataclass(frozen=True, slots=True)
+class PatientDisplay:
+    """حقول المريض المعروضة في الرأس والملخص — مُهرَّبة للـ HTML"""
+    name: str
+    file_number: str
+    age: str
+    diagnosis: str
+    icd: str
+
+
+@lru_cache(maxsize=64)
+def _patient_display(name: str, file_number: str, age: str, diagnosis: str, icd: str) -> PatientDisplay:
+    return PatientDisplay(*map(html.escape, (name, file_number, age, diagnosis, icd)))
+
+
+def patient_display(patient: dict) -> PatientDisplay:
+    """تهريب حقول الرأس مرة واحدة — الرأس وتبويب الملخص يتشاركان النتيجة المخزَّنة"""
+    fnum = patient.get("file_number", "—")
+    return _patient_display(
+        patient.get("name", patient["id"]),
+        f"#{fnum}" if isinstance(fnum, int) else str(fnum),
+        str(patient.get("age", "—")),
+        patient.get("diagnosis_text", "—") or "—",
+        icd_text(tuple(patient.get("diagnosis_icd10", []))) or "—",
+    )
+
+
 def render_patient_file(patient: dict):
     pid = patient["id"]
 
@@ -1413,63 +1547,151 @@ def render_patient_file(patient: dict):
         st.rerun()
 
     # Patient header
-    name = patient.get("name", pid)
-    dx = patient.get("diagnosis_text", "—") or "—"
-    icd = ", ".join(patient.get("diagnosis_icd10", [])) or "—"
-    age = patient.get("age", "—")
+    esc = patient_display(patient)
     rehab_type = patient.get("rehabilitation_type", "")
-    rehab_type_ar = REHAB_TYPES.get(rehab_type, rehab_type) or "عام"
-
-    fnum = patient.get("file_number", "—")
-    fnum_display = f"#{fnum}" if isinstance(fnum, int) else fnum
+    rehab_type_ar = REHAB_TYPES_ESCAPED.get(rehab_type) or html.escape(rehab_type) or "عام"
 
     # Build meta line based on rehab type
-    meta_parts = [f"ملف {html.escape(str(fnum_display))}", f"العمر: {html.escape(str(age))}", f"التشخيص: {html.escape(dx)} ({html.escape(icd)})"]
+    meta_parts = [f"ملف {esc.file_number}", f"العمر: {esc.age}", f"التشخيص: {esc.diagnosis} ({esc.icd})"]
     if rehab_type == "vision" and patient.get("va_logmar") is not None:
         meta_parts.append(f"VA: {patient.get('va_logmar')} LogMAR")
-    meta_line = " · ".join(meta_parts)
 
-    st.markdown(f"""
-    <div class="patient-header">
-        <div>
-            <p class="ph-name">{html.escape(name)}</p>
-            <p class="ph-meta">{meta_line}</p>
-        </div>
-        <div class="ph-badges">
-            <span class="badge badge-green" style="font-size:12px;font-weight:900">{html.escape(str(fnum_display))}</span>
-            <span class="badge badge-blue">{html.escape(rehab_type_ar)}</span>
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(_PATIENT_HEADER_TPL.format(
+        name=esc.name, meta=" · ".join(meta_parts), fnum=esc.file_number, rehab_type=rehab_type_ar,
+    ), unsafe_allow_html=True)
 
-    # Tabs
-    tab_summary, tab_chat, tab_notes, tab_plans, tab_assess, tab_cdss, tab_intervene, tab_docs = st.tabs([
-        "الملخص", "المحادثة", "الملاحظات", "الخطط العلاجية",
-        "التقييمات", "CDSS", "التدخلات", "التقارير"
-    ])
-
-    with tab_summary:
-        render_summary_tab(patient)
-    with tab_chat:
-        render_chat_tab(patient)
-    with tab_notes:
-        render_notes_tab(patient)
-    with tab_plans:
-        render_treatment_plans_tab(patient)
-    with tab_assess:
-        render_assessments_tab(patient)
-    with tab_cdss:
-        render_cdss_tab(patient)
-    with tab_intervene:
-        render_interventions_tab(patient)
-    with tab_docs:
-        render_documents_tab(patient)
+    # Tabs — يُنفَّذ التبويب المختار وحده بدل تشغيل الثمانية في كل إعادة تشغيل
+    with st.container(key="patient_tabs"):
+        tab = st.radio("tabs", PATIENT_TAB_LABELS, horizontal=True,
+                       key=f"tab_{pid}", label_visibility="collapsed")
+    keep_tab_widget_state(pid, tab)
+    PATIENT_TABS[tab](patient)
 
 
 # ═══════════════════════════════════════════════════════════════
 # Tab: Summary
 # ═══════════════════════════════════════════════════════════════
 
+# سجلات المريض التي تظهر في "آخر الأنشطة" — الحقل: (النوع، الرمز، اللون)
+_ACTIVITY_SOURCES = {
+    "notes": ("ملاحظة", "N", "#2E8BC0"),
+    "assessment_results": ("تقييم", "A", "#7C3AED"),
+    "intervention_sessions": ("جلسة", "S", "#0B8457"),
+    "cdss_evaluations": ("CDSS", "C", "#D97706"),
+    "documents": ("وثيقة", "D", "#DC2626"),
+}
+_ACTIVITY_ITEM_TPL = (
+    '<div class="activity-item">'
+    '<div class="activity-dot" style="background:{color}"></div>'
+    '<div class="activity-content">'
+    '<span class="activity-type">{icon} {type}</span>'
+    '<div class="activity-desc">{desc}</div>'
+    '</div>'
+    '<span class="activity-time">{time}</span>'
+    '</div>'
+)
+# مفتاح فرز الأنشطة — itemgetter أسرع من lambda لكل عنصر
+_ACTIVITY_TIME = itemgetter(0)
+
+
+# خطوات مسار العمل: (الرقم، التسمية، السجل الذي يكملها) — HTML كل خطوة بحالتيها جاهز عند التحميل
+_WORKFLOW_STEPS = (
+    ("1", "التسجيل", None),
+    ("2", "التقييم", "assessment_results"),
+    ("3", "CDSS", "cdss_evaluations"),
+    ("4", "التدخل", "intervention_sessions"),
+    ("5", "التقارير", "documents"),
+)
+_WORKFLOW_STEP_TPL = (
+    '<div class="workflow-step {cls}">{connector}'
+    '<span class="workflow-step-icon">{icon}</span>'
+    '<span class="workflow-step-label">{label}</span>'
+    '</div>'
+)
+_WORKFLOW_STEP_HTML = tuple(
+    tuple(_WORKFLOW_STEP_TPL.format(
+        cls=cls, icon=icon, label=label,
+        connector='<span class="workflow-step-connector"></span>' if i > 0 else "",
+    ) for cls in ("", "done"))
+    for i, (icon, label, _) in enumerate(_WORKFLOW_STEPS)
+)
+_METRIC_ROW_TPL = (
+    '<div class="metric-row">'
+    '<div class="metric-card"><span class="metric-num">{}</span><span class="metric-label">التقييمات</span></div>'
+    '<div class="metric-card"><span class="metric-num">{}</span><span class="metric-label">الجلسات</span></div>'
+    '<div class="metric-card"><span class="metric-num">{}</span><span class="metric-label">الملاحظات</span></div>'
+    '<div class="metric-card"><span class="metric-num">{}</span><span class="metric-label">تقييمات CDSS</span></div>'
+    '</div>'
+)
+_INFO_ITEM_TPL = '<div class="info-item"><div class="info-label">{}</div><div class="info-value">{}</div></div>'
+_AI_SUMMARY_PROMPT_TPL = (
+    "لخّص حالة هذا المريض سريرياً واقترح الخطوات التالية:\n"
+    "الاسم: {name}, العمر: {age}\n"
+    "نوع التأهيل: {rehab}\n"
+    "التشخيص: {diagnosis} ({icd})\n"
+    "الأهداف الوظيفية: {goals}\n"
+    "عدد التقييمات: {n_assess}, عدد الجلسات: {n_sessions}, عدد الخطط العلاجية: {n_plans}"
+)
+
+
+class _SummaryError(Exception):
+    """رد تنبيه من المستشار (مفتاح/اتصال/حد الاستخدام) — يُعرض ولا يُخزَّن"""
+
+
+def _summary_prompt_fields(patient: dict, **extra) -> dict:
+    """حقول قوالب الطلبات (ملخص AI، الوثائق) — الحقول غير المستخدمة في القالب تُتجاهل"""
+    return {
+        "name": patient.get("name"),
+        "age": patient.get("age"),
+        "rehab": REHAB_TYPES.get(patient.get("rehabilitation_type", ""), "عام"),
+        "diagnosis": patient.get("diagnosis_text"),
+        "icd": icd_text(tuple(patient.get("diagnosis_icd10", []))),
+        "goals": goals_ar_text(tuple(patient.get("functional_goals", []))) or "لم تُحدد",
+        "n_assess": len(patient.get("assessment_results", [])),
+        "n_sessions": len(patient.get("intervention_sessions", [])),
+        "n_plans": len(patient.get("treatment_plans", [])),
+        **extra,
+    }
+
+
+def _build_summary_prompt(patient: dict) -> str:
+    return _AI_SUMMARY_PROMPT_TPL.format_map(_summary_prompt_fields(patient))
+
+
+@st.cache_data(ttl=600, max_entries=64, show_spinner=False)
+def _cached_ai_summary(pid: str, stamp: tuple, prompt: str, _patient: dict) -> str:
+    """ملخص AI للمريض — نقرة ثانية بلا تغيير في الملف خلال 10 دقائق لا تعيد استدعاء النموذج"""
+    text = chat_with_patient_context(prompt, _patient)["text"]
+    if text.startswith("[تنبيه]"):
+        raise _SummaryError(text)
+    return text
+
+
+def _activity_desc(source: str, entry: dict) -> str:
+    if source == "notes":
+        return entry.get("content", "")[:60]
+    if source == "cdss_evaluations":
+        return "تقييم CDSS"
+    return entry.get("type", "")
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def _recent_activities_html(pid: str, stamp: tuple, _patient: dict) -> str:
+    """أحدث 6 أنشطة — heapq.nlargest بدل فرز كل السجلات، مخزَّنة حسب (updated_at، أعداد السجلات)"""
+    latest = heapq.nlargest(6, chain.from_iterable(
+        ((e.get("timestamp", ""), source, e) for e in _patient.get(source, []))
+        for source in _ACTIVITY_SOURCES
+    ), key=_ACTIVITY_TIME)
+    parts = []
+    for ts, source, entry in latest:
+        atype, icon, color = _ACTIVITY_SOURCES[source]
+        parts.append(_ACTIVITY_ITEM_TPL.format(
+            color=color, icon=icon, type=atype,
+            desc=html.escape(_activity_desc(source, entry)), time=ts[:16],
+        ))
+    return "".join(parts)
+
+
 def render_summary_tab(patient: dict):
     n_assess = len(patient.get("assessment_results", []))
     n_sessions = len(patient.get("intervention_sessions", []))
@@ -1477,144 +1699,83 @@ def render_summary_tab(patient: dict):
     n_cdss = len(patient.get("cdss_evaluations", []))
 
     # Workflow progress bar
-    steps = [
-        ("1", "التسجيل", True),
-        ("2", "التقييم", n_assess > 0),
-        ("3", "CDSS", n_cdss > 0),
-        ("4", "التدخل", n_sessions > 0),
-        ("5", "التقارير", len(patient.get("documents", [])) > 0),
-    ]
-    steps_html = ""
-    for i, (icon, label, done) in enumerate(steps):
-        cls = "done" if done else ""
-        connector = f'<span class="workflow-step-connector"></span>' if i > 0 else ""
-        steps_html += f"""
-        <div class="workflow-step {cls}">
-            {connector}
-            <span class="workflow-step-icon">{icon}</span>
-            <span class="workflow-step-label">{label}</span>
-        </div>"""
+    steps_html = "".join(
+        step_html[source is None or bool(patient.get(source))]
+        for step_html, (_, _, source) in zip(_WORKFLOW_STEP_HTML, _WORKFLOW_STEPS)
+    )
     st.markdown(f'<div class="workflow-progress">{steps_html}</div>', unsafe_allow_html=True)
 
     # Metric cards
-    st.markdown(f"""
-    <div class="metric-row">
-        <div class="metric-card"><span class="metric-num">{n_assess}</span><span class="metric-label">التقييمات</span></div>
-        <div class="metric-card"><span class="metric-num">{n_sessions}</span><span class="metric-label">الجلسات</span></div>
-        <div class="metric-card"><span class="metric-num">{n_notes}</span><span class="metric-label">الملاحظات</span></div>
-        <div class="metric-card"><span class="metric-num">{n_cdss}</span><span class="metric-label">تقييمات CDSS</span></div>
-    </div>
-    """, unsafe_allow_html=True)
+    st.markdown(_METRIC_ROW_TPL.format(n_assess, n_sessions, n_notes, n_cdss), unsafe_allow_html=True)
 
     # Patient info grid — dynamic based on rehabilitation type
-    cog_map = {"normal": "طبيعي", "mild_impairment": "خفيف", "moderate_impairment": "متوسط", "severe_impairment": "شديد"}
-    cog_val = cog_map.get(patient.get('cognitive_status', 'normal'), '—')
+    cog_val = COG_STATE_LABELS.get(patient.get('cognitive_status', 'normal'), '—')
     rehab_type = patient.get("rehabilitation_type", "") or "—"
-    rehab_type_ar = REHAB_TYPES.get(rehab_type, rehab_type)
-    goals_ar = ", ".join(FUNCTIONAL_GOALS_AR.get(g, g) for g in patient.get("functional_goals", [])) or "—"
+    rehab_type_ar = REHAB_TYPES_ESCAPED.get(rehab_type) or html.escape(rehab_type)
+    goals_ar = goals_ar_text(tuple(patient.get("functional_goals", []))) or "—"
     n_plans = len(patient.get("treatment_plans", []))
 
-    fnum_s = patient.get("file_number", "—")
-    fnum_badge = f"#{fnum_s}" if isinstance(fnum_s, int) else str(fnum_s)
+    esc = patient_display(patient)
 
     # Core info items (always shown)
-    info_items = f"""
-            <div class="info-item"><div class="info-label">رقم الملف</div><div class="info-value" style="color:var(--secondary);font-weight:900;font-size:18px">{html.escape(fnum_badge)}</div></div>
-            <div class="info-item"><div class="info-label">نوع التأهيل</div><div class="info-value">{html.escape(rehab_type_ar)}</div></div>
-            <div class="info-item"><div class="info-label">التشخيص</div><div class="info-value">{html.escape(patient.get('diagnosis_text', '—') or '—')}</div></div>
-            <div class="info-item"><div class="info-label">ICD-10</div><div class="info-value">{html.escape(', '.join(patient.get('diagnosis_icd10', [])) or '—')}</div></div>"""
+    items = [
+        '<div class="info-item"><div class="info-label">رقم الملف</div><div class="info-value" '
+        f'style="color:var(--secondary);font-weight:900;font-size:18px">{esc.file_number}</div></div>',
+        _INFO_ITEM_TPL.format("نوع التأهيل", rehab_type_ar),
+        _INFO_ITEM_TPL.format("التشخيص", esc.diagnosis),
+        _INFO_ITEM_TPL.format("ICD-10", esc.icd),
+    ]
 
     # Specialty-specific items
     if rehab_type == "vision":
-        va_val = patient.get('va_logmar', '—')
-        vf_val = patient.get('visual_field_degrees', '—')
-        info_items += f"""
-            <div class="info-item"><div class="info-label">حدة الإبصار</div><div class="info-value">{html.escape(str(va_val))} LogMAR</div></div>
-            <div class="info-item"><div class="info-label">مجال الرؤية</div><div class="info-value">{html.escape(str(vf_val))} درجة</div></div>
-            <div class="info-item"><div class="info-label">نمط الفقد</div><div class="info-value">{html.escape(patient.get('vision_pattern', '—') or '—')}</div></div>"""
-    elif rehab_type in ("orthopedic", "pain"):
+        items.append(_INFO_ITEM_TPL.format("حدة الإبصار", f"{html.escape(str(patient.get('va_logmar', '—')))} LogMAR"))
+        items.append(_INFO_ITEM_TPL.format("مجال الرؤية", f"{html.escape(str(patient.get('visual_field_degrees', '—')))} درجة"))
+        items.append(_INFO_ITEM_TPL.format("نمط الفقد", html.escape(patient.get('vision_pattern', '—') or '—')))
+    elif rehab_type in ("orthopedic", "pain", "neuro"):
+        if rehab_type == "neuro":
+            affected = AFFECTED_SIDE_LABELS.get(patient.get("affected_side", ""), "—")
+            items.append(_INFO_ITEM_TPL.format("الجانب المصاب", affected))
         pain_scores = patient.get("pain_scores", [])
         last_pain = pain_scores[-1]["value"] if pain_scores else "—"
-        info_items += f"""
-            <div class="info-item"><div class="info-label">مستوى الألم (VAS)</div><div class="info-value">{html.escape(str(last_pain))}/10</div></div>"""
-    elif rehab_type == "neuro":
-        affected = {"right": "أيمن", "left": "أيسر", "bilateral": "ثنائي"}.get(patient.get("affected_side", ""), "—")
-        pain_scores = patient.get("pain_scores", [])
-        last_pain = pain_scores[-1]["value"] if pain_scores else "—"
-        info_items += f"""
-            <div class="info-item"><div class="info-label">الجانب المصاب</div><div class="info-value">{html.escape(str(affected))}</div></div>
-            <div class="info-item"><div class="info-label">مستوى الألم (VAS)</div><div class="info-value">{html.escape(str(last_pain))}/10</div></div>"""
+        items.append(_INFO_ITEM_TPL.format("مستوى الألم (VAS)", f"{html.escape(str(last_pain))}/10"))
     elif rehab_type == "cardiac":
-        nyha = patient.get("nyha_class", "—")
-        info_items += f"""
-            <div class="info-item"><div class="info-label">تصنيف NYHA</div><div class="info-value">{html.escape(str(nyha))}</div></div>"""
+        items.append(_INFO_ITEM_TPL.format("تصنيف NYHA", html.escape(str(patient.get("nyha_class", "—")))))
 
     # Common items (always shown)
-    info_items += f"""
-            <div class="info-item"><div class="info-label">الحالة الإدراكية</div><div class="info-value">{html.escape(cog_val)}</div></div>
-            <div class="info-item"><div class="info-label">PHQ-9</div><div class="info-value">{html.escape(str(patient.get('phq9_score', '—') or '—'))}</div></div>
-            <div class="info-item"><div class="info-label">الأهداف</div><div class="info-value">{html.escape(goals_ar)}</div></div>
-            <div class="info-item"><div class="info-label">الخطط العلاجية</div><div class="info-value">{n_plans}</div></div>
-            <div class="info-item"><div class="info-label">تاريخ الإنشاء</div><div class="info-value">{html.escape(patient.get('created_at', '—')[:10])}</div></div>"""
-
-    st.markdown(f"""
-    <div style="margin-top:4px">
-        <div style="font-size:15px;font-weight:800;color:var(--primary);margin-bottom:12px">المعلومات الأساسية</div>
-        <div class="info-grid">{info_items}
-        </div>
-    </div>
-    """, unsafe_allow_html=True)
+    items.append(_INFO_ITEM_TPL.format("الحالة الإدراكية", cog_val))
+    items.append(_INFO_ITEM_TPL.format("PHQ-9", html.escape(str(patient.get('phq9_score', '—') or '—'))))
+    items.append(_INFO_ITEM_TPL.format("الأهداف", html.escape(goals_ar)))
+    items.append(_INFO_ITEM_TPL.format("الخطط العلاجية", n_plans))
+    items.append(_INFO_ITEM_TPL.format("تاريخ الإنشاء", html.escape(patient.get('created_at', '—')[:10])))
+
+    st.markdown(
+        '<div style="margin-top:4px">'
+        '<div style="font-size:15px;font-weight:800;color:var(--primary);margin-bottom:12px">المعلومات الأساسية</div>'
+        f'<div class="info-grid">{"".join(items)}</div>'
+        '</div>', unsafe_allow_html=True)
 
     st.markdown("")
 
     # AI Summary button
     if st.button("توليد ملخص AI للمريض", key="ai_summary", type="primary"):
         with st.spinner("يحلل بيانات المريض..."):
-            r_type = REHAB_TYPES.get(patient.get("rehabilitation_type", ""), "عام")
-            goals_list = ", ".join(FUNCTIONAL_GOALS_AR.get(g, g) for g in patient.get("functional_goals", [])) or "لم تُحدد"
-            prompt = (
-                f"لخّص حالة هذا المريض سريرياً واقترح الخطوات التالية:\n"
-                f"الاسم: {patient.get('name')}, العمر: {patient.get('age')}\n"
-                f"نوع التأهيل: {r_type}\n"
-                f"التشخيص: {patient.get('diagnosis_text')} ({', '.join(patient.get('diagnosis_icd10', []))})\n"
-                f"الأهداف الوظيفية: {goals_list}\n"
-                f"عدد التقييمات: {len(patient.get('assessment_results', []))}, "
-                f"عدد الجلسات: {len(patient.get('intervention_sessions', []))}, "
-                f"عدد الخطط العلاجية: {len(patient.get('treatment_plans', []))}"
-            )
-            result = chat_with_patient_context(prompt, patient)
-            st.markdown(result["text"])
+            # الملخص مخزَّن حسب (المريض، updated_at، المحادثة، نص الطلب) — يتجدد عند أي تعديل على الملف
+            # أو رسالة جديدة (المحادثة تُلحق بسجلها دون تغيير updated_at وتُرسل للنموذج مع الطلب)
+            history = patient.get("chat_history") or ()
+            stamp = (patient.get("updated_at"), len(history), history[-1].get("time") if history else None)
+            try:
+                text = _cached_ai_summary(patient["id"], stamp, _build_summary_prompt(patient), patient)
+            except _SummaryError as e:
+                text = str(e)
+            st.markdown(text)
 
     # Recent activity timeline
-    all_activities = []
-    type_icons = {"ملاحظة": "N", "تقييم": "A", "جلسة": "S", "CDSS": "C", "وثيقة": "D"}
-    type_colors = {"ملاحظة": "#2E8BC0", "تقييم": "#7C3AED", "جلسة": "#0B8457", "CDSS": "#D97706", "وثيقة": "#DC2626"}
-    for n in patient.get("notes", []):
-        all_activities.append({"time": n.get("timestamp", ""), "type": "ملاحظة", "desc": n.get("content", "")[:60]})
-    for a in patient.get("assessment_results", []):
-        all_activities.append({"time": a.get("timestamp", ""), "type": "تقييم", "desc": a.get("type", "")})
-    for s in patient.get("intervention_sessions", []):
-        all_activities.append({"time": s.get("timestamp", ""), "type": "جلسة", "desc": s.get("type", "")})
-    for c in patient.get("cdss_evaluations", []):
-        all_activities.append({"time": c.get("timestamp", ""), "type": "CDSS", "desc": "تقييم CDSS"})
-    for d in patient.get("documents", []):
-        all_activities.append({"time": d.get("timestamp", ""), "type": "وثيقة", "desc": d.get("type", "")})
-
-    if all_activities:
-        all_activities.sort(key=lambda x: x["time"], reverse=True)
+    activities_html = _recent_activities_html(patient["id"], (
+        patient.get("updated_at"), tuple(len(patient.get(k, [])) for k in _ACTIVITY_SOURCES),
+    ), patient)
+    if activities_html:
         st.markdown('<div style="font-size:15px;font-weight:800;color:var(--primary);margin:20px 0 12px">آخر الأنشطة</div>', unsafe_allow_html=True)
-        for act in all_activities[:6]:
-            icon = type_icons.get(act["type"], "-")
-            color = type_colors.get(act["type"], "#718096")
-            st.markdown(f"""
-            <div class="activity-item">
-                <div class="activity-dot" style="background:{color}"></div>
-                <div class="activity-content">
-                    <span class="activity-type">{icon} {html.escape(act['type'])}</span>
-                    <div class="activity-desc">{html.escape(act['desc'])}</div>
-                </div>
-                <span class="activity-time">{html.escape(act['time'][:16])}</span>
-            </div>""", unsafe_allow_html=True)
+        st.markdown(activities_html, unsafe_allow_html=True)
     else:
         st.markdown("""
         <div class="empty-state">
@@ -1627,6 +1788,55 @@ def render_summary_tab(patient: dict):
 # Tab: Treatment Plans
 # ═══════════════════════════════════════════════════════════════
 
+PLAN_STATUS_AR = MappingProxyType({"active": "نشطة", "completed": "مكتملة", "cancelled": "ملغاة"})
+PLAN_STATUS_KEYS = MappingProxyType({v: k for k, v in PLAN_STATUS_AR.items()})
+
+
+def _plan_details_md(plan: dict) -> str:
+    """تفاصيل الخطة (أهداف، تدخلات، احتياطات، متابعة) ككتلة Markdown واحدة — استدعاء st.markdown واحد لكل خطة"""
+    sections = []
+
+    # Goals
+    goals = plan.get("goals", [])
+    if goals:
+        lines = ["**الأهداف:**"]
+        for g in goals:
+            timeframe = g.get("timeframe", "")
+            desc = g.get("description", str(g) if isinstance(g, str) else "")
+            tf_label = f" ({timeframe})" if timeframe else ""
+            lines.append(f"- {desc}{tf_label}")
+        sections.append("\n".join(lines))
+
+    # Interventions
+    interventions = plan.get("interventions", [])
+    if interventions:
+        lines = ["**التدخلات:**"]
+        for inv in interventions:
+            if isinstance(inv, dict):
+                freq = inv.get("frequency", "")
+                lines.append(f"- {inv.get('name', inv.get('type', ''))} — {freq}")
+            else:
+                lines.append(f"- {inv}")
+        sections.append("\n".join(lines))
+
+    # Precautions
+    precautions = plan.get("precautions", [])
+    if precautions:
+        sections.append("\n".join(["**الاحتياطات:**", *(f"- {pr}" for pr in precautions)]))
+
+    # Follow-up
+    followup = plan.get("follow_up_schedule", "")
+    if followup:
+        sections.append(f"**جدول المتابعة:** {followup}")
+
+    # Notes
+    notes = plan.get("notes", "")
+    if notes:
+        sections.append(f"**ملاحظات:** {notes}")
+
+    return "\n\n".join(sections)
+
+
 def render_treatment_plans_tab(patient: dict):
     pid = patient["id"]
     plans = patient.get("treatment_plans", [])
@@ -1643,99 +1853,97 @@ def render_treatment_plans_tab(patient: dict):
         return
 
     # Summary metrics
-    active_count = sum(1 for p in plans if p.get("status") == "active")
-    completed_count = sum(1 for p in plans if p.get("status") == "completed")
+    # عدّ الحالات في مرور واحد
+    status_counts = Counter(p.get("status") for p in plans)
     st.markdown(f"""
     <div class="metric-row">
         <div class="metric-card"><span class="metric-num">{len(plans)}</span><span class="metric-label">إجمالي الخطط</span></div>
-        <div class="metric-card"><span class="metric-num">{active_count}</span><span class="metric-label">نشطة</span></div>
-        <div class="metric-card"><span class="metric-num">{completed_count}</span><span class="metric-label">مكتملة</span></div>
+        <div class="metric-card"><span class="metric-num">{status_counts["active"]}</span><span class="metric-label">نشطة</span></div>
+        <div class="metric-card"><span class="metric-num">{status_counts["completed"]}</span><span class="metric-label">مكتملة</span></div>
     </div>
     """, unsafe_allow_html=True)
 
+    # الأحدث أولاً — نسخة معكوسة واحدة تشير إلى نفس قواميس الخطط، فالتعديل عليها يُحفظ مباشرة
+    newest = plans[::-1]
+
+    # حالة جميع الخطط في جدول واحد قابل للتعديل — بدل أزرار اكتمال/إلغاء/إعادة تفعيل لكل خطة
+    rows = [{
+        "plan": plan.get("plan_title", f"خطة #{len(plans) - i}"),
+        "created": plan.get("created_at", "")[:10],
+        "status": PLAN_STATUS_AR.get(plan.get("status", "active"), plan.get("status", "active")),
+    } for i, plan in enumerate(newest)]
+    edited = st.data_editor(rows, key=f"plan_status_{pid}_{len(plans)}", hide_index=True,
+        disabled=("plan", "created"), column_config={
+            "plan": st.column_config.TextColumn("الخطة"),
+            "created": st.column_config.TextColumn("التاريخ"),
+            "status": st.column_config.SelectboxColumn("الحالة", options=tuple(PLAN_STATUS_AR.values()), required=True),
+        })
+    changed = False
+    for plan, row, new_row in zip(newest, rows, edited):
+        if new_row["status"] != row["status"] and new_row["status"] in PLAN_STATUS_KEYS:
+            plan["status"] = PLAN_STATUS_KEYS[new_row["status"]]
+            changed = True
+    if changed:
+        save_patient(patient)
+        st.rerun()
+
     # Display each plan
-    for i, plan in enumerate(reversed(plans)):
-        plan_idx = len(plans) - 1 - i
+    for i, plan in enumerate(newest):
         status = plan.get("status", "active")
-        status_ar = {"active": "نشطة", "completed": "مكتملة", "cancelled": "ملغاة"}.get(status, status)
-        status_color = {"active": "green", "completed": "blue", "cancelled": "orange"}.get(status, "blue")
-        title = plan.get("plan_title", f"خطة #{plan_idx + 1}")
+        status_ar = PLAN_STATUS_AR.get(status, status)
+        title = plan.get("plan_title", f"خطة #{len(plans) - i}")
         r_type = REHAB_TYPES.get(plan.get("rehabilitation_type", ""), "عام")
         created = plan.get("created_at", "")[:10]
 
         with st.expander(f"{title} — {r_type} [{status_ar}] ({created})", expanded=(i == 0 and status == "active")):
-            # Goals
-            goals = plan.get("goals", [])
-            if goals:
-                st.markdown("**الأهداف:**")
-                for g in goals:
-                    timeframe = g.get("timeframe", "")
-                    desc = g.get("description", str(g) if isinstance(g, str) else "")
-                    tf_label = f" ({timeframe})" if timeframe else ""
-                    st.markdown(f"- {desc}{tf_label}")
-
-            # Interventions
-            interventions = plan.get("interventions", [])
-            if interventions:
-                st.markdown("**التدخلات:**")
-                for inv in interventions:
-                    if isinstance(inv, dict):
-                        freq = inv.get("frequency", "")
-                        st.markdown(f"- {inv.get('name', inv.get('type', ''))} — {freq}")
-                    else:
-                        st.markdown(f"- {inv}")
-
-            # Precautions
-            precautions = plan.get("precautions", [])
-            if precautions:
-                st.markdown("**الاحتياطات:**")
-                for pr in precautions:
-                    st.markdown(f"- {pr}")
-
-            # Follow-up
-            followup = plan.get("follow_up_schedule", "")
-            if followup:
-                st.markdown(f"**جدول المتابعة:** {followup}")
-
-            # Notes
-            notes = plan.get("notes", "")
-            if notes:
-                st.markdown(f"**ملاحظات:** {notes}")
-
-            # Status toggle
-            col1, col2, col3 = st.columns(3)
-            if status == "active":
-                if col1.button("اكتمال", key=f"plan_complete_{pid}_{plan_idx}"):
-                    patient["treatment_plans"][plan_idx]["status"] = "completed"
-                    save_patient(patient)
-                    st.session_state.patients[pid] = patient
-                    st.rerun()
-                if col2.button("إلغاء", key=f"plan_cancel_{pid}_{plan_idx}"):
-                    patient["treatment_plans"][plan_idx]["status"] = "cancelled"
-                    save_patient(patient)
-                    st.session_state.patients[pid] = patient
-                    st.rerun()
-            elif status in ("completed", "cancelled"):
-                if col1.button("إعادة تفعيل", key=f"plan_reactivate_{pid}_{plan_idx}"):
-                    patient["treatment_plans"][plan_idx]["status"] = "active"
-                    save_patient(patient)
-                    st.session_state.patients[pid] = patient
-                    st.rerun()
+            st.markdown(_plan_details_md(plan))
 
 
 # ═══════════════════════════════════════════════════════════════
 # Tab: Chat (Patient-Aware)
 # ═══════════════════════════════════════════════════════════════
 
+def chat_view(patient: dict, grow: bool = False) -> deque:
+    """نافذة عرض المحادثة (deque محدود) — تُبنى مرة لكل مريض وتُوسَّع عند طلب الأقدم"""
+    key = f"chat_view_{patient['id']}"
+    view = st.session_state.get(key)
+    if view is None or grow:
+        size = (view.maxlen if view is not None else 0) + CHAT_VIEW_SIZE
+        view = st.session_state[key] = deque(patient.get("chat_history", [])[-size:], maxlen=size)
+    return view
+
+
+def _encode_upload(uploaded_file) -> dict:
+    """صورة مرفقة → كتلة base64 — الصور الأكبر من IMAGE_MAX_SIDE تُصغَّر وتُعاد كـ JPEG قبل الترميز"""
+    ext = uploaded_file.name.rsplit(".", 1)[-1].lower()
+    media_type = IMAGE_MEDIA_TYPES.get(ext, "image/jpeg")
+    data = uploaded_file.getvalue()
+    if Image is not None:
+        try:
+            with Image.open(uploaded_file) as img:
+                if max(img.size) > IMAGE_MAX_SIDE:
+                    img.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE))
+                    buf = io.BytesIO()
+                    img.convert("RGB").save(buf, format="JPEG", quality=85, optimize=True)
+                    data, media_type = buf.getvalue(), "image/jpeg"
+        except (OSError, ValueError):
+            pass  # ملف لا يقرؤه Pillow — يُرسل كما هو
+    return {"media_type": media_type, "data": base64.b64encode(data).decode("ascii")}
+
+
 def render_chat_tab(patient: dict):
     pid = patient["id"]
     chat_history = patient.get("chat_history", [])
+    view = chat_view(patient)
 
     # Chat area — auto-start if no history
     chat_area = st.container()
     with chat_area:
-        if not chat_history:
-            st.markdown("""
+        # المقابلة الاستهلالية تُطلق مرة واحدة ثم تُعرض في نفس التشغيل — بدون st.rerun()
+        if not chat_history and not st.session_state.get(f"intake_{pid}"):
+            st.session_state[f"intake_{pid}"] = True
+            loading = st.empty()
+            loading.markdown("""
             <div class="welcome-container">
                 <div class="ai-loading">
                     <div class="ai-loading-dot"></div>
@@ -1749,76 +1957,95 @@ def render_chat_tab(patient: dict):
             """, unsafe_allow_html=True)
             # أرسل trigger تلقائي لـ Claude ليبدأ المقابلة الاستهلالية
             _send_chat_message(patient, "__START_INTAKE__")
-            st.rerun()
-        else:
-            for msg in chat_history:
-                render_message(msg)
-
-    # Input area
-    st.markdown('<div class="input-wrapper"><div class="input-card">', unsafe_allow_html=True)
-
-    uploaded_file = None
-    show_upload = st.checkbox("إرفاق صورة طبية", value=False, key=f"upload_{pid}")
-    if show_upload:
-        uploaded_file = st.file_uploader("ارفع صورة", type=["png", "jpg", "jpeg", "webp"], key=f"file_{pid}", label_visibility="collapsed")
-
-    user_input = st.text_area("رسالتك", placeholder="اكتب سؤالك السريري هنا…", key=f"input_{pid}", height=80, label_visibility="collapsed")
-
-    col_send, col_clear, _ = st.columns([2, 1, 4])
-    with col_send:
-        st.markdown('<div class="send-col">', unsafe_allow_html=True)
-        send_btn = st.button("إرسال ↗", key=f"send_{pid}", use_container_width=True)
-        st.markdown('</div>', unsafe_allow_html=True)
-    with col_clear:
-        st.markdown('<div class="clear-col">', unsafe_allow_html=True)
-        if st.button("مسح المحادثة", key=f"clear_{pid}", use_container_width=True):
-            patient["chat_history"] = []
-            save_patient(patient)
-            st.session_state.patients[pid] = patient
-            st.rerun()
-        st.markdown('</div>', unsafe_allow_html=True)
-
-    st.markdown('</div></div>', unsafe_allow_html=True)
+            loading.empty()
+            chat_history = patient["chat_history"]
+        if len(chat_history) > len(view):
+            if st.button(f"تحميل القديم ({len(chat_history) - len(view)})", key=f"chat_older_{pid}"):
+                chat_view(patient, grow=True)
+                st.rerun()
+        for i, msg in enumerate(view, len(chat_history) - len(view)):
+            render_message(msg, i)
+
+    # Input area — حاويات بمفاتيح تُنسَّق من static/app.css (st-key-*) بدل divs مفتوحة عبر markdown
+    with st.container(key="chat_input_area"):
+        uploaded_file = None
+        show_upload = st.checkbox("إرفاق صورة طبية", value=False, key=f"upload_{pid}")
+        if show_upload:
+            uploaded_file = st.file_uploader("ارفع صورة", type=["png", "jpg", "jpeg", "webp"], key=f"file_{pid}", label_visibility="collapsed")
+
+        user_input = st.text_area("رسالتك", placeholder="اكتب سؤالك السريري هنا…", key=f"input_{pid}", height=80, label_visibility="collapsed")
+
+        col_send, col_clear, _ = st.columns([2, 1, 4])
+        with col_send, st.container(key="chat_send_col"):
+            send_btn = st.button("إرسال ↗", key=f"send_{pid}", use_container_width=True)
+        with col_clear, st.container(key="chat_clear_col"):
+            if st.button("مسح المحادثة", key=f"clear_{pid}", use_container_width=True):
+                patient["chat_history"] = []
+                view.clear()
+                st.session_state.pop(f"intake_{pid}", None)
+                save_patient(patient)
+                st.rerun()
 
     if send_btn and user_input and user_input.strip():
         images = None
         if uploaded_file:
-            img_bytes = uploaded_file.read()
-            img_b64 = base64.standard_b64encode(img_bytes).decode("utf-8")
-            ext = uploaded_file.name.rsplit(".", 1)[-1].lower()
-            media_map = {"png": "image/png", "jpg": "image/jpeg", "jpeg": "image/jpeg", "webp": "image/webp"}
-            images = [{"media_type": media_map.get(ext, "image/jpeg"), "data": img_b64}]
+            images = [_encode_upload(uploaded_file)]
         # Show user message immediately + stream response
+        sent_at = datetime.now().strftime("%H:%M")
         with chat_area:
-            render_message({"role": "user", "content": user_input.strip(), "time": datetime.now().strftime("%H:%M"), "tool_calls": []})
+            render_message({"role": "user", "content": user_input.strip(), "time": sent_at, "tool_calls": []})
             stream_placeholder = st.empty()
-        _send_chat_message(patient, user_input.strip(), images, placeholder=stream_placeholder)
-        st.rerun()
+        reply_msg = _send_chat_message(patient, user_input.strip(), images, placeholder=stream_placeholder, sent_at=sent_at)
+        if reply_msg is None or reply_msg["tool_calls"]:
+            # رسالة مكررة أو أدوات قد تكون عدّلت الملف — إعادة تشغيل كاملة
+            st.rerun()
+        # الرد مرسوم بالفعل — يُستبدل نص البث بالفقاعة النهائية دون إعادة تشغيل
+        with stream_placeholder.container():
+            render_message(reply_msg, len(patient["chat_history"]) - 1)
 
 
-def _send_chat_message(patient: dict, text: str, images: list = None, placeholder=None):
+def _send_chat_message(patient: dict, text: str, images: list = None, placeholder=None,
+                       sent_at: str = None) -> dict | None:
+    """إرسال رسالة وإلحاق الرد بسجل المحادثة — يعيد رسالة الرد أو None إن كانت مكررة"""
     pid = patient["id"]
-    now = datetime.now().strftime("%H:%M")
+    # نقرة مزدوجة على "إرسال" — نفس النص خلال ثوانٍ لا يُرسل مرة ثانية
+    last_text, last_at = st.session_state.get(f"last_sent_{pid}", (None, 0.0))
+    sent_mono = time.monotonic()
+    if text == last_text and sent_mono - last_at < DUPLICATE_SEND_WINDOW:
+        return None
+    st.session_state[f"last_sent_{pid}"] = (text, sent_mono)
+    # أدوات المستشار تقرأ/تكتب ملفات المرضى مباشرة — تُنهى الكتابات المعلّقة أولاً
+    flush_dirty_patients()
+    _patient_writer().flush()
+
+    now = sent_at or datetime.now().strftime("%H:%M")
+    view = chat_view(patient)
     patient.setdefault("chat_history", [])
-    patient["chat_history"].append({"role": "user", "content": text, "time": now, "tool_calls": []})
+    user_msg = {"role": "user", "content": text, "time": now, "tool_calls": []}
+    patient["chat_history"].append(user_msg)
+    view.append(user_msg)
 
     try:
         if placeholder:
             result = chat_with_patient_context_stream(text, patient, images, placeholder)
         else:
             result = chat_with_patient_context(text, patient, images)
-        patient["chat_history"].append({
-            "role": "assistant", "content": result["text"],
-            "time": datetime.now().strftime("%H:%M"), "tool_calls": result["tool_calls"],
-        })
+        reply_text, reply_tools = result["text"], result["tool_calls"]
     except Exception as e:
-        patient["chat_history"].append({
-            "role": "assistant", "content": f"[تنبيه] حدث خطأ: {str(e)}",
-            "time": datetime.now().strftime("%H:%M"), "tool_calls": [],
-        })
+        reply_text, reply_tools = f"[تنبيه] حدث خطأ: {str(e)}", []
+    # وقت الرد يُؤخذ بعد انتهاء الاستدعاء — مرة واحدة لكلا المسارين
+    reply_msg = {
+        "role": "assistant", "content": reply_text,
+        "time": datetime.now().strftime("%H:%M"), "tool_calls": reply_tools,
+    }
+    patient["chat_history"].append(reply_msg)
+    view.append(reply_msg)
 
-    save_patient(patient)
-    st.session_state.patients[pid] = patient
+    # الرسالتان تُلحقان بسجل المحادثة؛ ملف المريض يُعاد حفظه فقط إن عدّلته الأدوات
+    # (record_treatment_plan يسجّله عبر _dirty_patients)
+    append_chat_turns(patient, (user_msg, reply_msg))
+    flush_dirty_patients()
+    return reply_msg
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -1829,20 +2056,20 @@ def render_notes_tab(patient: dict):
     pid = patient["id"]
     st.markdown("### الملاحظات السريرية")
 
-    note_type = st.selectbox("نوع الملاحظة", ["ملاحظة عامة", "تقييم", "متابعة", "إحالة"], key=f"nt_{pid}")
+    note_type = st.selectbox("نوع الملاحظة", NOTE_TYPES, key=f"nt_{pid}")
     note_content = st.text_area("محتوى الملاحظة", height=100, key=f"nc_{pid}")
 
     if st.button("+ إضافة ملاحظة", key=f"add_note_{pid}", type="primary"):
         if note_content.strip():
             patient.setdefault("notes", [])
             patient["notes"].append({
+                "id": uuid.uuid4().hex,
                 "timestamp": datetime.now().isoformat(),
                 "type": note_type,
                 "content": note_content.strip(),
                 "author": "clinician",
             })
             save_patient(patient)
-            st.session_state.patients[pid] = patient
             st.rerun()
         else:
             st.warning("يرجى كتابة محتوى الملاحظة")
@@ -1851,21 +2078,18 @@ def render_notes_tab(patient: dict):
     notes = patient.get("notes", [])
     if notes:
         st.markdown("---")
-        for i, note in enumerate(reversed(notes)):
-            idx = len(notes) - 1 - i
-            st.markdown(f"""
-            <div class="note-card">
-                <div class="note-card-header">
-                    <span class="note-card-type">{html.escape(note.get('type', ''))}</span>
-                    <span class="note-card-time">{html.escape(note.get('timestamp', '')[:16])}</span>
-                </div>
-                <div class="note-card-body">{html.escape(note.get('content', ''))}</div>
-            </div>""", unsafe_allow_html=True)
-            if st.button("حذف", key=f"del_note_{pid}_{idx}"):
-                patient["notes"].pop(idx)
-                save_patient(patient)
-                st.session_state.patients[pid] = patient
-                st.rerun()
+        limit = st.session_state.get(f"prev_limit_{pid}_notes", HISTORY_PAGE_SIZE)
+        # شريحة عكسية واحدة — الأحدث أولاً دون نسخ القائمة مرتين
+        notes_view = notes[:-limit - 1:-1]
+        # جميع بطاقات الصفحة في استدعاء markdown واحد — القالب وحده ثابت، وكل حقل محفوظ يُهرَّب
+        # (الملفات المستوردة أو المعدّلة يدوياً قد تحمل أي نص في النوع أو الوقت)
+        st.markdown("".join(_NOTE_CARD_TPL.format(
+            type=escape_cached(note.get("type", "")),
+            time=escape_cached(note.get("timestamp", "")[:16]),
+            body=escape_cached(note.get("content", "")),
+        ) for note in notes_view), unsafe_allow_html=True)
+        render_show_older(pid, "notes", len(notes), limit)
+        render_delete_notes(patient, notes_view)
     else:
         st.markdown("""
         <div class="empty-state">
@@ -1874,6 +2098,31 @@ def render_notes_tab(patient: dict):
         </div>""", unsafe_allow_html=True)
 
 
+def render_delete_notes(patient: dict, notes_view: list):
+    """حذف ملاحظات الصفحة المعروضة من جدول واحد بعمود تحديد — بدل زر حذف لكل ملاحظة"""
+    pid = patient["id"]
+    if not st.toggle("حذف ملاحظات", key=f"show_delete_notes_{pid}"):
+        return
+    rows = [{
+        "delete": False,
+        # ملاحظات قديمة بدون معرف — تُعطى معرفاً ثابتاً عند أول عرض
+        "id": note.setdefault("id", uuid.uuid4().hex),
+        "time": note.get("timestamp", "")[:16],
+        "note": note.get("content", "")[:80],
+    } for note in notes_view]
+    edited = st.data_editor(rows, key=f"delete_notes_{pid}_{len(patient['notes'])}", hide_index=True,
+        disabled=("time", "note"), column_order=("delete", "time", "note"), column_config={
+            "delete": st.column_config.CheckboxColumn("حذف"),
+            "time": st.column_config.TextColumn("الوقت"),
+            "note": st.column_config.TextColumn("الملاحظة"),
+        })
+    selected = {row["id"] for row in edited if row["delete"]}
+    if st.button(f"حذف المحدد ({len(selected)})", key=f"del_notes_{pid}", disabled=not selected):
+        patient["notes"] = [n for n in patient["notes"] if n.get("id") not in selected]
+        save_patient(patient)
+        st.rerun()
+
+
 # ═══════════════════════════════════════════════════════════════
 # Tab: Assessments (Patient-Aware)
 # ═══════════════════════════════════════════════════════════════
@@ -1886,18 +2135,18 @@ def render_assessments_tab(patient: dict):
     # Previous results
     prev = patient.get("assessment_results", [])
     if prev:
-        with st.expander(f"نتائج سابقة ({len(prev)} تقييم)", expanded=False):
-            for a in reversed(prev):
-                st.write(f"**{a.get('type', '')}** — {a.get('timestamp', '')[:16]}")
-                st.json(a.get("result", {}))
-                st.markdown("---")
-
-    assess_type = st.selectbox("نوع التقييم", ["fixation", "reading", "visual_search", "contrast"],
-        format_func=lambda x: {"fixation": "ثبات التثبيت (BCEA)", "reading": "سرعة القراءة (MNREAD)",
-            "visual_search": "المسح البصري", "contrast": "حساسية التباين"}.get(x, x), key=f"at_{pid}")
-
-    if assess_type == "fixation":
-        st.info("أدخل إحداثيات تتبع العين (X, Y) لجلستين.")
+        render_history(pid, "assessments", f"نتائج سابقة ({len(prev)} تقييم)", prev, _render_prev_result)
+
+    assess_type = st.selectbox("نوع التقييم", ASSESSMENT_TYPES,
+        format_func=ASSESSMENT_TYPE_LABELS.__getitem__, key=f"at_{pid}")
+
+    ASSESSMENT_PANELS[assess_type](patient)
+
+
+def _render_fixation_assessment(patient: dict):
+    pid = patient["id"]
+    st.info("أدخل إحداثيات تتبع العين (X, Y) لجلستين.")
+    with st.form(f"fix_form_{pid}"):
         col1, col2 = st.columns(2)
         with col1:
             s1x = st.text_input("Session 1 — X", "0.5, 0.7, -0.2, 1.2, 0.9, 0.3, -0.1, 0.8", key=f"fx1x_{pid}")
@@ -1905,70 +2154,139 @@ def render_assessments_tab(patient: dict):
         with col2:
             s2x = st.text_input("Session 2 — X", "0.1, 0.2, 0.0, -0.1, 0.1, 0.05, -0.05, 0.15", key=f"fx2x_{pid}")
             s2y = st.text_input("Session 2 — Y", "0.0, 0.1, -0.1, 0.0, 0.2, -0.05, 0.1, -0.1", key=f"fx2y_{pid}")
-        if st.button("تحليل التثبيت", key=f"run_fix_{pid}", type="primary"):
-            try:
-                params = {"assessment_type": "fixation", "action": "evaluate_progress",
-                    "session1_x": [float(x) for x in s1x.split(",")], "session1_y": [float(x) for x in s1y.split(",")],
-                    "session2_x": [float(x) for x in s2x.split(",")], "session2_y": [float(x) for x in s2y.split(",")]}
-                result = run_assessment(params)
-                c1, c2, c3 = st.columns(3)
-                c1.metric("BCEA قبل", f"{result['bcea_before']} deg²")
-                c2.metric("BCEA بعد", f"{result['bcea_after']} deg²")
-                c3.metric("التحسن", f"{result['improvement_pct']}%")
-                st.success(f"**الحالة:** {result['status_ar']} — **الإجراء:** {result['action_ar']}")
-                _save_assessment(patient, "fixation", result)
-            except Exception as e:
-                st.error(f"خطأ: {e}")
-
-    elif assess_type == "reading":
-        st.info("أدخل قراءات MNREAD.")
-        num = st.number_input("عدد القراءات", 3, 10, 5, key=f"mn_n_{pid}")
-        readings = []
+        submitted = st.form_submit_button("تحليل التثبيت", type="primary")
+    if submitted:
+        try:
+            (x1, y1), (x2, y2) = _parse_xy(s1x, s1y), _parse_xy(s2x, s2y)
+            params = {"assessment_type": "fixation", "action": "evaluate_progress",
+                "session1_x": x1, "session1_y": y1, "session2_x": x2, "session2_y": y2}
+            result = run_assessment(params)
+            _render_metrics(_FIXATION_METRICS, result)
+            st.success(f"**الحالة:** {result['status_ar']} — **الإجراء:** {result['action_ar']}")
+            _save_assessment(patient, "fixation", result)
+        except Exception as e:
+            st.error(f"خطأ: {e}")
+
+
+def _render_reading_assessment(patient: dict):
+    pid = patient["id"]
+    st.info("أدخل قراءات MNREAD.")
+    # عدد القراءات خارج النموذج — يحدد عدد الحقول فيجب أن يعيد الرسم فوراً
+    num = st.number_input("عدد القراءات", 3, 10, 5, key=f"mn_n_{pid}")
+    readings = []
+    with st.form(f"mn_form_{pid}"):
         for i in range(int(num)):
             cols = st.columns(3)
             size = cols[0].number_input(f"حجم {i+1} (LogMAR)", 0.0, 1.5, max(0.0, 1.0 - i * 0.2), 0.1, key=f"mn_s_{pid}_{i}")
             time_s = cols[1].number_input(f"زمن {i+1} (ث)", 1.0, 120.0, 5.0 + i * 3, 0.5, key=f"mn_t_{pid}_{i}")
             errs = cols[2].number_input(f"أخطاء {i+1}", 0, 10, min(i, 5), key=f"mn_e_{pid}_{i}")
             readings.append({"print_size_logmar": size, "reading_time_seconds": time_s, "word_errors": int(errs)})
-        if st.button("تحليل القراءة", key=f"run_mn_{pid}", type="primary"):
-            result = run_assessment({"assessment_type": "reading", "readings": readings})
-            c1, c2, c3 = st.columns(3)
-            c1.metric("MRS", f"{result['mrs_wpm']} WPM")
-            c2.metric("CPS", f"{result['cps_logmar']} LogMAR")
-            c3.metric("RA", f"{result['reading_acuity_logmar']} LogMAR")
-            _save_assessment(patient, "reading", result)
-
-    elif assess_type == "contrast":
-        st.info("أدخل استجابات Pelli-Robson.")
-        levels = [0.0, 0.15, 0.30, 0.45, 0.60, 0.75, 0.90, 1.05, 1.20, 1.35]
-        responses = []
+        submitted = st.form_submit_button("تحليل القراءة", type="primary")
+    if submitted:
+        result = run_assessment({"assessment_type": "reading", "readings": readings})
+        _render_metrics(_READING_METRICS, result)
+        _save_assessment(patient, "reading", result)
+
+
+def _render_contrast_assessment(patient: dict):
+    pid = patient["id"]
+    st.info("أدخل استجابات Pelli-Robson.")
+    responses = []
+    with st.form(f"cs_form_{pid}"):
         cols = st.columns(5)
-        for i, lvl in enumerate(levels):
+        for i, lvl in enumerate(PELLI_ROBSON_LEVELS):
             c = cols[i % 5]
             correct = c.number_input(f"LogCS {lvl}", 0, 3, 3 if i < 5 else 2, key=f"pr_{pid}_{i}")
             responses.append({"log_cs_level": lvl, "letters_correct": int(correct)})
-        if st.button("تحليل التباين", key=f"run_cs_{pid}", type="primary"):
-            result = run_assessment({"assessment_type": "contrast", "method": "pelli_robson", "responses": responses})
-            c1, c2 = st.columns(2)
-            c1.metric("LogCS", result["threshold_logcs"])
-            c2.metric("التصنيف", result["classification"]["label_ar"])
-            _save_assessment(patient, "contrast", result)
-
-    elif assess_type == "visual_search":
-        st.info("محاكاة اختبار شطب رقمي.")
+        submitted = st.form_submit_button("تحليل التباين", type="primary")
+    if submitted:
+        result = run_assessment({"assessment_type": "contrast", "method": "pelli_robson", "responses": responses})
+        c1, c2 = st.columns(2)
+        c1.metric("LogCS", result["threshold_logcs"])
+        c2.metric("التصنيف", result["classification"]["label_ar"])
+        _save_assessment(patient, "contrast", result)
+
+
+def _render_visual_search_assessment(patient: dict):
+    pid = patient["id"]
+    st.info("محاكاة اختبار شطب رقمي.")
+    with st.form(f"vs_form_{pid}"):
         diff = st.slider("الصعوبة", 1, 5, 2, key=f"vs_d_{pid}")
         targets = st.slider("الأهداف", 10, 40, 20, key=f"vs_t_{pid}")
-        if st.button("توليد اختبار", key=f"run_vs_{pid}", type="primary"):
-            result = run_assessment({"assessment_type": "visual_search", "action": "generate_trial", "difficulty": diff, "target_count": targets})
-            st.success(f"تم توليد {result['total_targets']} هدف + {result['total_distractors']} مشتت")
-            _save_assessment(patient, "visual_search", result)
+        submitted = st.form_submit_button("توليد اختبار", type="primary")
+    if submitted:
+        result = run_assessment({"assessment_type": "visual_search", "action": "generate_trial", "difficulty": diff, "target_count": targets})
+        st.success(f"تم توليد {result['total_targets']} هدف + {result['total_distractors']} مشتت")
+        _save_assessment(patient, "visual_search", result)
+
+
+# نموذج إدخال كل نوع تقييم — اختيار النوع يستدعي دالته مباشرة
+ASSESSMENT_PANELS = MappingProxyType({
+    "fixation": _render_fixation_assessment,
+    "reading": _render_reading_assessment,
+    "contrast": _render_contrast_assessment,
+    "visual_search": _render_visual_search_assessment,
+})
+
+
+def _parse_coords(text: str) -> np.ndarray:
+    """تحويل إحداثيات مفصولة بفواصل إلى مصفوفة أرقام عبر np.fromstring (تحليل في C)"""
+    with warnings.catch_warnings():
+        # إصدارات NumPy الأقدم تُصدر تحذيراً بدل الخطأ عند وجود قيم غير رقمية
+        warnings.simplefilter("error", DeprecationWarning)
+        try:
+            coords = np.fromstring(text, sep=",", dtype=np.float64)
+        except (ValueError, DeprecationWarning):
+            raise ValueError(f"إحداثيات غير صالحة: {text[:40]}") from None
+    # حقل فارغ أو نص بلا أرقام يعطي مصفوفة فارغة دون خطأ — وBCEA يحتاج 3 نقاط على الأقل
+    if coords.size < MIN_FIXATION_POINTS:
+        raise ValueError(f"يلزم {MIN_FIXATION_POINTS} إحداثيات على الأقل: {text[:40] or 'حقل فارغ'}")
+    # تُمرَّر المصفوفة كما هي إلى حساب BCEA دون تحويلها إلى قائمة Python
+    return coords
+
+
+def _parse_xy(x_text: str, y_text: str) -> tuple:
+    """إحداثيات X وY لجلسة تثبيت واحدة — بنفس العدد"""
+    x, y = _parse_coords(x_text), _parse_coords(y_text)
+    if x.size != y.size:
+        raise ValueError(f"عدد إحداثيات X ({x.size}) لا يساوي عدد إحداثيات Y ({y.size})")
+    return x, y
+
+
+# مؤشرات النتيجة: (العنوان، المفتاح، قالب التنسيق) — حلقة واحدة بدل استدعاءات metric مكررة
+_FIXATION_METRICS = (
+    ("BCEA قبل", "bcea_before", "{} deg²"),
+    ("BCEA بعد", "bcea_after", "{} deg²"),
+    ("التحسن", "improvement_pct", "{}%"),
+)
+_READING_METRICS = (
+    ("MRS", "mrs_wpm", "{} WPM"),
+    ("CPS", "cps_logmar", "{} LogMAR"),
+    ("RA", "reading_acuity_logmar", "{} LogMAR"),
+)
+_SCAN_METRICS = (
+    ("المحاولات", "total_trials", "{}"),
+    ("الدقة", "accuracy_pct", "{}%"),
+    ("أعلى صعوبة", "max_difficulty_reached", "{}"),
+    ("الانعكاسات", "total_reversals", "{}"),
+)
+_PERCEPTUAL_METRICS = (
+    ("المحاولات", "total_trials", "{}"),
+    ("الدقة", "accuracy_pct", "{}%"),
+    ("التباين النهائي", "ending_contrast", "{:.3f}"),
+)
+
+
+def _render_metrics(specs: tuple, data: dict):
+    """صف مؤشرات st.metric — عمود لكل عنصر في specs"""
+    for col, (label, key, fmt) in zip(st.columns(len(specs)), specs):
+        col.metric(label, fmt.format(data[key]))
 
 
 def _save_assessment(patient: dict, atype: str, result: dict):
     patient.setdefault("assessment_results", [])
     patient["assessment_results"].append({"timestamp": datetime.now().isoformat(), "type": atype, "result": result})
-    save_patient(patient)
-    st.session_state.patients[patient["id"]] = patient
+    mark_dirty(patient)
     st.success("تم حفظ نتيجة التقييم في ملف المريض")
 
 
@@ -1978,38 +2296,37 @@ def _save_assessment(patient: dict, atype: str, result: dict):
 
 def render_cdss_tab(patient: dict):
     pid = patient["id"]
+    vp = patient.get("vision_pattern")
+    default_vp = [vp] if vp else _EMPTY_DEFAULT
+    fg = patient.get("functional_goals") or _EMPTY_DEFAULT
     st.markdown("### نظام دعم القرار السريري (CDSS)")
     st.caption("يُملأ تلقائياً من بيانات المريض. يمكنك تعديل القيم قبل التقييم.")
 
     # Previous evaluations
     prev_cdss = patient.get("cdss_evaluations", [])
     if prev_cdss:
-        with st.expander(f"تقييمات سابقة ({len(prev_cdss)})", expanded=False):
-            for ev in reversed(prev_cdss):
-                st.write(f"**{ev.get('timestamp', '')[:16]}**")
-                recs = ev.get("result", {}).get("recommendations", [])
-                for r in recs[:3]:
-                    st.write(f"  - {r.get('technique_ar', r.get('technique', ''))}: أولوية {r.get('priority', '')}")
-                st.markdown("---")
+        render_history(pid, "cdss", f"تقييمات سابقة ({len(prev_cdss)})", prev_cdss, _render_prev_cdss)
 
-    col1, col2 = st.columns(2)
-    with col1:
-        va = st.number_input("VA (LogMAR)", -0.3, 3.0, float(patient.get("va_logmar", 1.0) or 1.0), 0.1, format="%.1f", key=f"cdss_va_{pid}")
-        icd_input = st.text_input("ICD-10", ", ".join(patient.get("diagnosis_icd10", [])), key=f"cdss_icd_{pid}")
-        phq9 = st.number_input("PHQ-9", 0, 27, int(patient.get("phq9_score", 0) or 0), key=f"cdss_phq_{pid}")
-    with col2:
-        patterns = st.multiselect("نمط الفقد", VISION_PATTERNS,
-            default=[patient.get("vision_pattern", "")] if patient.get("vision_pattern") else [], key=f"cdss_pat_{pid}")
-        goals = st.multiselect("الأهداف", FUNCTIONAL_GOALS,
-            default=patient.get("functional_goals", []),
-            format_func=lambda x: FUNCTIONAL_GOALS_AR.get(x, x), key=f"cdss_goals_{pid}")
-        cog = st.selectbox("الحالة الإدراكية", ["normal", "mild_impairment", "moderate_impairment", "severe_impairment"],
-            index=["normal", "mild_impairment", "moderate_impairment", "severe_impairment"].index(patient.get("cognitive_status", "normal")),
-            key=f"cdss_cog_{pid}")
-
-    language = st.radio("لغة التقرير", ["ar", "en"], horizontal=True, key=f"cdss_lang_{pid}")
-
-    if st.button("تشغيل تقييم CDSS", type="primary", key=f"cdss_run_{pid}"):
+    with st.form(f"cdss_form_{pid}"):
+        col1, col2 = st.columns(2)
+        with col1:
+            va = st.number_input("VA (LogMAR)", -0.3, 3.0, patient.get("va_logmar") or 1.0, 0.1, format="%.1f", key=f"cdss_va_{pid}")
+            icd_input = st.text_input("ICD-10", icd_text(tuple(patient.get("diagnosis_icd10", []))), key=f"cdss_icd_{pid}")
+            phq9 = st.number_input("PHQ-9", 0, 27, patient.get("phq9_score") or 0, key=f"cdss_phq_{pid}")
+        with col2:
+            patterns = st.multiselect("نمط الفقد", VISION_PATTERNS,
+                default=default_vp, key=f"cdss_pat_{pid}")
+            goals = st.multiselect("الأهداف", FUNCTIONAL_GOALS,
+                default=fg,
+                format_func=FUNCTIONAL_GOAL_LABELS.__getitem__, key=f"cdss_goals_{pid}")
+            cog = st.selectbox("الحالة الإدراكية", COG_STATES,
+                index=COG_INDEX.get(patient.get("cognitive_status", "normal"), 0),
+                key=f"cdss_cog_{pid}")
+
+        language = st.radio("لغة التقرير", REPORT_LANGUAGES, horizontal=True, key=f"cdss_lang_{pid}")
+        submitted = st.form_submit_button("تشغيل تقييم CDSS", type="primary")
+
+    if submitted:
         icd_list = [c.strip() for c in icd_input.split(",") if c.strip()]
         patient_data = {
             "age": patient.get("age", 60), "active_icd10": icd_list, "vision_patterns": patterns,
@@ -2024,8 +2341,7 @@ def render_cdss_tab(patient: dict):
                 # Save
                 patient.setdefault("cdss_evaluations", [])
                 patient["cdss_evaluations"].append({"timestamp": datetime.now().isoformat(), "result": result})
-                save_patient(patient)
-                st.session_state.patients[pid] = patient
+                mark_dirty(patient)
                 st.success("تم حفظ نتيجة CDSS في ملف المريض")
             except Exception as e:
                 st.error(f"خطأ: {e}")
@@ -2079,76 +2395,86 @@ def render_interventions_tab(patient: dict):
 
     prev = patient.get("intervention_sessions", [])
     if prev:
-        with st.expander(f"جلسات سابقة ({len(prev)})", expanded=False):
-            for s in reversed(prev):
-                st.write(f"**{s.get('type', '')}** — {s.get('timestamp', '')[:16]}")
-                st.json(s.get("result", {}))
-                st.markdown("---")
-
-    int_type = st.selectbox("نوع التدخل", ["scanning", "perceptual_learning", "device_routing", "visual_augmentation"],
-        format_func=lambda x: {"scanning": "تدريب المسح البصري", "perceptual_learning": "التعلم الإدراكي",
-            "device_routing": "التوجيه الذكي للمعدات", "visual_augmentation": "التعزيز البصري"}.get(x, x),
-        key=f"it_{pid}")
-
-    if int_type == "scanning":
-        col1, col2 = st.columns(2)
-        blind_side = col1.selectbox("الجانب الأعمى", ["right", "left"], key=f"sc_s_{pid}")
-        num_trials = col2.slider("المحاولات", 10, 50, 20, key=f"sc_n_{pid}")
-        if st.button("تشغيل", key=f"run_sc_{pid}", type="primary"):
-            result = run_intervention({"intervention_type": "scanning", "action": "simulate_session", "blind_side": blind_side, "num_trials": num_trials})
-            s = result["session_summary"]
-            c1, c2, c3, c4 = st.columns(4)
-            c1.metric("المحاولات", s["total_trials"]); c2.metric("الدقة", f"{s['accuracy_pct']}%")
-            c3.metric("أعلى صعوبة", s["max_difficulty_reached"]); c4.metric("الانعكاسات", s["total_reversals"])
-            _save_intervention(patient, "scanning", result)
-
-    elif int_type == "perceptual_learning":
-        col1, col2 = st.columns(2)
-        sc = col1.slider("تباين البداية", 0.1, 1.0, 1.0, 0.05, key=f"pl_c_{pid}")
-        num_t = col2.slider("المحاولات", 20, 100, 50, key=f"pl_n_{pid}")
-        if st.button("تشغيل", key=f"run_pl_{pid}", type="primary"):
-            result = run_intervention({"intervention_type": "perceptual_learning", "action": "simulate_session", "starting_contrast": sc, "num_trials": num_t})
-            s = result["session_summary"]
-            c1, c2, c3 = st.columns(3)
-            c1.metric("المحاولات", s["total_trials"]); c2.metric("الدقة", f"{s['accuracy_pct']}%")
-            c3.metric("التباين النهائي", f"{s['ending_contrast']:.3f}")
-            _save_intervention(patient, "perceptual_learning", result)
-
-    elif int_type == "device_routing":
+        render_history(pid, "interventions", f"جلسات سابقة ({len(prev)})", prev, _render_prev_result)
+
+    int_type = st.selectbox("نوع التدخل", INTERVENTION_TYPES,
+        format_func=INTERVENTION_TYPE_LABELS.__getitem__, key=f"it_{pid}")
+
+    INTERVENTION_PANELS[int_type](patient)
+
+
+def _render_scanning_intervention(patient: dict):
+    pid = patient["id"]
+    col1, col2 = st.columns(2)
+    blind_side = col1.selectbox("الجانب الأعمى", BLIND_SIDES, key=f"sc_s_{pid}")
+    num_trials = col2.slider("المحاولات", 10, 50, 20, key=f"sc_n_{pid}")
+    if st.button("تشغيل", key=f"run_sc_{pid}", type="primary"):
+        result = run_intervention({"intervention_type": "scanning", "action": "simulate_session", "blind_side": blind_side, "num_trials": num_trials})
+        s = result["session_summary"]
+        _render_metrics(_SCAN_METRICS, s)
+        _save_intervention(patient, "scanning", result)
+
+
+def _render_perceptual_learning_intervention(patient: dict):
+    pid = patient["id"]
+    col1, col2 = st.columns(2)
+    sc = col1.slider("تباين البداية", 0.1, 1.0, 1.0, 0.05, key=f"pl_c_{pid}")
+    num_t = col2.slider("المحاولات", 20, 100, 50, key=f"pl_n_{pid}")
+    if st.button("تشغيل", key=f"run_pl_{pid}", type="primary"):
+        result = run_intervention({"intervention_type": "perceptual_learning", "action": "simulate_session", "starting_contrast": sc, "num_trials": num_t})
+        s = result["session_summary"]
+        _render_metrics(_PERCEPTUAL_METRICS, s)
+        _save_intervention(patient, "perceptual_learning", result)
+
+
+def _render_device_routing_intervention(patient: dict):
+    pid = patient["id"]
+    with st.form(f"dr_form_{pid}"):
         col1, col2 = st.columns(2)
-        va = col1.number_input("VA", 0.0, 3.0, float(patient.get("va_logmar", 1.0) or 1.0), 0.1, key=f"dr_va_{pid}")
-        vf = col2.number_input("مجال الرؤية", 0.0, 180.0, float(patient.get("visual_field_degrees", 60) or 60), 5.0, key=f"dr_vf_{pid}")
+        va = col1.number_input("VA", 0.0, 3.0, patient.get("va_logmar") or 1.0, 0.1, key=f"dr_va_{pid}")
+        vf = col2.number_input("مجال الرؤية", 0.0, 180.0, patient.get("visual_field_degrees") or 60.0, 5.0, key=f"dr_vf_{pid}")
         cog = st.checkbox("تدهور إدراكي", value=patient.get("cognitive_status", "normal") != "normal", key=f"dr_cog_{pid}")
-        dr_goals = st.multiselect("الأهداف", FUNCTIONAL_GOALS, default=patient.get("functional_goals", []),
-            format_func=lambda x: FUNCTIONAL_GOALS_AR.get(x, x), key=f"dr_g_{pid}")
-        if st.button("توصية الجهاز", key=f"run_dr_{pid}", type="primary"):
-            result = run_intervention({"intervention_type": "device_routing", "va_logmar": va, "visual_field_degrees": vf,
-                "has_cognitive_decline": cog, "functional_goals": dr_goals, "budget_usd": 5000})
-            for w in result.get("guardrail_warnings", []):
-                st.warning(f"[تنبيه] {w.get('message_ar', w)}")
-            dev = result.get("primary_device")
-            if dev:
-                st.success(f"**الجهاز:** {dev['name_ar']} ({dev['name']}) — ${dev['price_usd']}")
-                st.info(result.get("justification_ar", ""))
-            _save_intervention(patient, "device_routing", result)
-
-    elif int_type == "visual_augmentation":
-        st.info("محاكاة معالجة صورة لأنماط ضعف البصر.")
-        if st.button("تشغيل العرض", key=f"run_va_{pid}", type="primary"):
-            result = run_intervention({"intervention_type": "visual_augmentation", "action": "demo"})
-            for mode, data in result.get("demo_results", {}).items():
-                if mode == "environment_analysis":
-                    st.write(f"**تحليل البيئة:** إضاءة {data.get('estimated_lux', 'N/A')} لوكس")
-                else:
-                    st.write(f"**{mode}:** تم المعالجة تم")
-            _save_intervention(patient, "visual_augmentation", result)
+        dr_goals = st.multiselect("الأهداف", FUNCTIONAL_GOALS, default=patient.get("functional_goals") or _EMPTY_DEFAULT,
+            format_func=FUNCTIONAL_GOAL_LABELS.__getitem__, key=f"dr_g_{pid}")
+        submitted = st.form_submit_button("توصية الجهاز", type="primary")
+    if submitted:
+        result = run_intervention({"intervention_type": "device_routing", "va_logmar": va, "visual_field_degrees": vf,
+            "has_cognitive_decline": cog, "functional_goals": dr_goals, "budget_usd": 5000})
+        for w in result.get("guardrail_warnings", []):
+            st.warning(f"[تنبيه] {w.get('message_ar', w)}")
+        dev = result.get("primary_device")
+        if dev:
+            st.success(f"**الجهاز:** {dev['name_ar']} ({dev['name']}) — ${dev['price_usd']}")
+            st.info(result.get("justification_ar", ""))
+        _save_intervention(patient, "device_routing", result)
+
+
+def _render_visual_augmentation_intervention(patient: dict):
+    pid = patient["id"]
+    st.info("محاكاة معالجة صورة لأنماط ضعف البصر.")
+    if st.button("تشغيل العرض", key=f"run_va_{pid}", type="primary"):
+        result = run_intervention({"intervention_type": "visual_augmentation", "action": "demo"})
+        for mode, data in result.get("demo_results", {}).items():
+            if mode == "environment_analysis":
+                st.write(f"**تحليل البيئة:** إضاءة {data.get('estimated_lux', 'N/A')} لوكس")
+            else:
+                st.write(f"**{mode}:** تم المعالجة تم")
+        _save_intervention(patient, "visual_augmentation", result)
+
+
+# نموذج تشغيل كل نوع تدخل — اختيار النوع يستدعي دالته مباشرة
+INTERVENTION_PANELS = MappingProxyType({
+    "scanning": _render_scanning_intervention,
+    "perceptual_learning": _render_perceptual_learning_intervention,
+    "device_routing": _render_device_routing_intervention,
+    "visual_augmentation": _render_visual_augmentation_intervention,
+})
 
 
 def _save_intervention(patient: dict, itype: str, result: dict):
     patient.setdefault("intervention_sessions", [])
     patient["intervention_sessions"].append({"timestamp": datetime.now().isoformat(), "type": itype, "result": result})
-    save_patient(patient)
-    st.session_state.patients[patient["id"]] = patient
+    mark_dirty(patient)
     st.success("تم حفظ نتيجة الجلسة في ملف المريض")
 
 
@@ -2156,6 +2482,33 @@ def _save_intervention(patient: dict, itype: str, result: dict):
 # Tab: Documents
 # ═══════════════════════════════════════════════════════════════
 
+# قالب الطلب لكل نوع وثيقة — يُملأ من _summary_prompt_fields
+_DOC_PROMPT_TPL = MappingProxyType({
+    "تقرير شامل": (
+        "أنشئ تقريراً سريرياً شاملاً لهذا المريض بصيغة SOAP.\n"
+        "اسم المريض: {name}, العمر: {age}\n"
+        "نوع التأهيل: {rehab}\n"
+        "التشخيص: {diagnosis}\n"
+        "الأهداف: {goals}\n"
+        "عدد التقييمات: {n_assess}\n"
+        "عدد الجلسات: {n_sessions}\n"
+        "عدد الخطط العلاجية: {n_plans}"
+    ),
+    "خطاب إحالة": (
+        "أنشئ خطاب إحالة لتخصص {specialty} لهذا المريض.\n"
+        "اسم المريض: {name}, العمر: {age}\n"
+        "نوع التأهيل: {rehab}\n"
+        "التشخيص: {diagnosis}"
+    ),
+    "خطة علاجية": (
+        "أنشئ خطة علاجية تفصيلية لهذا المريض.\n"
+        "نوع التأهيل: {rehab}\n"
+        "التشخيص: {diagnosis}\n"
+        "الأهداف: {goals}"
+    ),
+})
+
+
 def render_documents_tab(patient: dict):
     pid = patient["id"]
     st.markdown("### التقارير والوثائق")
@@ -2163,62 +2516,90 @@ def render_documents_tab(patient: dict):
 
     prev_docs = patient.get("documents", [])
     if prev_docs:
-        with st.expander(f"وثائق سابقة ({len(prev_docs)})", expanded=False):
-            for d in reversed(prev_docs):
-                st.write(f"**{d.get('type', '')}** — {d.get('timestamp', '')[:16]}")
-                st.markdown(d.get("content", ""))
-                st.markdown("---")
+        render_history(pid, "documents", f"وثائق سابقة ({len(prev_docs)})", prev_docs, _render_prev_document)
 
-    doc_type = st.selectbox("نوع الوثيقة", ["تقرير شامل", "خطاب إحالة", "خطة علاجية"], key=f"doc_type_{pid}")
+    doc_type = st.selectbox("نوع الوثيقة", DOC_TYPES, key=f"doc_type_{pid}")
 
+    specialty = None
     if doc_type == "خطاب إحالة":
-        specialty = st.selectbox("التخصص", ["ophthalmology", "neurology", "orthopedics", "cardiology",
-            "pulmonology", "psychiatry", "psychology", "pediatrics", "ot", "om",
-            "social_work", "optometry", "pain_management"], key=f"ref_spec_{pid}")
+        specialty = st.selectbox("التخصص", REFERRAL_SPECIALTIES, key=f"ref_spec_{pid}")
 
     if st.button(f"توليد {doc_type}", type="primary", key=f"gen_doc_{pid}"):
-        with st.spinner("يولد الوثيقة..."):
-            r_type = REHAB_TYPES.get(patient.get("rehabilitation_type", ""), "عام")
-            goals_str = ", ".join(FUNCTIONAL_GOALS_AR.get(g, g) for g in patient.get("functional_goals", [])) or "لم تُحدد"
-            if doc_type == "تقرير شامل":
-                prompt = (f"أنشئ تقريراً سريرياً شاملاً لهذا المريض بصيغة SOAP.\n"
-                    f"اسم المريض: {patient.get('name')}, العمر: {patient.get('age')}\n"
-                    f"نوع التأهيل: {r_type}\n"
-                    f"التشخيص: {patient.get('diagnosis_text')}\n"
-                    f"الأهداف: {goals_str}\n"
-                    f"عدد التقييمات: {len(patient.get('assessment_results', []))}\n"
-                    f"عدد الجلسات: {len(patient.get('intervention_sessions', []))}\n"
-                    f"عدد الخطط العلاجية: {len(patient.get('treatment_plans', []))}")
-            elif doc_type == "خطاب إحالة":
-                prompt = (f"أنشئ خطاب إحالة لتخصص {specialty} لهذا المريض.\n"
-                    f"اسم المريض: {patient.get('name')}, العمر: {patient.get('age')}\n"
-                    f"نوع التأهيل: {r_type}\n"
-                    f"التشخيص: {patient.get('diagnosis_text')}")
-            else:
-                prompt = (f"أنشئ خطة علاجية تفصيلية لهذا المريض.\n"
-                    f"نوع التأهيل: {r_type}\n"
-                    f"التشخيص: {patient.get('diagnosis_text')}\n"
-                    f"الأهداف: {goals_str}")
-
-            result = chat_with_patient_context(prompt, patient)
-            st.markdown(result["text"])
-
-            patient.setdefault("documents", [])
-            patient["documents"].append({
-                "timestamp": datetime.now().isoformat(), "type": doc_type, "content": result["text"],
-            })
-            save_patient(patient)
-            st.session_state.patients[pid] = patient
-            st.success("تم حفظ الوثيقة في ملف المريض")
+        prompt = _DOC_PROMPT_TPL[doc_type].format_map(_summary_prompt_fields(patient, specialty=specialty))
+        # أدوات المستشار تقرأ/تكتب ملفات المرضى مباشرة — تُنهى الكتابات المعلّقة أولاً كما في المحادثة
+        flush_dirty_patients()
+        _patient_writer().flush()
+        # الوثيقة تُبث في العنصر أثناء التوليد بدل انتظار الرد كاملاً
+        placeholder = st.empty()
+        placeholder.markdown("*يولد الوثيقة...*")
+        result = chat_with_patient_context_stream(prompt, patient, placeholder=placeholder)
+        # النص النهائي (أو رسالة التنبيه إن لم يبدأ البث)
+        placeholder.markdown(result["text"])
+
+        patient.setdefault("documents", [])
+        patient["documents"].append({
+            "timestamp": datetime.now().isoformat(), "type": doc_type, "content": result["text"],
+        })
+        mark_dirty(patient)
+        st.success("تم حفظ الوثيقة في ملف المريض")
+
+
+# ترتيب تبويبات ملف المريض ودالة عرض كل منها
+PATIENT_TABS = {
+    "الملخص": render_summary_tab,
+    "المحادثة": render_chat_tab,
+    "الملاحظات": render_notes_tab,
+    "الخطط العلاجية": render_treatment_plans_tab,
+    "التقييمات": render_assessments_tab,
+    "CDSS": render_cdss_tab,
+    "التدخلات": render_interventions_tab,
+    "التقارير": render_documents_tab,
+}
+PATIENT_TAB_LABELS = tuple(PATIENT_TABS)
+
+# حقول الإدخال في كل تبويب — Streamlit يحذف حالة أي ويدجت لم يُرسم في الدورة، فتُعاد تعيين
+# قيم التبويبات غير المعروضة لتبقى المسودات والاختيارات عند العودة (الأزرار والمحررات مستثناة).
+# المفتاح المنتهي بـ "*" بادئة لحقول مفهرسة بالصف (قراءات MNREAD، استجابات Pelli-Robson)
+TAB_WIDGET_KEYS = MappingProxyType({
+    "المحادثة": ("input_{pid}", "upload_{pid}"),
+    "الملاحظات": ("nt_{pid}", "nc_{pid}", "show_delete_notes_{pid}"),
+    "التقييمات": ("at_{pid}", "show_prev_{pid}_assessments", "fx1x_{pid}", "fx1y_{pid}",
+                  "fx2x_{pid}", "fx2y_{pid}", "mn_n_{pid}", "mn_s_{pid}_*", "mn_t_{pid}_*",
+                  "mn_e_{pid}_*", "pr_{pid}_*", "vs_d_{pid}", "vs_t_{pid}"),
+    "CDSS": ("show_prev_{pid}_cdss", "cdss_va_{pid}", "cdss_icd_{pid}", "cdss_phq_{pid}",
+             "cdss_pat_{pid}", "cdss_goals_{pid}", "cdss_cog_{pid}", "cdss_lang_{pid}"),
+    "التدخلات": ("it_{pid}", "show_prev_{pid}_interventions", "sc_s_{pid}", "sc_n_{pid}",
+                 "pl_c_{pid}", "pl_n_{pid}", "dr_va_{pid}", "dr_vf_{pid}", "dr_g_{pid}", "dr_cog_{pid}"),
+    "التقارير": ("show_prev_{pid}_documents", "doc_type_{pid}", "ref_spec_{pid}"),
+})
+
+
+def keep_tab_widget_state(pid: str, active_tab: str):
+    """إبقاء قيم حقول التبويبات التي زارها المستخدم — المفاتيح الموجودة فقط، والتبويب المعروض يرسم حقوله بنفسه"""
+    state = st.session_state
+    prefixes = []
+    for tab, keys in TAB_WIDGET_KEYS.items():
+        if tab == active_tab:
+            continue
+        for key in keys:
+            key = key.format(pid=pid)
+            if key.endswith("*"):
+                prefixes.append(key[:-1])
+            elif key in state:
+                state[key] = state[key]
+    if prefixes:
+        # مرور واحد على مفاتيح الجلسة لكل البادئات
+        prefixes = tuple(prefixes)
+        for key in [k for k in state.keys() if k.startswith(prefixes)]:
+            state[key] = state[key]
 
 
 # ═══════════════════════════════════════════════════════════════
 # Sidebar
 # ═══════════════════════════════════════════════════════════════
 
-def render_sidebar():
-    with st.sidebar:
-        st.markdown("""
+# رأس الشريط الجانبي ثابت (SVG متحرك) — نص واحد على مستوى الوحدة يُمرَّر كما هو
+_SIDEBAR_HEADER_HTML = """
         <div class="sb-header">
             <div class="sb-logo-wrap">
               <svg width="72" height="72" viewBox="0 0 100 100" xmlns="http://www.w3.org/2000/svg">
@@ -2249,10 +2630,20 @@ def render_sidebar():
             <div class="sb-model-badge">Claude Sonnet 4.6 · Extended Thinking</div>
         </div>
         <div class="sb-body">
-        """, unsafe_allow_html=True)
+        """
+
+# بطاقات الأدوات لا تتغير بين الدورات — تُبنى مرة واحدة عند التحميل
+_TOOL_CHIPS_HTML = "".join(
+    _TOOL_CHIP_TPL.format(icon=icon, name=name) for icon, name in TOOLS_MANIFEST_ESCAPED
+)
+
+
+def render_sidebar():
+    with st.sidebar:
+        st.markdown(_SIDEBAR_HEADER_HTML, unsafe_allow_html=True)
 
         # API Status
-        api_key = os.environ.get("ANTHROPIC_API_KEY", "")
+        api_key = get_api_key()
         if api_key:
             st.markdown('<div style="text-align:center;margin-bottom:12px"><span class="badge badge-green">● API متصل</span></div>', unsafe_allow_html=True)
         else:
@@ -2269,13 +2660,7 @@ def render_sidebar():
 
         # Tools
         st.markdown('<div class="sb-section-label">الأدوات المتاحة</div>', unsafe_allow_html=True)
-        for icon, name, _ in TOOLS_MANIFEST:
-            st.markdown(f"""
-            <div class="tool-chip">
-                <span class="tool-chip-icon">{icon}</span>
-                <span class="tool-chip-name">{name}</span>
-                <span class="tool-chip-badge">نشط</span>
-            </div>""", unsafe_allow_html=True)
+        st.markdown(_TOOL_CHIPS_HTML, unsafe_allow_html=True)
 
         st.markdown('</div>', unsafe_allow_html=True)
 
@@ -2286,14 +2671,19 @@ def render_sidebar():
 
 render_sidebar()
 
-if st.session_state.current_page == "patient_file" and st.session_state.current_patient_id:
-    pid = st.session_state.current_patient_id
-    patient = st.session_state.patients.get(pid)
-    if patient:
-        render_patient_file(patient)
+# الحفظ المؤجَّل (mark_dirty) يتم عند انتهاء الدورة — بما فيها الخروج عبر st.rerun
+try:
+    if st.session_state.current_page == "patient_file" and st.session_state.current_patient_id:
+        pid = st.session_state.current_patient_id
+        # نفس الكائن المخزَّن في الجلسة — التبويبات تعدّله في مكانه دون إعادة إسناد
+        patient = get_patient(pid)
+        if patient:
+            render_patient_file(patient)
+        else:
+            st.error("المريض غير موجود")
+            st.session_state.current_page = "registry"
+            st.rerun()
     else:
-        st.error("المريض غير موجود")
-        st.session_state.current_page = "registry"
-        st.rerun()
-else:
-    render_patient_registry()
+        render_patient_registry()
+finally:
+    flush_dirty_patients()
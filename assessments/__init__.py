@@ -6,12 +6,45 @@ Digital Biomarkers لتقييم حالة المريض البصرية:
   2. DigitalMNREAD — سرعة القراءة + CPS + RA
   3. VisualSearchAssessment — المسح البصري والإهمال
   4. ContrastSensitivityAssessment — حساسية التباين (LogCS)
+
+الوحدات الفرعية تُستورد عند أول استخدام (PEP 562) — لا يُحمَّل إلا التقييم المطلوب.
 """
 
-from .fixation_analyzer import run_fixation_assessment, FixationStabilityAnalyzer
-from .reading_speed import run_reading_assessment, DigitalMNREAD
-from .visual_search import run_visual_search_assessment, VisualSearchAssessment
-from .contrast_sensitivity import run_contrast_assessment, ContrastSensitivityAssessment
+import importlib
+
+# الاسم العام → الوحدة الفرعية التي تعرّفه
+_LAZY = {
+    "run_fixation_assessment": "fixation_analyzer",
+    "FixationStabilityAnalyzer": "fixation_analyzer",
+    "run_reading_assessment": "reading_speed",
+    "DigitalMNREAD": "reading_speed",
+    "run_visual_search_assessment": "visual_search",
+    "VisualSearchAssessment": "visual_search",
+    "run_contrast_assessment": "contrast_sensitivity",
+    "ContrastSensitivityAssessment": "contrast_sensitivity",
+}
+
+# نوع → اسم دالة التشغيل (بحث واحد في القاموس بدل سلسلة مقارنات)
+_ASSESSMENT_DISPATCH = {
+    "fixation": "run_fixation_assessment",
+    "reading": "run_reading_assessment",
+    "visual_search": "run_visual_search_assessment",
+    "contrast": "run_contrast_assessment",
+}
+
+
+def __getattr__(name: str):
+    module = _LAZY.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    obj = getattr(importlib.import_module(f".{module}", __name__), name)
+    # يُخزَّن في الحزمة — الوصول التالي لا يمر بـ __getattr__
+    globals()[name] = obj
+    return obj
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY))
 
 
 def run_assessment(params: dict) -> dict:
@@ -24,20 +57,14 @@ def run_assessment(params: dict) -> dict:
           - ... باقي البارامترات حسب النوع
     """
     atype = params.get("assessment_type", "")
-
-    if atype == "fixation":
-        return run_fixation_assessment(params)
-    elif atype == "reading":
-        return run_reading_assessment(params)
-    elif atype == "visual_search":
-        return run_visual_search_assessment(params)
-    elif atype == "contrast":
-        return run_contrast_assessment(params)
-    else:
+    handler = _ASSESSMENT_DISPATCH.get(atype)
+    if handler is None:
         return {
             "error": f"Unknown assessment_type: {atype}",
-            "available_types": ["fixation", "reading", "visual_search", "contrast"],
+            "available_types": list(_ASSESSMENT_DISPATCH),
         }
+    run = globals().get(handler) or __getattr__(handler)
+    return run(params)
 
 __all__ = [
     "run_assessment",
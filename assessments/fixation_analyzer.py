@@ -10,7 +10,17 @@ Fixation Stability Analyzer — محلل ثبات التثبيت
 """
 
 import math
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union
+
+import numpy as np
+try:
+    from numba import njit
+except ImportError:
+    # fallback إلى NumPy إن لم تتوفر numba
+    njit = None
+
+# إحداثيات التثبيت: قائمة (من أداة المستشار) أو مصفوفة NumPy (من واجهة التقييم) — تُقبل كما هي
+Coords = Union[List[float], np.ndarray]
 
 # ── ثوابت كاي-تربيع ──
 # chi2.ppf(p, df=2) لمستويات ثقة شائعة
@@ -23,6 +33,31 @@ CHI2_VALUES = {
 }
 
 
+def _moments_numpy(x: np.ndarray, y: np.ndarray) -> Tuple[float, float, float]:
+    """(var_x, var_y, cov_xy) بالتباين السكاني — عبر np.cov"""
+    (var_x, cov_xy), (_, var_y) = np.cov(x, y, bias=True)
+    return var_x, var_y, cov_xy
+
+
+def _moments_loop(x: np.ndarray, y: np.ndarray) -> Tuple[float, float, float]:
+    """(var_x, var_y, cov_xy) في مرور واحد بعد المتوسط — بلا مصفوفات وسيطة (يُترجم عبر numba)"""
+    n = x.shape[0]
+    mean_x = x.mean()
+    mean_y = y.mean()
+    sxx = syy = sxy = 0.0
+    for i in range(n):
+        dx = x[i] - mean_x
+        dy = y[i] - mean_y
+        sxx += dx * dx
+        syy += dy * dy
+        sxy += dx * dy
+    return sxx / n, syy / n, sxy / n
+
+
+# نواة numba المترجمة إن توفرت (تُخزَّن ترجمتها على القرص)، وإلا np.cov
+_bcea_moments = njit(cache=True)(_moments_loop) if njit is not None else _moments_numpy
+
+
 class FixationStabilityAnalyzer:
     """
     محلل ثبات التثبيت بناءً على حساب BCEA.
@@ -42,12 +77,12 @@ class FixationStabilityAnalyzer:
         self.probability_level = probability_level
         self.chi_sq_val = CHI2_VALUES[probability_level]
 
-    def calculate_bcea(self, x_coords: List[float], y_coords: List[float]) -> float:
+    def calculate_bcea(self, x_coords: Coords, y_coords: Coords) -> float:
         """
         حساب BCEA بالدرجات المربعة (deg²).
 
         Args:
-            x_coords: إحداثيات X لنقاط التثبيت (بالدرجات البصرية)
+            x_coords: إحداثيات X لنقاط التثبيت (بالدرجات البصرية) — list أو np.ndarray
             y_coords: إحداثيات Y لنقاط التثبيت
 
         Returns:
@@ -57,13 +92,10 @@ class FixationStabilityAnalyzer:
         if n < 3 or len(y_coords) < 3 or n != len(y_coords):
             return float("inf")
 
-        # المتوسطات
-        mean_x = sum(x_coords) / n
-        mean_y = sum(y_coords) / n
-
-        # الانحراف المعياري (population)
-        var_x = sum((xi - mean_x) ** 2 for xi in x_coords) / n
-        var_y = sum((yi - mean_y) ** 2 for yi in y_coords) / n
+        # التباين والتغاير (population) — نواة numba أو np.cov
+        var_x, var_y, cov_xy = _bcea_moments(
+            np.asarray(x_coords, dtype=np.float64), np.asarray(y_coords, dtype=np.float64)
+        )
         std_x = math.sqrt(var_x)
         std_y = math.sqrt(var_y)
 
@@ -71,13 +103,12 @@ class FixationStabilityAnalyzer:
             return 0.0  # تثبيت مثالي
 
         # معامل الارتباط (بيرسون)
-        cov_xy = sum((x_coords[i] - mean_x) * (y_coords[i] - mean_y) for i in range(n)) / n
         rho = cov_xy / (std_x * std_y)
         rho = max(-0.999, min(0.999, rho))  # تجنب sqrt سالب
 
         # BCEA = π × χ² × σx × σy × √(1 - ρ²)
         bcea = math.pi * self.chi_sq_val * std_x * std_y * math.sqrt(1 - rho ** 2)
-        return round(bcea, 4)
+        return round(float(bcea), 4)
 
     def classify_stability(self, bcea: float) -> dict:
         """
@@ -116,7 +147,7 @@ class FixationStabilityAnalyzer:
             }
 
     def estimate_prl_location(
-        self, x_coords: List[float], y_coords: List[float]
+        self, x_coords: Coords, y_coords: Coords
     ) -> dict:
         """
         تقدير موقع نقطة التثبيت اللامركزي (PRL).
@@ -129,8 +160,8 @@ class FixationStabilityAnalyzer:
         if n == 0:
             return {"x": 0, "y": 0, "eccentricity": 0, "quadrant": "unknown"}
 
-        cx = sum(x_coords) / n
-        cy = sum(y_coords) / n
+        cx = float(np.mean(x_coords))
+        cy = float(np.mean(y_coords))
         eccentricity = math.sqrt(cx ** 2 + cy ** 2)
 
         if cx >= 0 and cy >= 0:
@@ -151,8 +182,8 @@ class FixationStabilityAnalyzer:
 
     def evaluate_progress(
         self,
-        session1_coords: Tuple[List[float], List[float]],
-        session2_coords: Tuple[List[float], List[float]],
+        session1_coords: Tuple[Coords, Coords],
+        session2_coords: Tuple[Coords, Coords],
     ) -> dict:
         """
         مقارنة جلستين لتقييم تأثير تدريب الارتجاع البيولوجي.
@@ -216,8 +247,8 @@ def run_fixation_assessment(params: dict) -> dict:
     Args:
         params: dict مع:
           - action: "calculate_bcea" | "evaluate_progress" | "full_assessment"
-          - x_coords / y_coords: list
-          - session1_x, session1_y, session2_x, session2_y: lists (لـ evaluate_progress)
+          - x_coords / y_coords: list أو np.ndarray
+          - session1_x, session1_y, session2_x, session2_y: lists أو np.ndarray (لـ evaluate_progress)
           - probability_level: float (default 0.68)
     """
     prob = params.get("probability_level", 0.68)
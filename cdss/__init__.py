@@ -16,6 +16,7 @@ CDSS Orchestrator — منسق نظام دعم القرار السريري
 """
 
 import os
+from functools import lru_cache
 
 from .fhir_parser import FHIRParser
 from .engine import ClinicalRuleEngine
@@ -135,8 +136,7 @@ class CDSSOrchestrator:
             eval_result["recommendations"] = recommendations
 
         # 4. إضافة المبررات لكل توصية
-        for rec in recommendations:
-            rec["justification"] = self.explainer.build_justification(rec, ctx)
+        self.explainer.build_justifications(recommendations, ctx)
 
         # 5. توليد التقرير السريري
         clinical_report = self.explainer.format_for_clinician(
@@ -185,6 +185,12 @@ class CDSSOrchestrator:
 # دالة مساعدة للاستخدام المباشر من rehab_consultant.py
 # ─────────────────────────────────────────────────────
 
+@lru_cache(maxsize=1)
+def _default_orchestrator() -> CDSSOrchestrator:
+    """منسق واحد لكل عملية — ملفات YAML وفهرس القواعد تُحمَّل مرة بدل كل تقييم"""
+    return CDSSOrchestrator()
+
+
 def run_cdss_evaluation(params: dict) -> dict:
     """
     دالة المدخل الرئيسية لأداة Claude (cdss_evaluate).
@@ -200,7 +206,7 @@ def run_cdss_evaluation(params: dict) -> dict:
     Returns:
         نتائج CDSS كاملة
     """
-    orchestrator = CDSSOrchestrator()
+    orchestrator = _default_orchestrator()
 
     input_type = params.get("input_type", "manual")
     patient_id = params.get("patient_id")
@@ -7,6 +7,7 @@ Clinical Rule Engine — محرك القواعد السريرية
 
 import os
 import yaml
+from collections import defaultdict
 from datetime import datetime
 
 
@@ -35,6 +36,7 @@ class ClinicalRuleEngine:
         self.rules_dir = rules_dir
         self.rules = []
         self._load_all_rules()
+        self._build_pattern_index()
 
     def _load_all_rules(self):
         """تحميل جميع ملفات القواعد من مجلد rules/techniques/"""
@@ -52,6 +54,23 @@ class ClinicalRuleEngine:
                         rule["_source_file"] = filename
                     self.rules.extend(data["rules"])
 
+    def _build_pattern_index(self):
+        """
+        فهرسة القواعد حسب نمط الفقد البصري المطلوب — تُبنى مرة عند التحميل.
+
+        القواعد المقيّدة بأنماط محددة تُفهرس بكل نمط منها؛ القواعد بدون قيد
+        (أو "any") تُفحص دائماً.
+        """
+        self._pattern_index = defaultdict(list)
+        self._unindexed = []
+        for pos, rule in enumerate(self.rules):
+            patterns = rule.get("conditions", {}).get("has_vision_pattern", [])
+            if patterns and "any" not in patterns:
+                for pattern in patterns:
+                    self._pattern_index[pattern].append(pos)
+            else:
+                self._unindexed.append(pos)
+
     def evaluate(self, patient_context: dict) -> list:
         """
         تقييم جميع القواعد مقابل بيانات المريض.
@@ -71,8 +90,22 @@ class ClinicalRuleEngine:
         recommendations = []
         skipped_rules = []
 
-        for rule in self.rules:
-            match_result = self._check_conditions(rule, patient_context)
+        # المرشحات: قواعد أنماط المريض من الفهرس + القواعد غير المفهرسة؛
+        # الباقي يُرفض بسبب نمط الفقد دون فحص بقية شروطه
+        patient_patterns = set(patient_context.get("vision_patterns", []))
+        candidates = set(self._unindexed)
+        for pattern in patient_patterns:
+            candidates.update(self._pattern_index.get(pattern, ()))
+
+        for pos, rule in enumerate(self.rules):
+            if pos in candidates:
+                match_result = self._check_conditions(rule, patient_context)
+            else:
+                required_patterns = rule["conditions"]["has_vision_pattern"]
+                match_result = {
+                    "matched": False,
+                    "fail_reason": f"vision pattern mismatch: need {required_patterns}, have {list(patient_patterns)}",
+                }
             if match_result["matched"]:
                 rec = self._build_recommendation(rule, patient_context, match_result)
                 recommendations.append(rec)
@@ -10,13 +10,28 @@ from datetime import datetime
 class ExplainabilityBuilder:
     """توليد مبررات بشرية وتقارير شفافية"""
 
-    def build_justification(self, recommendation: dict, patient_context: dict) -> str:
+    def build_justifications(self, recommendations: list, patient_context: dict):
+        """
+        إضافة المبرر لكل توصية في مكانها.
+
+        متغيرات القوالب تعتمد على بيانات المريض فقط — تُجمع مرة واحدة
+        (وعند أول توصية لها قالب) بدل إعادة جمعها لكل توصية.
+        """
+        variables = None
+        for rec in recommendations:
+            if variables is None and rec.get("justification_template"):
+                variables = self._collect_template_variables(patient_context)
+            rec["justification"] = self.build_justification(rec, patient_context, variables)
+
+    def build_justification(self, recommendation: dict, patient_context: dict,
+                            variables: dict = None) -> str:
         """
         ملء قالب المبرر ببيانات المريض الفعلية.
 
         Args:
             recommendation: dict من ClinicalRuleEngine
             patient_context: dict من FHIRParser
+            variables: متغيرات القالب المجمّعة مسبقاً (اختياري)
 
         Returns:
             نص المبرر الكامل (عربي)
@@ -26,7 +41,8 @@ class ExplainabilityBuilder:
             return self._generate_default_justification(recommendation, patient_context)
 
         # جمع المتغيرات لملء القالب
-        variables = self._collect_template_variables(patient_context)
+        if variables is None:
+            variables = self._collect_template_variables(patient_context)
 
         try:
             return template.format(**variables)
@@ -14,6 +14,15 @@ from .visual_augmentation import run_visual_augmentation, VisualAugmentationEngi
 from .device_router import run_device_routing, SmartDeviceRouter
 
 
+# نوع → دالة التشغيل (بحث واحد في القاموس بدل سلسلة مقارنات)
+_INTERVENTION_DISPATCH = {
+    "scanning": run_scanning_trainer,
+    "perceptual_learning": run_perceptual_learning,
+    "visual_augmentation": run_visual_augmentation,
+    "device_routing": run_device_routing,
+}
+
+
 def run_intervention(params: dict) -> dict:
     """
     واجهة موحدة لتشغيل أي تدخل علاجي.
@@ -24,20 +33,13 @@ def run_intervention(params: dict) -> dict:
           - ... باقي البارامترات حسب النوع
     """
     itype = params.get("intervention_type", "")
-
-    if itype == "scanning":
-        return run_scanning_trainer(params)
-    elif itype == "perceptual_learning":
-        return run_perceptual_learning(params)
-    elif itype == "visual_augmentation":
-        return run_visual_augmentation(params)
-    elif itype == "device_routing":
-        return run_device_routing(params)
-    else:
+    handler = _INTERVENTION_DISPATCH.get(itype)
+    if handler is None:
         return {
             "error": f"Unknown intervention_type: {itype}",
-            "available_types": ["scanning", "perceptual_learning", "visual_augmentation", "device_routing"],
+            "available_types": list(_INTERVENTION_DISPATCH),
         }
+    return handler(params)
 
 
 __all__ = [
@@ -9,6 +9,11 @@ import json
 import base64
 import anthropic
 from typing import Optional
+try:
+    import orjson
+except ImportError:
+    # fallback إلى json القياسي إن لم تتوفر orjson
+    orjson = None
 
 from tools.pubmed import search_pubmed_api, fetch_pubmed_article
 from tools.calculator import calculate_visual_params
@@ -30,6 +35,15 @@ from assessments import run_assessment
 from interventions import run_intervention
 
 
+def _read_patient_json(path: str) -> dict:
+    """قراءة ملف مريض — عبر orjson إن توفرت (أخطاؤها ترث json.JSONDecodeError)"""
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
 # ═══════════════════════════════════════════════════════════════
 # System Prompt — شخصية المستشار المتخصص
 # ═══════════════════════════════════════════════════════════════
@@ -1100,9 +1114,8 @@ def query_patient_database(params: dict) -> dict:
                 if fname.endswith(".json"):
                     path = _os.path.join(_patients_dir, fname)
                     try:
-                        with open(path, "r", encoding="utf-8") as f:
-                            p = json.load(f)
-                            patients[p["id"]] = p
+                        p = _read_patient_json(path)
+                        patients[p["id"]] = p
                     except (json.JSONDecodeError, KeyError):
                         pass
         return patients
@@ -1298,11 +1311,8 @@ def query_patient_database(params: dict) -> dict:
 
 def record_treatment_plan(params: dict) -> dict:
     """تسجيل خطة علاجية في ملف المريض الحالي"""
-    import os as _os
     from datetime import datetime as _dt
 
-    _patients_dir = _os.path.join(_os.path.dirname(_os.path.abspath(__file__)), "data", "patients")
-
     plan = {
         "timestamp": _dt.now().isoformat(),
         "plan_title": params.get("plan_title", "خطة علاجية"),
@@ -1326,13 +1336,8 @@ def record_treatment_plan(params: dict) -> dict:
             patient = st.session_state.patients[pid]
             patient.setdefault("treatment_plans", [])
             patient["treatment_plans"].append(plan)
-            # Save to disk
-            import re
-            safe_id = re.sub(r'[^A-Za-z0-9_\-]', '', pid)
-            path = _os.path.join(_patients_dir, f"{safe_id}.json")
-            patient["updated_at"] = _dt.now().isoformat()
-            with open(path, "w", encoding="utf-8") as f:
-                json.dump(patient, f, ensure_ascii=False, indent=2)
+            # الحفظ عبر save_patient في app.py (mark_dirty) — كتابة ذرية بدون المحادثة، مع تحديث السجل
+            st.session_state.setdefault("_dirty_patients", {})[pid] = patient
             return {
                 "status": "ok",
                 "message": f"تم تسجيل الخطة العلاجية '{plan['plan_title']}' في ملف المريض",
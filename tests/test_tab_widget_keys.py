@@ -0,0 +1,100 @@
+"""
+TAB_WIDGET_KEYS يجب أن يغطي كل ويدجت قيمة بمفتاح في كل تبويب من ملف المريض —
+وإلا يحذف Streamlit قيمته عند الانتقال لتبويب آخر.
+"""
+
+import ast
+import os
+import shutil
+
+import pytest
+
+pytest.importorskip("streamlit")
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# أنواع ويدجت تحمل قيمة يمكن إعادة تعيينها عبر session_state (الأزرار والمحررات والرفع مستثناة)
+VALUE_WIDGETS = (
+    "text_input", "text_area", "number_input", "selectbox", "multiselect",
+    "slider", "select_slider", "checkbox", "toggle", "radio", "date_input", "time_input",
+)
+
+
+def _tab_widget_keys() -> dict:
+    """قراءة TAB_WIDGET_KEYS من app.py دون تشغيل السكربت"""
+    with open(os.path.join(REPO, "app.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(t, ast.Name) and t.id == "TAB_WIDGET_KEYS" for t in node.targets):
+            return ast.literal_eval(node.value.args[0])
+    raise AssertionError("TAB_WIDGET_KEYS غير موجود في app.py")
+
+
+def _covered(key: str, patterns: tuple, pid: str) -> bool:
+    for pattern in patterns:
+        pattern = pattern.format(pid=pid)
+        if key == pattern or (pattern.endswith("*") and key.startswith(pattern[:-1])):
+            return True
+    return False
+
+
+def _widget_keys(at: AppTest, pid: str) -> set:
+    keys = set()
+    for kind in VALUE_WIDGETS:
+        for widget in getattr(at, kind, ()):
+            if widget.key and pid in widget.key and widget.key != f"tab_{pid}":
+                keys.add(widget.key)
+    return keys
+
+
+# نسخة واحدة من التطبيق للوحدة — موارد st.cache_resource (الكاتب، السجل) مشتركة في العملية
+@pytest.fixture(scope="module")
+def app(tmp_path_factory):
+    dst = tmp_path_factory.mktemp("app")
+    shutil.copytree(REPO, dst, dirs_exist_ok=True, ignore=shutil.ignore_patterns(
+        ".git", "tests", "*.whl", "__pycache__", "MR-*", "registry.db*", ".counter*"))
+    cwd = os.getcwd()
+    os.chdir(dst)
+    os.environ.pop("ANTHROPIC_API_KEY", None)
+    at = AppTest.from_file(str(dst / "app.py"), default_timeout=60).run()
+    next(b for b in at.button if b.key == "new_patient_btn").click().run()
+    at.selectbox(key="np_rehab_type").set_value("vision").run()
+    at.text_input(key="np_name").input("اختبار")
+    next(b for b in at.button if b.label.startswith("حفظ")).click().run()
+    assert not at.exception
+    yield at, at.session_state["current_patient_id"]
+    os.chdir(cwd)
+
+
+def test_every_keyed_widget_is_listed(app):
+    at, pid = app
+    listed = _tab_widget_keys()
+    # لوحات التبويب الفرعية تُعرض حسب الاختيار — يُمر على كل خيار ليظهر كل ويدجت
+    sub_panels = {"التقييمات": f"at_{pid}", "التدخلات": f"it_{pid}", "التقارير": f"doc_type_{pid}"}
+    missing = {}
+    for tab in at.radio(key=f"tab_{pid}").options:
+        at.radio(key=f"tab_{pid}").set_value(tab).run()
+        assert not at.exception, tab
+        seen = _widget_keys(at, pid)
+        selector = sub_panels.get(tab)
+        if selector:
+            for option in at.selectbox(key=selector).options:
+                at.selectbox(key=selector).select(option).run()
+                assert not at.exception, (tab, option)
+                seen |= _widget_keys(at, pid)
+        not_listed = sorted(k for k in seen if not _covered(k, listed.get(tab, ()), pid))
+        if not_listed:
+            missing[tab] = not_listed
+    assert not missing, f"ويدجت غير مدرجة في TAB_WIDGET_KEYS: {missing}"
+
+
+def test_cdss_multiselect_survives_tab_switch(app):
+    at, pid = app
+    at.radio(key=f"tab_{pid}").set_value("CDSS").run()
+    at.multiselect(key=f"cdss_pat_{pid}").set_value(["hemianopia"])
+    next(b for b in at.button if b.label == "تشغيل تقييم CDSS").click().run()
+    at.radio(key=f"tab_{pid}").set_value("الملخص").run()
+    at.radio(key=f"tab_{pid}").set_value("CDSS").run()
+    assert at.multiselect(key=f"cdss_pat_{pid}").value == ["hemianopia"]
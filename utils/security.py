@@ -45,6 +45,11 @@ SENSITIVE_DATA_PATTERNS = [
     (r'\b\d{3}-\d{2}-\d{4}\b', '[REDACTED_SSN]'),  # SSN أمريكي
 ]
 
+# تُترجم الأنماط مرة واحدة عند التحميل — ونمط مُجمَّع يتخطى فحص كل نمط على حدة للنص السليم
+_INJECTION_RES = [(p, re.compile(p, flags=re.IGNORECASE)) for p in INJECTION_PATTERNS]
+_ANY_INJECTION_RE = re.compile("|".join(f"(?:{p})" for p in INJECTION_PATTERNS), flags=re.IGNORECASE)
+_SENSITIVE_RES = [(re.compile(p), replacement) for p, replacement in SENSITIVE_DATA_PATTERNS]
+
 
 # ═══════════════════════════════════════════════════════════════
 # تنظيف المدخلات
@@ -67,16 +72,17 @@ def sanitize_patient_input(text: str) -> str:
     original_length = len(text)
 
     # فحص Prompt Injection
-    for pattern in INJECTION_PATTERNS:
-        if re.search(pattern, text, flags=re.IGNORECASE):
-            logger.warning(
-                f"[SECURITY] محاولة Prompt Injection مكتشفة: '{pattern[:50]}'"
-            )
-            text = re.sub(pattern, "[FILTERED]", text, flags=re.IGNORECASE)
+    if _ANY_INJECTION_RE.search(text):
+        for pattern, regex in _INJECTION_RES:
+            if regex.search(text):
+                logger.warning(
+                    f"[SECURITY] محاولة Prompt Injection مكتشفة: '{pattern[:50]}'"
+                )
+                text = regex.sub("[FILTERED]", text)
 
     # إخفاء البيانات الشديدة الحساسية
-    for pattern, replacement in SENSITIVE_DATA_PATTERNS:
-        text = re.sub(pattern, replacement, text)
+    for regex, replacement in _SENSITIVE_RES:
+        text = regex.sub(replacement, text)
 
     # تنظيف أساسي
     # إزالة الأصفار والمسافات الزائدة